@@ -1,9 +1,12 @@
 import os
 import sqlite3
-from flask import Flask, render_template, request, g
+from flask import Flask, render_template, request, g, Response, abort
+from markupsafe import Markup
 import datetime
-from db import get_db_connection
+from db import get_db_connection, close_db_connection
 from identity import get_email_address_and_name, get_cached_identity_full
+from storage import open_raw, raw_name
+from fts import build_match_query, snippet_html, RANK_SQL, SNIPPET_SQL
 
 app = Flask(__name__)
 
@@ -14,40 +17,26 @@ def get_db():
 
 @app.teardown_appcontext
 def close_db(error):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    # The request thread's shared connection (close() is a no-op on it): really close it,
+    # or the threaded server leaves one open per request thread
+    g.pop('db', None)
+    close_db_connection()
 
 def get_sidebar_data():
     """Fetch data for the sidebar: Year/Month tree and Top Senders."""
     db = get_db()
     c = db.cursor()
     
-    # 1. Date Tree
-    # Fix: Date column contains raw email date strings (e.g. 'Thu, 3 Feb...').
-    # We must parse them in Python to group correctly. SQL substr won't work reliably.
-    
-    c.execute("SELECT date FROM emails")
+    # 1. Date Tree (year/month are parsed at download time)
+    c.execute("SELECT year, month, COUNT(*) FROM emails WHERE year IS NOT NULL GROUP BY year, month")
     rows = c.fetchall()
     
     date_tree = {}
-    
-    from email.utils import parsedate_to_datetime
-    
     for r in rows:
-        d_str = r[0]
-        if not d_str: continue
-        try:
-            # Parse RFC2822 date
-            dt = parsedate_to_datetime(d_str)
-            y = str(dt.year)
-            m = f"{dt.month:02d}" # Zero pad
-            
-            if y not in date_tree: date_tree[y] = {}
-            if m not in date_tree[y]: date_tree[y][m] = 0
-            date_tree[y][m] += 1
-        except:
-             continue
+        y = str(r[0])
+        m = f"{r[1]:02d}" # Zero pad
+        if y not in date_tree: date_tree[y] = {}
+        date_tree[y][m] = r[2]
     
     # Convert dict to sorted list structure
     sorted_tree = {}
@@ -94,6 +83,23 @@ def get_sidebar_data():
 
 
 import re
+import calendar
+from email.utils import parsedate_to_datetime
+
+def date_arg_to_epoch(date_arg, next_day=False):
+    """'YYYY-MM-DD' -> UTC epoch (day clamped to the month). None if invalid."""
+    if not date_arg:
+        return None
+    try:
+        y, m, d = map(int, date_arg.split('-'))
+        d = min(d, calendar.monthrange(y, m)[1])
+        dt = datetime.datetime(y, m, d, tzinfo=datetime.timezone.utc)
+    except:
+        return None
+    if next_day:
+        dt += datetime.timedelta(days=1)
+    return int(dt.timestamp())
+
 def clean_filename(s):
     """Sanitize string (Duplicated from downloader.py for path matching)."""
     s = str(s).strip().replace('"', '').replace("'", "").replace("\n", "").replace("\r", "")
@@ -106,103 +112,57 @@ def index():
     start_date = request.args.get('start_date', '')
     end_date = request.args.get('end_date', '')
     sender_filter = request.args.get('sender_email', '').strip()
+    # Sidebar timeline clicks: same header-local year/month columns the sidebar counts
+    year_filter = request.args.get('year', type=int)
+    month_filter = request.args.get('month', type=int)
     
     limit = 100
     
-    # Fetch all for Python-side sorting/filtering (Date format issue)
-    # OR: Try to utilize SQLite if we can. 
-    # But current 'date' column is messy text. Sorting 'Thu, ...' vs 'Wed, ...' is wrong.
-    # To fix SORTING, we need to fetch all and sort in Python, or add a proper column.
-    # For 100 limit, fetching all is okay if DB is small (<10k). 
-    # If DB is large, this will be slow.
-    # BEST FIX: Use 'id' DESC as proxy for date (assuming download order ~ date order). 
-    # downloader.py usually downloads mostly in order or we can rely on it.
-    # BUT user insisted on "descending order of dates".
-    # Let's try to fetch a larger batch, sort in python, slice.
-    
-    sql = "SELECT * FROM emails WHERE 1=1"
+    # Dates are filtered and sorted in SQL on date_epoch (UTC, parsed at download time)
+    sql = "SELECT e.*, NULL AS snippet FROM emails e WHERE 1=1"
     params = []
-    
-    if query:
-        sql += " AND (subject LIKE ? OR sender LIKE ? OR message_id LIKE ?)"
-        wildcard_query = f"%{query}%"
-        params.extend([wildcard_query, wildcard_query, wildcard_query])
+    order = "date_epoch DESC"
+    
+    match = build_match_query(query) if query else ''
+    if query.startswith('<') and query.endswith('>'):
+        # Message-ID lookup
+        sql += " AND message_id = ?"
+        params.append(query)
+    elif match:
+        # Full-text search (subject, sender, recipients, attachment names, body), best match first
+        sql = f"SELECT e.*, {SNIPPET_SQL} AS snippet FROM emails_fts JOIN emails e ON e.id = emails_fts.rowid WHERE emails_fts MATCH ?"
+        params.append(match)
+        order = RANK_SQL
         
     if sender_filter:
         # FILTER SENDER & RECIPIENT (Conversation View)
-        # Use local_path trick: the folder name contains the other party's email.
-        # This covers both emails FROM them (folder=sender) and emails TO them (folder=recipient).
-        clean_email = clean_filename(sender_filter)
+        # other_party is the sender for received and the recipient for sent emails
+        sql += " AND other_party = ?"
+        params.append(sender_filter.lower())
         
-        # We search if local_path contains that clean folder name
-        # Windows path: ...\clean_email\filename.eml
-        # Linux: .../clean_email/filename.eml
-        # So we look for path separator + clean_email + path separator
-        # match %sep%clean_email%sep%
-        
-        # Simpler: just "%clean_email%" but make sure it's valid
-        if clean_email:
-             sql += " AND local_path LIKE ?"
-             params.append(f"%{clean_email}%")
-        else:
-             # Fallback to sender field if name cleaning fails
-             sql += " AND sender LIKE ?"
-             params.append(f"%{sender_filter}%")
-
-        
-    if start_date:
-        sql += " AND date >= ?"
-        params.append(start_date)
+    if year_filter is not None:
+        sql += " AND year = ?"
+        params.append(year_filter)
+        if month_filter is not None:
+            sql += " AND month = ?"
+            params.append(month_filter)
+            
+    start_epoch = date_arg_to_epoch(start_date)
+    if start_epoch is not None:
+        sql += " AND date_epoch >= ?"
+        params.append(start_epoch)
+    end_epoch = date_arg_to_epoch(end_date, next_day=True)
+    if end_epoch is not None:
+        sql += " AND date_epoch < ?"
+        params.append(end_epoch)
         
-    # Remove SQL Order/Limit for now, do it in Python to fix Date Sort
-    # sql += " ORDER BY date DESC LIMIT ?" 
-    # params.append(limit)
+    sql += f" ORDER BY {order} LIMIT ?"
+    params.append(limit)
     
     db = get_db()
     cursor = db.cursor()
     cursor.execute(sql, params)
-    raw_emails = cursor.fetchall()
-    
-    # Python-side Date Parsing & Sorting
-    from email.utils import parsedate_to_datetime
-    
-    all_results = []
-    for r in raw_emails:
-        # Convert row to dict for mutability
-        item = dict(r)
-        
-        # Parse Date
-        try:
-             dt = parsedate_to_datetime(item['date'])
-             
-             # Ensure Timezone Awareness to prevent sort errors
-             if dt.tzinfo is None:
-                 dt = dt.replace(tzinfo=datetime.timezone.utc)
-             
-             # Filter by Date Range (if set) in Python since SQL format is raw text
-             if start_date:
-                  sd_obj = datetime.datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=dt.tzinfo)
-                  if dt < sd_obj: continue
-             if end_date:
-                  ed_obj = datetime.datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=dt.tzinfo)
-                  # Inclusive of end day?
-                  ed_obj = ed_obj + datetime.timedelta(days=1)
-                  if dt >= ed_obj: continue
-                  
-             item['_dt'] = dt
-             item['display_date'] = str(dt) # standardized display
-        except:
-             # Fallback
-             item['_dt'] = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
-             item['display_date'] = item['date']
-             
-        all_results.append(item)
-        
-    # Sort with safety for mixed types (though we tried to fix above)
-    all_results.sort(key=lambda x: x['_dt'], reverse=True)
-    
-    # Pagination / Limit
-    display_slice = all_results[:limit]
+    display_slice = cursor.fetchall()
     
     display_emails = []
     for r in display_slice:
@@ -216,10 +176,16 @@ def index():
              n, _ = get_email_address_and_name(raw_s)
              best_name = n if n else email_addr
              
+        try:
+            display_date = str(parsedate_to_datetime(r['date']))
+        except:
+            display_date = r['date'] or ''
+            
         display_emails.append({
             'id': r['id'],
-            'date': r['display_date'], # Clean ISO-ish string
+            'date': display_date, # Clean ISO-ish string
             'subject': r['subject'],
+            'snippet': Markup(snippet_html(r['snippet'])) if r['snippet'] else '',
             'sender_name': best_name,
             'sender_email': email_addr,
             'local_path': r['local_path']
@@ -233,10 +199,33 @@ def index():
                            query=query, 
                            start_date=start_date, 
                            end_date=end_date,
+                           year_filter=year_filter,
+                           month_filter=month_filter,
                            sender_filter=sender_filter,
                            date_tree=date_tree,
                            top_senders=top_senders)
 
+@app.route('/email/<int:email_id>/raw')
+def raw_email(email_id):
+    """Download the original .eml (decompressed on the fly)."""
+    c = get_db().cursor()
+    c.execute("SELECT local_path FROM emails WHERE id = ?", (email_id,))
+    row = c.fetchone()
+    if not row or not row['local_path'] or not os.path.exists(row['local_path']):
+        abort(404)
+        
+    def generate():
+        with open_raw(row) as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                yield chunk
+                
+    filename = raw_name(row['local_path'])
+    return Response(generate(), mimetype='message/rfc822',
+                    headers={'Content-Disposition': f'attachment; filename="{clean_filename(filename)}"'})
+
 if __name__ == '__main__':
+    from db import backfill_pending
+    if backfill_pending('email_columns'):
+        print("Some emails have no date/party columns yet. Run 'python main.py backfill' first.")
     print("Starting Flask with Sidebar & Identity...")
     app.run(debug=True, port=5000, host='0.0.0.0')
@@ -9,7 +9,6 @@ import email.utils
 from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 from email.header import decode_header
 import datetime
 import re
@@ -18,38 +17,140 @@ import shutil
 import ollama
 import json
 import subprocess
+import concurrent.futures
+import collections
 import glob
 
 from config import load_config
-from db import get_db_connection
-from identity import get_cached_identity_full, update_cached_identity, get_better_name, get_email_address_and_name, decode_mime_words, process_identity
+from db import get_db_connection, backfill_pending, batch, run_backfill, save_concentrated_items
+from db import save_mime_summaries, load_mime_summary, archive_group_key, get_archive_group_counts
+from identity import get_cached_identity_full, update_cached_identity, get_better_name, get_email_address_and_name, decode_mime_words, process_identity, flush_identities, decision_report
+from storage import raw_size, raw_name, raw_format, extract_raw, scan_email, mime_part_offsets, write_multipart, split_ranges
+from storage import base64_size, attachment_part_size, multipart_size, BOUNDARY_LEN
+from downloader import mime_summary
+from fts import index_email
 
 MAX_SIZE_BYTES = 49 * 1024 * 1024 # 49MB
-SPLIT_THRESHOLD = 33 * 1024 * 1024 # 33MB
+SPLIT_THRESHOLD = 33 * 1024 * 1024 # 33MB: smaller emails always fit whole; bigger ones are split only if they don't (fits_whole)
 RAR_PART_SIZE = "16m"
+SPLIT_PART_SIZE = 16 * 1024 * 1024 # Pieces of an oversized email (builtin splitter)
 
 # ... (omitted helper lines) ...
 
 def mark_as_concentrated(email_ids, concentrated_id):
     conn = get_db_connection()
     c = conn.cursor()
-    for eid in email_ids:
-        c.execute("UPDATE emails SET is_concentrated = 1, concentrated_id = ? WHERE id = ?", (concentrated_id, eid))
+    c.executemany("UPDATE emails SET is_concentrated = 1, concentrated_id = ? WHERE id = ?", [(concentrated_id, eid) for eid in email_ids])
     conn.commit()
     conn.close()
 
-def save_concentrated_record(sender, file_path, metadata, uploaded=0):
+def get_concentrated_ids(email_ids):
+    """The ids among email_ids that are already in an archive."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    found = set()
+    for i in range(0, len(email_ids), 500): # SQLite variable limit
+        chunk = email_ids[i:i + 500]
+        c.execute(f"SELECT id FROM emails WHERE is_concentrated = 1 AND id IN ({','.join('?' * len(chunk))})", chunk)
+        found.update(r[0] for r in c.fetchall())
+    return found
+
+def archive_items(metadata, offsets=None):
+    """concentrated_items rows for an archive's metadata list (offsets: its MIME parts, in the same order)."""
+    items = []
+    for n, m in enumerate(metadata):
+        part_index, total_parts = m.get('part_index'), m.get('total_parts')
+        if m.get('is_part') and part_index is None:
+            # Older metadata only has it in the subject
+            found = re.match(r'\[Part (\d+)/(\d+)\]', m.get('subject', ''))
+            if found: part_index, total_parts = int(found.group(1)), int(found.group(2))
+        offset, size = offsets[n] if offsets and n < len(offsets) else (None, None)
+        items.append({
+            'email_id': m['original_id'],
+            'part_index': part_index or 0,
+            'total_parts': total_parts or 1,
+            'filename': m.get('filename'),
+            'byte_offset': offset,
+            'size': size,
+            'attachments': m.get('att_details'),
+        })
+    return items
+
+def save_concentrated_record(sender, file_path, metadata, offsets=None, uploaded=0, year=None, is_delta=0):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute('''
-        INSERT INTO concentrated_emails (sender, file_path, content_metadata, uploaded)
-        VALUES (?, ?, ?, ?)
-    ''', (sender, file_path, json.dumps(metadata), uploaded))
+        INSERT INTO concentrated_emails (sender, file_path, uploaded, year, group_key, is_delta)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (sender, file_path, uploaded, year, archive_group_key(sender), is_delta))
     new_id = c.lastrowid
+    save_concentrated_items(new_id, archive_items(metadata, offsets))
     conn.commit()
     conn.close()
     return new_id
 
+def backfill_concentrated_items(chunk_size=100):
+    """Backfill 'concentrated_items': move the content_metadata JSON of old archives into rows."""
+    def process(rows):
+        conn = get_db_connection()
+        for row in rows:
+            try:
+                metadata = json.loads(row['content_metadata'])
+            except Exception as e:
+                print(f"  Bad metadata in archive {row['id']}: {e}")
+                continue
+            offsets = None
+            if row['file_path'] and os.path.exists(row['file_path']):
+                with open(row['file_path'], 'rb') as f:
+                    offsets = mime_part_offsets(f)
+            conn.execute("DELETE FROM concentrated_items WHERE concentrated_id = ?", (row['id'],))
+            save_concentrated_items(row['id'], archive_items(metadata, offsets))
+            conn.execute("UPDATE concentrated_emails SET content_metadata = NULL WHERE id = ?", (row['id'],))
+            
+    return run_backfill('concentrated_items',
+                        "SELECT id, file_path, content_metadata FROM concentrated_emails WHERE id > ? AND content_metadata IS NOT NULL ORDER BY id LIMIT ?",
+                        process, chunk_size)
+
+def release_delta_archives(start_year=None, end_year=None):
+    """
+    --merge-deltas: put the emails of delta archives that are not uploaded yet back in the
+    queue and delete those archives, so this run repacks them with the new mail into
+    full-size archives. Deltas holding split parts are kept (the other parts of the
+    email may sit in a full archive).
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    sql = '''
+        SELECT id, file_path FROM concentrated_emails ce
+        WHERE is_delta = 1 AND uploaded = 0
+          AND NOT EXISTS (SELECT 1 FROM concentrated_items i WHERE i.concentrated_id = ce.id AND i.part_index > 0)
+    '''
+    params = []
+    if start_year is not None:
+        sql += " AND year >= ?"
+        params.append(start_year)
+    if end_year is not None:
+        sql += " AND year <= ?"
+        params.append(end_year)
+    c.execute(sql, params)
+    rows = c.fetchall()
+    if not rows:
+        return 0
+    
+    released = 0
+    with batch():
+        for row in rows:
+            c.execute("UPDATE emails SET is_concentrated = 0, concentrated_id = NULL WHERE id IN (SELECT email_id FROM concentrated_items WHERE concentrated_id = ?)", (row['id'],))
+            released += c.rowcount
+            c.execute("DELETE FROM concentrated_items WHERE concentrated_id = ?", (row['id'],))
+            c.execute("DELETE FROM concentrated_emails WHERE id = ?", (row['id'],))
+            
+    for row in rows:
+        try: os.remove(row['file_path'])
+        except OSError: pass
+    print(f"Merging {len(rows)} delta archives ({released} emails) into this run.")
+    return len(rows)
+
 # ... (rest of helper functions) ...
 
 
@@ -65,9 +166,29 @@ def clean_filename(s):
 
 # duplicate function removed
 
+def split_email_parts(row):
+    """
+    Queue items for an email too big to attach whole (builtin splitter): byte ranges of its stored
+    file, SPLIT_PART_SIZE each. Compressed raw files are split as stored. Nothing is written
+    here: build_archive streams every range straight into its archive, and the summary text
+    says how to put the pieces back together.
+    """
+    fpath = row['local_path']
+    stored_size = os.path.getsize(fpath)
+    ranges = split_ranges(stored_size, SPLIT_PART_SIZE)
+    return [{
+        'type': 'part',
+        'path': fpath,
+        'range': r,
+        'stored_size': stored_size,
+        'original_row': row,
+        'part_index': i + 1,
+        'total_parts': len(ranges)
+    } for i, r in enumerate(ranges)]
+
 def split_email_with_zip(file_path):
     """
-    Split a large email file into ZIP parts using 7-Zip.
+    Split a large email file into ZIP parts using 7-Zip (split_method: 7z).
     Returns list of paths to generated parts.
     """
     config = load_config()
@@ -80,6 +201,10 @@ def split_email_with_zip(file_path):
     temp_dir = os.path.join("data", "temp_zip")
     os.makedirs(temp_dir, exist_ok=True)
     
+    # 7-Zip needs the plain .eml (raw_compression)
+    source_path = file_path
+    file_path = extract_raw(file_path, temp_dir)
+    
     basename = os.path.basename(file_path)
     # Output archive name
     zip_name = f"{basename}.zip"
@@ -97,6 +222,8 @@ def split_email_with_zip(file_path):
             
         print(f"Splitting {basename} (>33MB) to ZIP...")
         subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if file_path != source_path:
+            os.remove(file_path)
         
         # Find generated parts
         # 7-Zip split zip naming is usually .zip.001, .zip.002 OR .zip, .z01, .z02 depending on version.
@@ -119,7 +246,7 @@ def split_email_with_zip(file_path):
         return parts
     except Exception as e:
         print(f"ZIP splitting failed: {e}")
-        return [file_path]
+        return [source_path]
 
 
 # duplicate function removed
@@ -128,60 +255,94 @@ def get_unconcentrated_years():
     """Get list of distinct years present in unconcentrated emails."""
     conn = get_db_connection()
     c = conn.cursor()
-    # We need to parse year from 'date' column. 
-    # Since date format varies, this is tricky in pure SQL.
-    # But usually we can get min/max date?
-    # Or just fetch all dates and parse in python (lightweight compared to fetching all content)
-    c.execute("SELECT date FROM emails WHERE is_concentrated = 0")
+    # year is parsed at download time (NULL = unparseable date, counted as this year)
+    c.execute("SELECT DISTINCT year FROM emails WHERE is_concentrated = 0")
     rows = c.fetchall()
     conn.close()
     
     years = set()
     for r in rows:
-        try:
-            d = email.utils.parsedate_to_datetime(r['date'])
-            years.add(d.year)
-        except:
-             years.add(datetime.datetime.now().year)
+        years.add(r['year'] if r['year'] is not None else datetime.datetime.now().year)
              
     return sorted(list(years))
 
-def get_unconcentrated_emails_for_year(year):
-    """Fetch emails for a specific year manually since SQL date parsing is hard."""
-    # We have to fetch all and filter in python? NO, that defeats the purpose.
-    # But SQLite doesn't have easy date parsing for our custom strings.
-    # Wait, 99% of our dates should be standard. 
-    # Actually, we can fetch ID + Date, filter in python, then fetch full rows by ID? 
-    # That is memory efficient.
+def _year_filter(year):
+    # Unconcentrated emails of a year (NULL = unparseable date, counted as this year); takes (year,)
+    sql = "is_concentrated = 0 AND (year = ?"
+    if year == datetime.datetime.now().year: # Fallback year
+        sql += " OR year IS NULL"
+    return sql + ")"
+
+def email_party(row, me_address_str):
+    """
+    (other party address, name, source type) of an email: the sender (0 = Received/From Header),
+    or the first To recipient of mail I sent (1 = Sent/To Header), from the cached mime summary.
+    """
+    real_name, email_addr = get_email_address_and_name(row['sender'])
     
+    # Simple check if I am the sender
+    if me_address_str and me_address_str.lower() in email_addr.lower():
+        try:
+            summary = load_mime_summary(row)
+            if summary is None:
+                summary = mime_summary(*scan_email(row['local_path']))
+                save_mime_summaries([(row['id'], summary)])
+            to_header = summary['to'] or 'Unknown'
+            t_name, t_email = get_email_address_and_name(to_header)
+            return t_email, (t_name if t_name else t_email), 1
+        except Exception as e:
+            # print(f"Error reading file {row['local_path']}: {e}")
+            pass
+    return email_addr, real_name, 0
+
+def assign_group_keys(year, me_address_str, chunk_size=1000):
+    """
+    Set emails.group_key (email_party's address, 'unknown' if none) for the year's unconcentrated
+    emails that don't have one yet, chunk by chunk. After the first run this is only the new mail.
+    """
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT id, date FROM emails WHERE is_concentrated = 0")
-    all_rows = c.fetchall()
-    
-    target_ids = []
-    
-    for r in all_rows:
-        try:
-            d = email.utils.parsedate_to_datetime(r['date'])
-            if d.year == year:
-                target_ids.append(r['id'])
-        except:
-            if year == datetime.datetime.now().year: # Fallback year
-                 target_ids.append(r['id'])
-                 
-    if not target_ids:
-        conn.close()
-        return []
-        
-    # Now fetch full rows
-    # chunk it if too big? 
-    placeholders = ','.join(['?'] * len(target_ids))
-    query = f"SELECT * FROM emails WHERE id IN ({placeholders}) ORDER BY date"
-    c.execute(query, target_ids)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    last_id = 0
+    done = 0
+    while True:
+        c.execute(f"SELECT * FROM emails WHERE {_year_filter(year)} AND group_key IS NULL AND id > ? ORDER BY id LIMIT ?",
+                  (year, last_id, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        keys = [(email_party(row, me_address_str)[0] or 'unknown', row['id']) for row in rows]
+        with batch():
+            c.executemany("UPDATE emails SET group_key = ? WHERE id = ?", keys)
+        last_id = rows[-1]['id']
+        done += len(rows)
+        print(f"Grouping {done} emails...")
+    return done
+
+def get_year_groups(year):
+    """(group_key, email count) of a year's unconcentrated emails, counted on the index."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT group_key, COUNT(*) FROM emails WHERE {_year_filter(year)} GROUP BY group_key ORDER BY group_key", (year,))
+    return [(r[0], r[1]) for r in c.fetchall()]
+
+def get_group_emails(year, group_key):
+    """One group's unconcentrated emails of a year, by date (index on is_concentrated, year, group_key, date_epoch)."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT * FROM emails WHERE {_year_filter(year)} AND group_key = ? ORDER BY date_epoch, id", (year, group_key))
+    return c.fetchall()
+
+def get_single_emails(year):
+    """The emails that are alone in their group this year (misc_singles candidates), by date."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    year_filter = _year_filter(year)
+    c.execute(f'''
+        SELECT * FROM emails WHERE {year_filter} AND group_key IN (
+            SELECT group_key FROM emails WHERE {year_filter} GROUP BY group_key HAVING COUNT(*) = 1)
+        ORDER BY date_epoch, id
+    ''', (year, year))
+    return c.fetchall()
 
 def connect_imap():
     config = load_config()
@@ -308,30 +469,6 @@ def upload_to_imap(file_path, retry_interactive=True, mail_conn=None):
 
 
 
-def parse_attachments_metrics(msg):
-    """Return count, size, and list of {name, size} for attachments."""
-    count = 0
-    total_size = 0
-    details = []
-    
-    for part in msg.walk():
-        if part.get_content_maintype() == 'multipart':
-            continue
-        if part.get('Content-Disposition') is None:
-            continue
-            
-        filename = part.get_filename()
-        if filename:
-            filename = decode_mime_words(filename)
-            payload = part.get_payload(decode=True)
-            if payload:
-                size = len(payload)
-                count += 1
-                total_size += size
-                details.append({'name': filename, 'size': size})
-                
-    return count, total_size, details
-
 def format_size(size_bytes):
     if size_bytes < 1024:
         return f"{size_bytes}B"
@@ -340,12 +477,419 @@ def format_size(size_bytes):
     else:
         return f"{size_bytes/(1024*1024):.1f}M"
 
-def concentrate_emails(start_year_arg=None, end_year_arg=None):
+def parse_row_date(row):
+    try:
+        dt = email.utils.parsedate_to_datetime(row['date'])
+        if dt.tzinfo is None: dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt
+    except:
+        return None
+
+def member_name(item):
+    if 'range' in item:
+        return f"{os.path.basename(item['path'])}.{item['part_index']:03d}"
+    return raw_name(item['path'])
+
+def member_size(item):
+    # Bytes before base64 encoding
+    return item['range'][1] if 'range' in item else raw_size(item['path'])
+
+def member_source(item):
+    # What write_multipart streams: a file range for builtin split pieces, else the (raw) file
+    return (item['path'],) + tuple(item['range']) if 'range' in item else item['path']
+
+def item_metadata(item, summary):
+    """Archive metadata of one queue item (summary: cached mime summary, unused for parts)."""
+    path = item['path']
+    row = item['original_row']
+    original_filename = raw_name(path)
+    
+    if item['type'] == 'part':
+        # Split parts: recipients are not read from the (huge) original file
+        meta = {
+            'original_id': row['id'],
+            'subject': f"[Part {item['part_index']}/{item['total_parts']}] {row['subject']}",
+            'date': row['date'],
+            'date_iso': row['date'], 
+            'message_id': row['message_id'],
+            'to': "Unknown",
+            'cc': "",
+            'att_details': [{'name': member_name(item), 'size': member_size(item)}],
+            'filename': original_filename,
+            'is_part': True,
+            'part_index': item['part_index'],
+            'total_parts': item['total_parts']
+        }
+        if 'range' in item:
+            # Reassembly manifest (summary text)
+            meta['part_range'] = tuple(item['range'])
+            meta['stored_name'] = os.path.basename(path)
+            meta['stored_size'] = item['stored_size']
+            meta['compressed'] = raw_format(path) != 'none'
+            meta['sha256'] = dict(row).get('sha256')
+        return meta
+        
+    d = parse_row_date(row)
+    return {
+        'original_id': row['id'],
+        'subject': row['subject'],
+        'date': row['date'],
+        'date_iso': d.strftime('%Y-%m-%d %H:%M:%S') if d else row['date'],
+        'message_id': row['message_id'],
+        'to': summary['to'],
+        'cc': summary['cc'],
+        'bcc': summary['bcc'],
+        'att_details': summary['attachments'],
+        'filename': original_filename,
+        'is_part': False
+    }
+
+def archive_title(year, party_display, part_num, total_parts, email_count, att_count, size_str, fd_str, ld_str):
+    return f"{year}_[{party_display}]_{part_num}/{total_parts}_{email_count}-Emails_{att_count}-Files-{size_str.replace(' ', '')}_{fd_str}_{ld_str}"
+
+def chunk_title(year, party_display, part_num, total_parts, metadata_list):
+    """Archive title: counts, attachment size and date range (YYYYMMDD) of the whole emails in the chunk."""
+    emails = [m for m in metadata_list if not m['is_part']]
+    atts = [a for m in emails for a in m['att_details']]
+    dates = [d for d in (parse_row_date(m) for m in emails) if d]
+    fd_str = min(dates).strftime("%Y%m%d") if dates else "00000000"
+    ld_str = max(dates).strftime("%Y%m%d") if dates else "00000000"
+    return archive_title(year, party_display, part_num, total_parts, len(metadata_list), len(atts),
+                         format_size(sum(a['size'] for a in atts)), fd_str, ld_str)
+
+def archive_message(title_str, party_display, sender_for_new_email, receipt_address):
+    """Outer message (headers only) of an archive."""
+    outer = MIMEMultipart()
+    outer['Subject'] = title_str
+    outer['From'] = sender_for_new_email
+    if receipt_address:
+        if '<' in receipt_address: outer['To'] = receipt_address
+        else:
+            p_name, _ = get_email_address_and_name(party_display)
+            if not p_name: p_name = "Concentration"
+            outer['To'] = f"{p_name} <{receipt_address}>"
+    else:
+        outer['To'] = party_display 
+        
+    outer['Date'] = email.utils.formatdate(localtime=True)
+    return outer
+
+def summary_header_lines(title_str):
+    return ["Concentrated Email Archive", f"Title: {title_str}", "=" * 60, ""]
+
+def summary_item_lines(m):
+    lines = []
+    lines.append(f"Subject: {m['subject']}")
+    lines.append(f"Date:    {m['date']}")
+    lines.append(f"File:    {m['filename']}") 
+    lines.append(f"To:      {m['to']}")
+    if m['cc']: lines.append(f"Cc:      {m['cc']}")
+    if m.get('part_range'):
+        offset, length = m['part_range']
+        name = m['stored_name']
+        lines.append(f"Piece:   bytes {offset}-{offset + length - 1} of {name} ({m['stored_size']} bytes)")
+        rejoin = f"Rejoin:  concatenate {name}.001 ... {name}.{m['total_parts']:03d} in order"
+        if m['compressed']: rejoin += ", then decompress"
+        lines.append(rejoin)
+        if m['sha256']: lines.append(f"SHA-256: {m['sha256']} (the email)")
+    
+    if m['att_details']:
+        lines.append("  Attachments:")
+        for att in m['att_details']:
+            lines.append(f"  - {att['name']} ({format_size(att['size'])})")
+    else:
+        lines.append("  (No Attachments)")
+        
+    lines.append("-" * 40)
+    lines.append("")
+    return lines
+
+def _lines_size(lines):
+    # Bytes the lines add to the "\n"-joined summary text
+    return sum(len(line.encode('utf-8')) + 1 for line in lines)
+
+SUMMARY_PART_HEADERS = len(MIMEText('', 'plain', 'utf-8').as_bytes())
+
+def summary_part_size(text_size):
+    # MIMEText utf-8 bodies are base64 with 76-char lines, like the members
+    return SUMMARY_PART_HEADERS + base64_size(text_size)
+
+def member_subtype(item):
+    if item['type'] != 'part':
+        return 'rfc822'
+    return 'octet-stream' if 'range' in item else 'zip'
+
+UNSCANNED_SUMMARY = {'to': '', 'cc': '', 'bcc': '', 'attachments': []}
+UNSCANNED_SUMMARY_RESERVE = 4096 # Summary text bytes assumed for an email whose recipients/attachments are unknown
+
+class ChunkSizer:
+    """
+    Running exact size of an archive, as write_multipart will write it, while items are added.
+    exact_title=False sizes the headers and summary with a worst-case title; True uses the
+    chunk's real title (only the part numbers are bounded, by max_parts).
+    """
+    def __init__(self, year, party_display, sender, receipt_address, max_parts, exact_title=False, total_label=None):
+        self.year = year
+        self.party_display = party_display
+        self.sender = sender
+        self.receipt_address = receipt_address
+        self.max_parts = max_parts
+        self.exact_title = exact_title
+        self.total_label = total_label # Shown instead of the part count (incremental archives)
+        self._outer_sizes = {}
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.members_size = 0
+        self.summary_text = 0
+        self.stats = (0, 0, None, None) # Attachment count, attachment bytes, first and last date
+
+    def measure(self, item, meta, summary_reserve=0):
+        """(member bytes, summary text bytes, meta) of one item."""
+        member = attachment_part_size(member_name(item), member_subtype(item), member_size(item))
+        return member, _lines_size(summary_item_lines(meta)) + summary_reserve, meta
+
+    def _stats(self, meta):
+        att_count, att_size, first, last = self.stats
+        if meta['is_part']:
+            return self.stats
+        d = parse_row_date(meta)
+        if d:
+            first = min(first, d) if first else d
+            last = max(last, d) if last else d
+        return (att_count + len(meta['att_details']), att_size + sum(a['size'] for a in meta['att_details']), first, last)
+
+    def title(self, count, stats):
+        n = self.max_parts
+        total = self.total_label or n
+        if not self.exact_title:
+            # Every number at its widest
+            return archive_title(self.year, self.party_display, n, total, 99999, 99999, "9999.9M", "00000000", "00000000")
+        att_count, att_size, first, last = stats
+        fd_str = first.strftime("%Y%m%d") if first else "00000000"
+        ld_str = last.strftime("%Y%m%d") if last else "00000000"
+        return archive_title(self.year, self.party_display, n, total, count, att_count, format_size(att_size), fd_str, ld_str)
+
+    def _outer_size(self, title):
+        # multipart_size() of an archive with this title and one empty part (cached for the last title)
+        if title not in self._outer_sizes:
+            outer = archive_message(title, self.party_display, self.sender, self.receipt_address)
+            self._outer_sizes = {title: multipart_size(outer, 0, 1)}
+        return self._outer_sizes[title]
+
+    def size(self, extra=None):
+        """Archive size with the items added so far, plus `extra` (a measure() result) if given."""
+        count, members_size, summary_text, stats = self.count, self.members_size, self.summary_text, self.stats
+        if extra:
+            count += 1
+            members_size += extra[0]
+            summary_text += extra[1]
+            stats = self._stats(extra[2])
+        title = self.title(count, stats)
+        summary = summary_part_size(_lines_size(summary_header_lines(title)) + summary_text - 1)
+        # Members plus the summary part; each part after the first adds a boundary line and a newline
+        return self._outer_size(title) + members_size + summary + count * (BOUNDARY_LEN + 4)
+
+    def add(self, measured):
+        self.count += 1
+        self.members_size += measured[0]
+        self.summary_text += measured[1]
+        self.stats = self._stats(measured[2])
+
+def pack_chunks(process_queue, sizer, scan_missing=False):
+    """
+    Split a group's queue (in date order) into archives of at most MAX_SIZE_BYTES, measured exactly.
+    Greedy in date order: an archive is closed only when the next item would not fit, which is the
+    fewest archives possible without reordering. Emails never scanned are sized with a reserve for
+    their summary lines, or scanned first with scan_missing (their item['summary'] is filled in).
+    """
+    chunks = []
+    current = []
+    sizer.reset()
+    for item in process_queue:
+        if item['type'] != 'part' and item['summary'] is None:
+            if scan_missing:
+                item['summary'] = mime_summary(*scan_email(item['path']))
+                item['scanned'] = True
+            
+        if item['type'] != 'part' and item['summary'] is None:
+            measured = sizer.measure(item, item_metadata(item, UNSCANNED_SUMMARY), UNSCANNED_SUMMARY_RESERVE)
+        else:
+            measured = sizer.measure(item, item_metadata(item, item.get('summary')))
+            
+        if current and sizer.size(measured) > MAX_SIZE_BYTES:
+            chunks.append(current)
+            current = []
+            sizer.reset()
+        current.append(item)
+        sizer.add(measured)
+        
+    if current:
+        chunks.append(current)
+    return chunks
+
+def fits_whole(item, sizer):
+    """
+    True if an email over SPLIT_THRESHOLD still fits in an archive of its own when attached
+    whole (rfc822, decompressed), so it does not need splitting. Decided from the bytes that
+    will be written, not the raw size. An unscanned email is scanned for an exact summary.
+    """
+    if item['summary'] is None:
+        item['summary'] = mime_summary(*scan_email(item['path']))
+        item['scanned'] = True
+    sizer.reset()
+    return sizer.size(sizer.measure(item, item_metadata(item, item['summary']))) <= MAX_SIZE_BYTES
+
+def legacy_chunk_count(process_queue):
+    """Archives the old packing (1.4x raw size estimate) would have made, for the savings report."""
+    count = 0
+    current_size = None
+    for item in process_queue:
+        estimated = int(member_size(item) * 1.4)
+        if current_size is None or current_size + estimated > MAX_SIZE_BYTES:
+            count += 1
+            current_size = 0
+        current_size += estimated
+    return count
+
+def packing_report(count, legacy_count):
+    if count <= legacy_count:
+        return f"the old 1.4x size estimate would have made {legacy_count}, saved {legacy_count - count}"
+    # Small emails grow by more than 1.4x (base64 plus part headers), so the old packing overfilled archives
+    return f"the old 1.4x size estimate would have made {legacy_count}, some of them over the size limit"
+
+def build_archive(unit):
+    """
+    Build one archive file from a chunk of a sender group. No database access, so
+    with --jobs this runs in a worker process; the parent records the result in order.
+    unit: year, party_display, part_num, total_parts, items (rows as dicts, with their cached
+    mime summary or None), sender, receipt_address.
+    """
+    current_processing_year = unit['year']
+    party_display = unit['party_display']
+    chunk_msgs = unit['items']
+    fts_entries = []
+    new_summaries = [] # Scanned here, cached by the parent
+    
+    # Sort chunk by Date
+    chunk_msgs.sort(key=lambda item: parse_row_date(item['original_row']) or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
+    
+    metadata_list = []
+    for item in chunk_msgs:
+        row = item['original_row']
+        summary = None
+        if item['type'] != 'part':
+            # Recipients and attachments from the emails table, or one pass over the file
+            summary = item.get('summary')
+            if summary is None:
+                summary = mime_summary(*scan_email(item['path']))
+                new_summaries.append((row['id'], summary))
+                
+        meta = item_metadata(item, summary)
+        if summary is not None:
+            # Refresh the search entry (recipients incl. Bcc); the indexed body text is kept
+            fts_entries.append((row['id'], row['subject'], decode_mime_words(row['sender'] or ''),
+                                ', '.join(filter(None, [meta['to'], meta['cc'], meta['bcc']])),
+                                [a['name'] for a in meta['att_details']]))
+        metadata_list.append(meta)
+    
+    title_str = chunk_title(current_processing_year, party_display, unit['part_num'], unit['total_parts'], metadata_list)
+    filename = f"{clean_filename(title_str)}.eml"
+    outer = archive_message(title_str, party_display, unit['sender'], unit['receipt_address'])
+    
+    # Attachments are streamed from their files by write_multipart, never loaded whole
+    members = [(member_name(item), member_subtype(item), member_source(item)) for item in chunk_msgs]
+    
+    # Summary Body
+    summary_lines = summary_header_lines(title_str)
+    for m in metadata_list:
+        summary_lines.extend(summary_item_lines(m))
+    summary_part = MIMEText("\n".join(summary_lines), 'plain', 'utf-8')
+    
+    save_dir = os.path.join("data", "concentrated", str(current_processing_year)) # Subfolder by Year
+    os.makedirs(save_dir, exist_ok=True)
+    file_path = os.path.join(save_dir, filename)
+    
+    # Offsets of where each email/part landed in the file (the summary text is the last part)
+    offsets = write_multipart(file_path, outer, members, [summary_part])
+    
+    print(f"Created: {filename}")
+    return {
+        'party_display': party_display,
+        'year': current_processing_year,
+        'is_delta': unit.get('is_delta', 0),
+        'file_path': file_path,
+        'metadata': metadata_list,
+        'offsets': offsets,
+        'fts_entries': fts_entries,
+        'new_summaries': new_summaries,
+    }
+
+def record_archive(result):
+    """Parent side of build_archive: archive row, contents, marks and search entries in one transaction."""
+    # A whole email must never land in two archives (split parts legitimately span several)
+    twice = get_concentrated_ids([m['original_id'] for m in result['metadata'] if not m['is_part']])
+    if twice:
+        raise RuntimeError(f"{result['file_path']}: emails {sorted(twice)} are already in another archive")
+    with batch():
+        cid = save_concentrated_record(result['party_display'], result['file_path'], result['metadata'], result['offsets'],
+                                       uploaded=0, year=result['year'], is_delta=result['is_delta'])
+        ids = [m['original_id'] for m in result['metadata']]
+        mark_as_concentrated(ids, cid)
+        save_mime_summaries(result['new_summaries'])
+        for entry in result['fts_entries']:
+            index_email(*entry)
+    return cid
+
+def run_archive_units(units, jobs=1):
+    """
+    Build archives (in a process pool if jobs > 1) and record them in the order of `units`.
+    `units` may be a generator: it is consumed as archives finish, at most 2 * jobs ahead.
+    """
+    if jobs <= 1:
+        for unit in units:
+            record_archive(build_archive(unit))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        # Recorded in submission order, so archive ids and marks stay deterministic
+        pending = collections.deque()
+        for unit in units:
+            pending.append(pool.submit(build_archive, unit))
+            if len(pending) >= 2 * jobs:
+                record_archive(pending.popleft().result())
+        while pending:
+            record_archive(pending.popleft().result())
+
+def concentrate_emails(start_year_arg=None, end_year_arg=None, jobs=None, pack=None, incremental=False, merge_deltas=False):
+    """
+    Archive the unconcentrated emails, grouped per year and other party.
+    incremental: groups that already have archives in a year get new numbered archives of
+    their own (a single new email is not moved into misc_singles), and the last, partly
+    filled archive of each group is a delta. merge_deltas (implies incremental) first
+    puts the emails of deltas not uploaded yet back in the queue, so they are repacked
+    into full-size archives.
+    """
     config = load_config()
     sender_for_new_email = config.get('concerntrated_email_sender', 'Concentrator <auto@local>')
     receipt_address = config.get('concerntrated_email_receipt')
     me_address_str = config.get('username')
+    if jobs is None:
+        jobs = int(config.get('concentrate_jobs', 1))
+    if pack is None:
+        pack = config.get('concentrate_pack', 'exact').strip().lower()
+    split_method = config.get('split_method', 'builtin').strip().lower()
+    if merge_deltas:
+        incremental = True
+    
+    # Older databases: parse the dates/parties once so the queries below can use them
+    if backfill_pending('email_columns'):
+        from downloader import backfill_email_columns
+        backfill_email_columns()
     
+    if merge_deltas:
+        release_delta_archives(start_year_arg, end_year_arg)
+        
     # 1. Identify Years to Process
     print("Scanning database for available years...")
     available_years = get_unconcentrated_years()
@@ -362,328 +906,152 @@ def concentrate_emails(start_year_arg=None, end_year_arg=None):
         
     print(f"Target Years: {target_years}")
 
+    total_archives = 0
+    total_legacy = 0
+    
     # 2. Iterate Year by Year
     for current_processing_year in target_years:
         print(f"\n=== Processing Year: {current_processing_year} ===")
         
-        raw_emails = get_unconcentrated_emails_for_year(current_processing_year)
-        if not raw_emails:
+        # Group key of every new email (stored, so this is proportional to new mail)
+        assign_group_keys(current_processing_year, me_address_str)
+        groups = get_year_groups(current_processing_year)
+        if not groups:
             print(f"No emails found for year {current_processing_year} (Checked)")
             continue
             
-        print(f"Loaded {len(raw_emails)} emails for {current_processing_year}.")
-        
-        # Grouping for current year
-        groups = {} # Key: other_party_email
-        # We don't need nested year dict since we are processing one year
+        total_emails = sum(count for _, count in groups)
+        print(f"Found {total_emails} emails in {len(groups)} groups for {current_processing_year}.")
+        # Incremental: archives each group already has this year (numbering continues after them)
+        existing_archives = get_archive_group_counts(current_processing_year) if incremental else {}
         
-        total_emails = len(raw_emails)
-        for i, row in enumerate(raw_emails):
-            if i % 1000 == 0:
-                print(f"Scanning {i}/{total_emails}...")
-                
-            sender_str = row['sender']
-            real_name, email_addr = get_email_address_and_name(sender_str)
-            
-            # Identity Logic
-            other_party_email = email_addr
-            other_party_name = real_name
-            current_source_type = 0 # 0 = Received/From Header
-            
-            # Simple check if I am the sender
-            if me_address_str and me_address_str.lower() in email_addr.lower():
-                try:
-                    with open(row['local_path'], 'rb') as f:
-                        msg = email.message_from_bytes(f.read())
-                        to_header = decode_mime_words(msg.get('To', 'Unknown'))
-                        t_name, t_email = get_email_address_and_name(to_header)
-                        other_party_email = t_email
-                        other_party_name = t_name if t_name else t_email
-                        current_source_type = 1 # 1 = Sent/To Header
-                except Exception as e:
-                    # print(f"Error reading file {row['local_path']}: {e}")
-                    pass
-            
-            # --- Name Persistence Logic ---
-            process_identity(other_party_email, other_party_name, current_source_type)
-            cached_name, _, _ = get_cached_identity_full(other_party_email)
-            display_name = cached_name if cached_name else other_party_name
-            # -----------------------------
-            
-            group_key = other_party_email
-            if not group_key: group_key = "unknown"
-            
-            if group_key not in groups:
-                 groups[group_key] = {'name': display_name, 'emails': []}
-                 
-            # Update name if valid (trust cache more)
-            groups[group_key]['name'] = display_name
-            groups[group_key]['emails'].append(row)
-            
         # --- Aggregation Logic (Per Year) ---
-        misc_emails = []
-        keys_to_remove = []
+        # Single-email groups go into misc_singles (unless the group has archives already)
+        misc_count = sum(1 for key, count in groups if count <= 1 and key not in existing_archives)
+        # Read before the first archive of the year is recorded: with --jobs, a split group whose
+        # earlier archives are already marked would otherwise count its last email as a single
+        misc_rows = []
+        if misc_count:
+            misc_rows = [row for row in get_single_emails(current_processing_year) if row['group_key'] not in existing_archives]
         
-        for email_key, data in groups.items():
-            if len(data['emails']) <= 1:
-                misc_emails.extend(data['emails'])
-                keys_to_remove.append(email_key)
-                
-        for k in keys_to_remove:
-            del groups[k]
-            
-        if misc_emails:
-            groups['misc_singles'] = {'name': 'Miscellaneous Singles', 'emails': misc_emails}
-            print(f"Aggregated {len(misc_emails)} sparse emails into 'misc_singles'")
-            
-        # --- Process Groups for this Year ---
-        for email_key, data in groups.items():
-            
-            # Use the persisted best name
-            key_name = data['name']
-            if not key_name: key_name = email_key
-            
-            # Subject display: [Name <email>]
-            party_display = f"{key_name} <{email_key}>"
-            
-            msg_rows = data['emails']
-            
-            # Sort by date
-            # Sort by date
-            def parse_date_sort(row):
-                 try: 
-                     dt = email.utils.parsedate_to_datetime(row['date'])
-                     if dt.tzinfo is None:
-                         dt = dt.replace(tzinfo=datetime.timezone.utc)
-                     return dt
-                 except: 
-                     return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
-            msg_rows.sort(key=parse_date_sort)
-            
-            # Pre-calculate Chunks
-            process_queue = []
-            
-            for row in msg_rows:
-                fpath = row['local_path']
-                if not os.path.exists(fpath):
+        def year_groups():
+            # One group's rows in memory at a time, read by date from the index
+            for email_key, count in groups:
+                if count <= 1 and email_key not in existing_archives:
                     continue
-                size = os.path.getsize(fpath)
-                
-                if size > SPLIT_THRESHOLD:
-                    parts = split_email_with_zip(fpath)
-                    total_parts_count = len(parts)
-                    for i, p_path in enumerate(parts):
-                        process_queue.append({
-                            'type': 'part',
-                            'path': p_path,
-                            'original_row': row,
-                            'part_index': i + 1,
-                            'total_parts': total_parts_count
-                        })
-                else:
-                    process_queue.append({
-                        'type': 'email',
-                        'path': fpath,
-                        'original_row': row
-                    })
-
-            chunks = []
-            current_chunk = []
-            current_encoded_size = 0
-            
-            for item in process_queue:
-                fpath = item['path']
-                size = os.path.getsize(fpath)
-                estimated_encoded_size = int(size * 1.4)
+                yield email_key, get_group_emails(current_processing_year, email_key)
+            if misc_count:
+                print(f"Aggregated {misc_count} sparse emails into 'misc_singles'")
+                yield 'misc_singles', misc_rows
+        
+        counts = collections.Counter()
+        
+        def year_units():
+            # --- Process Groups for this Year (archives built while the next groups are read) ---
+            scanned_count = 0
+            for email_key, msg_rows in year_groups():
+                # --- Name Persistence Logic ---
+                display_name = None
+                for row in msg_rows:
+                    if scanned_count % 1000 == 0:
+                        print(f"Scanning {scanned_count}/{total_emails}...")
+                    scanned_count += 1
+                    other_party_email, other_party_name, current_source_type = email_party(row, me_address_str)
+                    process_identity(other_party_email, other_party_name, current_source_type)
+                    cached_name, _, _ = get_cached_identity_full(other_party_email)
+                    display_name = cached_name if cached_name else other_party_name
+                # -----------------------------
                 
-                if current_encoded_size + estimated_encoded_size > MAX_SIZE_BYTES and current_chunk:
-                    chunks.append(current_chunk)
-                    current_chunk = []
-                    current_encoded_size = 0
+                # Use the persisted best name
+                key_name = 'Miscellaneous Singles' if email_key == 'misc_singles' else display_name
+                if not key_name: key_name = email_key
                 
-                current_chunk.append(item)
-                current_encoded_size += estimated_encoded_size
+                # Subject display: [Name <email>]
+                party_display = f"{key_name} <{email_key}>"
                 
-            if current_chunk:
-                chunks.append(current_chunk)
+                # Pre-calculate Chunks
+                process_queue = []
+                # Sizes one email alone in an archive, worst-case title
+                fit_sizer = ChunkSizer(current_processing_year, party_display, sender_for_new_email, receipt_address,
+                                       99999, total_label='delta' if incremental else None)
             
-            total_parts = len(chunks)
-            # print(f"Processing {email_key}: {len(msg_rows)} items -> {total_parts} chunks.")
-            
-            for idx, chunk_msgs in enumerate(chunks):
-                part_num = idx + 1
-                
-                # Sort chunk by Date
-                def parse_date_item(item):
-                    row = item['original_row']
-                    try:
-                        dt = email.utils.parsedate_to_datetime(row['date'])
-                        if dt.tzinfo is None: dt = dt.replace(tzinfo=datetime.timezone.utc)
-                        return dt
-                    except:
-                        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
-                
-                chunk_msgs.sort(key=parse_date_item)
-
-                # Metrics Calculation
-                chunk_att_count = 0
-                chunk_att_size = 0
-                first_date = None
-                last_date = None
-                
-                metadata_list = []
-                
-                # Collect Data
-                for item in chunk_msgs:
-                    path = item['path']
-                    row = item['original_row']
-                    original_filename = os.path.basename(path)
-                    
-                    is_part = (item['type'] == 'part')
-                    
-                    if is_part:
-                        subject = f"[Part {item['part_index']}/{item['total_parts']}] {row['subject']}"
-                        att_details = [{'name': os.path.basename(path), 'size': os.path.getsize(path)}]
-                        
-                        try:
-                            # Try to get header from original file just for TO field consistency
-                            # But if file is huge, maybe skip?
-                            # 33MB is big. Let's try raw read only head?
-                            # Optim: Just use Unknown for parts, or read row data if we had it.
-                            # We can trust row['sender']? But we want 'To'.
-                            to_h = "Unknown" 
-                            cc_h = ""
-                        except:
-                            to_h = "Unknown"
-                            cc_h = ""
-                        
-                        meta = {
-                            'original_id': row['id'],
-                            'subject': subject,
-                            'date': row['date'],
-                            'date_iso': row['date'], 
-                            'message_id': row['message_id'],
-                            'to': to_h,
-                            'cc': cc_h,
-                            'att_details': att_details,
-                            'filename': original_filename,
-                            'is_part': True
-                        }
-                    else:
-                        # Normal Email
-                        with open(path, 'rb') as f:
-                            raw_bytes = f.read()
-                        
-                        msg = email.message_from_bytes(raw_bytes)
-                        att_count, att_size, att_details = parse_attachments_metrics(msg)
-                        
-                        chunk_att_count += att_count
-                        chunk_att_size += att_size
-                        
-                        # Date for Range
-                        try:
-                            d = email.utils.parsedate_to_datetime(row['date'])
-                            if d.tzinfo is None: d = d.replace(tzinfo=datetime.timezone.utc)
-                            if not first_date or d < first_date: first_date = d
-                            if not last_date or d > last_date: last_date = d
-                            date_str_iso = d.strftime('%Y-%m-%d %H:%M:%S')
-                        except:
-                            date_str_iso = row['date']
-                        
-                        meta = {
-                            'original_id': row['id'],
-                            'subject': row['subject'],
-                            'date': row['date'],
-                            'date_iso': date_str_iso,
-                            'message_id': row['message_id'],
-                            'to': decode_mime_words(msg.get('To', '')),
-                            'cc': decode_mime_words(msg.get('Cc', '')),
-                            'bcc': decode_mime_words(msg.get('Bcc', '')),
-                            'att_details': att_details,
-                            'filename': original_filename,
-                            'is_part': False
-                        }
-                    metadata_list.append(meta)
-                
-                # Format Dates for Title: YYYYMMDD
-                fd_str = first_date.strftime("%Y%m%d") if first_date else "00000000"
-                ld_str = last_date.strftime("%Y%m%d") if last_date else "00000000"
-                
-                size_str = format_size(chunk_att_size)
-                
-                # Use current_processing_year for title
-                title_str = f"{current_processing_year}_[{party_display}]_{part_num}/{total_parts}_{len(chunk_msgs)}-Emails_{chunk_att_count}-Files-{size_str.replace(' ', '')}_{fd_str}_{ld_str}"
-                
-                filename_base = clean_filename(title_str)
-                filename = f"{filename_base}.eml"
-                
-                # Build MIME
-                outer = MIMEMultipart()
-                outer['Subject'] = title_str
-                outer['From'] = sender_for_new_email
-                if receipt_address:
-                    if '<' in receipt_address: outer['To'] = receipt_address
-                    else:
-                        p_name, _ = get_email_address_and_name(party_display)
-                        if not p_name: p_name = "Concentration"
-                        outer['To'] = f"{p_name} <{receipt_address}>"
-                else:
-                    outer['To'] = party_display 
-                    
-                outer['Date'] = email.utils.formatdate(localtime=True)
-                
-                for item in chunk_msgs:
-                    path = item['path']
-                    with open(path, 'rb') as f: content = f.read()
-                    
-                    if item['type'] == 'part':
-                        part = MIMEApplication(content, _subtype="zip")
-                    else:
-                        part = MIMEApplication(content, _subtype="rfc822")
-                        
-                    part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(path))
-                    outer.attach(part)
-                
-                # Summary Body
-                summary_lines = []
-                summary_lines.append(f"Concentrated Email Archive")
-                summary_lines.append(f"Title: {title_str}")
-                summary_lines.append("=" * 60)
-                summary_lines.append("")
+                for row in msg_rows:
+                    fpath = row['local_path']
+                    size = raw_size(fpath)
+                    if size is None:
+                        continue
+                    item = {
+                        'type': 'email',
+                        'path': fpath,
+                        'original_row': row,
+                        'summary': load_mime_summary(row)
+                    }
                 
-                for m in metadata_list:
-                    summary_lines.append(f"Subject: {m['subject']}")
-                    summary_lines.append(f"Date:    {m['date']}")
-                    summary_lines.append(f"File:    {m['filename']}") 
-                    summary_lines.append(f"To:      {m['to']}")
-                    if m['cc']: summary_lines.append(f"Cc:      {m['cc']}")
-                    
-                    if m['att_details']:
-                        summary_lines.append("  Attachments:")
-                        for att in m['att_details']:
-                            summary_lines.append(f"  - {att['name']} ({format_size(att['size'])})")
+                    if size <= SPLIT_THRESHOLD or fits_whole(item, fit_sizer):
+                        process_queue.append(item)
+                    elif split_method != '7z':
+                        # Pieces are read from the raw file by the archive builders (in parallel with --jobs)
+                        process_queue.extend(split_email_parts(row))
                     else:
-                        summary_lines.append("  (No Attachments)")
-                        
-                    summary_lines.append("-" * 40)
-                    summary_lines.append("")
-                
-                outer.attach(MIMEText("\n".join(summary_lines), 'plain', 'utf-8'))
-                
-                save_dir = os.path.join("data", "concentrated", str(current_processing_year)) # Subfolder by Year
-                os.makedirs(save_dir, exist_ok=True)
-                file_path = os.path.join(save_dir, filename)
-                
-                with open(file_path, 'wb') as f:
-                    f.write(outer.as_bytes())
-                
-                print(f"Created: {filename}")
-                
-                cid = save_concentrated_record(party_display, file_path, metadata_list, uploaded=0)
-                ids = [m['original_id'] for m in metadata_list]
-                mark_as_concentrated(ids, cid)
-                # print(f"Saved local archive {filename} (ID: {cid}).")
+                        parts = split_email_with_zip(fpath)
+                        total_parts_count = len(parts)
+                        for i, p_path in enumerate(parts):
+                            process_queue.append({
+                                'type': 'part',
+                                'path': p_path,
+                                'original_row': row,
+                                'part_index': i + 1,
+                                'total_parts': total_parts_count
+                            })
+
+                # Chunks sized exactly as they will be written (--pack tight: real titles, scans unknown emails first)
+                archives_before = existing_archives.get(email_key, 0)
+                sizer = ChunkSizer(current_processing_year, party_display, sender_for_new_email, receipt_address,
+                                   archives_before + len(process_queue), exact_title=(pack == 'tight'),
+                                   total_label='delta' if incremental else None)
+                chunks = pack_chunks(process_queue, sizer, scan_missing=(pack == 'tight'))
+                save_mime_summaries([(item['original_row']['id'], item['summary']) for item in process_queue if item.pop('scanned', False)])
+                counts['legacy'] += legacy_chunk_count(process_queue)
+            
+                total_parts = len(chunks)
+                # print(f"Processing {email_key}: {len(msg_rows)} items -> {total_parts} chunks.")
             
+                for idx, chunk_msgs in enumerate(chunks):
+                    # Incremental archives continue the group's numbering; the total is open ('+'), and the
+                    # last one is the delta (only filled up to the new mail, merged later with --merge-deltas)
+                    is_delta = incremental and idx == total_parts - 1
+                    if incremental:
+                        total_label = 'delta' if is_delta else '+'
+                    counts['archives'] += 1
+                    counts['deltas'] += int(is_delta)
+                    yield {
+                        'year': current_processing_year,
+                        'party_display': party_display,
+                        'part_num': archives_before + idx + 1,
+                        'total_parts': total_label if incremental else total_parts,
+                        'is_delta': int(is_delta),
+                        # sqlite3.Row can't be sent to a worker process
+                        'items': [dict(item, original_row=dict(item['original_row'])) for item in chunk_msgs],
+                        'sender': sender_for_new_email,
+                        'receipt_address': receipt_address,
+                    }
+                    
+        run_archive_units(year_units(), jobs)
+        # Identity changes are written behind; persist this year's with its archives
+        flush_identities()
+        
+        if counts['archives']:
+            print(f"Packing: {counts['archives']} archives for {current_processing_year} "
+                  f"({packing_report(counts['archives'], counts['legacy'])})")
+            if incremental:
+                print(f"Incremental: {counts['deltas']} of them are deltas")
+        total_archives += counts['archives']
+        total_legacy += counts['legacy']
+        
+    if total_archives:
+        print(f"\nCreated {total_archives} archives ({packing_report(total_archives, total_legacy)}).")
+    report = decision_report()
+    if report: print(report)
 
 
 def upload_pending_concentrated_emails():
@@ -1,21 +1,137 @@
 import sqlite3
 import os
+import re
+import json
+import atexit
+import hashlib
+import threading
+import contextlib
 
 DB_FILE = 'data/emails.db'
 
+# One connection per thread, tuned for a local archive: WAL lets the web UI read
+# while a download/concentration run writes, synchronous=NORMAL is still crash-safe in WAL.
+BUSY_TIMEOUT_MS = 30000
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+_local = threading.local()
+
+# In-Memory Message-ID Index
+# Loaded once per process (one query), then kept current by save_email_metadata().
+# Keys are 16-byte BLAKE2b digests of the Message-ID: ~3x smaller than the strings
+# and still collision-free in practice, which matters because --remove trusts it.
+_MESSAGE_ID_INDEX = None
+
+# Parsed from the headers at download time so queries never parse dates in Python
+TYPED_COLUMNS = [
+    ('date_epoch', 'INTEGER'), # UTC seconds
+    ('year', 'INTEGER'), # Year/month as written in the Date header (its own timezone)
+    ('month', 'INTEGER'),
+    ('other_party', 'TEXT'), # Lowercase email of the sender (received) or recipient (sent)
+    ('direction', 'TEXT'), # 'sent' or 'received'
+    ('size_bytes', 'INTEGER'), # Uncompressed message size
+    ('attachment_count', 'INTEGER'),
+]
+
+# Recipients and attachments from one pass over the raw file, so the concentrator never parses it again
+MIME_COLUMNS = [
+    ('to_addrs', 'TEXT'), # Decoded To/Cc/Bcc headers
+    ('cc_addrs', 'TEXT'),
+    ('bcc_addrs', 'TEXT'),
+    ('attachments', 'TEXT'), # JSON [{name, size}]; NULL = not scanned yet
+]
+
+class SharedConnection(sqlite3.Connection):
+    """
+    The calling thread's connection. close() is a no-op so callers can keep the usual
+    get_db_connection() / commit() / close() pattern, and commit() is deferred while
+    a batch() is open.
+    """
+    batch_depth = 0
+    
+    def commit(self):
+        if self.batch_depth > 0:
+            return
+        super().commit()
+        
+    def close(self):
+        pass
+        
+    def really_close(self):
+        self.batch_depth = 0
+        super().commit()
+        super().close()
+
 def get_db_connection():
+    conn = getattr(_local, 'conn', None)
+    # Reopen if the DB file was removed (clean) underneath us
+    if conn is not None and os.path.exists(DB_FILE):
+        return conn
+    if conn is not None:
+        close_db_connection()
+        
     if not os.path.exists('data'):
         os.makedirs('data')
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_MS / 1000, factory=SharedConnection)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    _local.conn = conn
     return conn
 
-def init_db():
+def close_db_connection():
+    """Really close this thread's connection (before deleting data/, at exit)."""
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.really_close()
+        except sqlite3.Error:
+            pass
+
+atexit.register(close_db_connection)
+
+@contextlib.contextmanager
+def batch():
+    """
+    Group every write of this thread into one transaction, committed when the
+    outermost batch exits. It is committed on errors too: each statement is complete
+    on its own, and rows must not be lost for files that were already moved into place.
+    """
     conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 1. Create Tables (Latest Schema)
-    
+    conn.batch_depth += 1
+    try:
+        yield conn
+    finally:
+        conn.batch_depth -= 1
+        if conn.batch_depth == 0:
+            conn.commit()
+
+# --- Schema Migrations ---
+# Applied in order, once per database: PRAGMA user_version is the last applied version.
+# Databases created before versioning start at 0, so every step must also work on a
+# schema that already has some of its tables/columns (CREATE IF NOT EXISTS, _add_column).
+# Long data migrations are not done here: a step registers a backfill, which runs in
+# resumable chunks (see run_backfill and `python main.py backfill`).
+
+def _has_column(c, table, col):
+    c.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in c.fetchall())
+
+def _add_column(c, table, col, col_type):
+    if not _has_column(c, table, col):
+        print(f"Migrating: Adding {col} column to {table} table...")
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
+
+def _register_backfill(c, name, table='emails'):
+    # Nothing to backfill in a new (empty) database
+    c.execute(f"INSERT OR IGNORE INTO migration_backfills (name, done) VALUES (?, NOT EXISTS (SELECT 1 FROM {table}))", (name,))
+
+def _migrate_1_base(c):
     # Table to store original downloaded emails
     c.execute('''
         CREATE TABLE IF NOT EXISTS emails (
@@ -29,7 +145,7 @@ def init_db():
             concentrated_id INTEGER
         )
     ''')
-    
+
     # Table to store concentrated emails
     c.execute('''
         CREATE TABLE IF NOT EXISTS concentrated_emails (
@@ -38,9 +154,10 @@ def init_db():
             file_path TEXT,
             remote_uid TEXT,
             content_metadata TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            uploaded BOOLEAN DEFAULT 0
         )
-    ''')    
+    ''')
 
     # Table to cache persistent identities (names) for email addresses
     c.execute('''
@@ -52,58 +169,344 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+
+    # Columns added over time (old databases)
+    _add_column(c, 'emails', 'concentrated_id', 'INTEGER')
+    _add_column(c, 'email_identities', 'seen_names', 'TEXT')
+    _add_column(c, 'email_identities', 'name_source', 'INTEGER DEFAULT 0')
+    _add_column(c, 'concentrated_emails', 'uploaded', 'BOOLEAN DEFAULT 0')
+
+    # Progress of chunked data migrations
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS migration_backfills (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER DEFAULT 0,
+            done BOOLEAN DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migrate_2_sync_state(c):
+    # Per-folder IMAP sync checkpoints (valid only while UIDVALIDITY is unchanged)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            folder TEXT PRIMARY KEY,
+            uidvalidity INTEGER,
+            last_uid INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Months whose date-window pass completed without errors, per folder
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS synced_months (
+            folder TEXT,
+            uidvalidity INTEGER,
+            month TEXT,
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (folder, month)
+        )
+    ''')
+
+def _migrate_3_transfer_ledger(c):
+    # Bytes transferred per CST day (163.com's daily IMAP quota)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS transfer_ledger (
+            day TEXT,
+            direction TEXT,
+            bytes INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (day, direction)
+        )
+    ''')
+
+def _migrate_4_sha256(c):
+    _add_column(c, 'emails', 'sha256', 'TEXT')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_sha256 ON emails(sha256)")
+    _register_backfill(c, 'sha256')
+
+def _migrate_5_typed_columns(c):
+    # Typed columns parsed once at download time
+    for col, col_type in TYPED_COLUMNS:
+        _add_column(c, 'emails', col, col_type)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_date_epoch ON emails(date_epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_year_month ON emails(year, month)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_concentrated_year ON emails(is_concentrated, year)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_party_date ON emails(other_party, date_epoch)")
+    _register_backfill(c, 'email_columns')
+
+def _migrate_6_fts(c):
+    # Full-text search (rowid = emails.id), filled by fts.index_email
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender, recipients, attachments, body, tokenize='unicode61 remove_diacritics 2')")
+    _register_backfill(c, 'emails_fts')
+
+def _migrate_7_concentrated_items(c):
+    # One row per email (or split part) inside a concentrated archive; replaces the
+    # content_metadata JSON of concentrated_emails (moved over by the 'concentrated_items' backfill).
+    # byte_offset/size locate the MIME part in the archive file (storage.read_archive_part).
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS concentrated_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            concentrated_id INTEGER NOT NULL,
+            email_id INTEGER,
+            part_index INTEGER DEFAULT 0,
+            total_parts INTEGER DEFAULT 1,
+            filename TEXT,
+            byte_offset INTEGER,
+            size INTEGER,
+            attachments TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_items_archive ON concentrated_items(concentrated_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_items_email ON concentrated_items(email_id)")
+    _register_backfill(c, 'concentrated_items', 'concentrated_emails')
+
+def _migrate_8_mime_columns(c):
+    # Filled at download time, and lazily by the concentrator for older emails
+    for col, col_type in MIME_COLUMNS:
+        _add_column(c, 'emails', col, col_type)
+
+ARCHIVE_GROUP_RE = re.compile(r'<([^<>]*)>\s*$')
+
+def archive_group_key(party_display):
+    """Group key (other party address, or misc_singles) of an archive's 'Name <key>' sender."""
+    found = ARCHIVE_GROUP_RE.search(party_display or '')
+    return found.group(1) if found else (party_display or 'unknown')
+
+def _migrate_9_archive_groups(c):
+    # Which year/group an archive belongs to, and whether it is a delta (the partly filled
+    # last archive of an incremental run, which a later --merge-deltas run may rebuild)
+    _add_column(c, 'concentrated_emails', 'year', 'INTEGER')
+    _add_column(c, 'concentrated_emails', 'group_key', 'TEXT')
+    _add_column(c, 'concentrated_emails', 'is_delta', 'BOOLEAN DEFAULT 0')
+    # One row per archive file, so existing archives are filled in right here
+    c.execute("SELECT id, sender, file_path FROM concentrated_emails WHERE group_key IS NULL")
+    rows = []
+    for archive_id, sender, file_path in c.fetchall():
+        # Archives are saved as data/concentrated/<year>/<title>.eml
+        year = os.path.basename(os.path.dirname(file_path or ''))
+        rows.append((int(year) if year.isdigit() else None, archive_group_key(sender), archive_id))
+    c.executemany("UPDATE concentrated_emails SET year = ?, group_key = ? WHERE id = ?", rows)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_concentrated_group ON concentrated_emails(year, group_key)")
+
+def _migrate_10_name_decisions(c):
+    # LLM name tie-breaks, keyed on the normalized (sorted) name pair, and the ties
+    # deferred to `main.py resolve-identities` (identity_llm: defer)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS name_decisions (
+            name_a TEXT,
+            name_b TEXT,
+            winner TEXT,
+            decided_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name_a, name_b)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS identity_ties (
+            email TEXT,
+            current_name TEXT,
+            candidate_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (email, candidate_name)
+        )
+    ''')
+
+def _migrate_11_name_decision_counts(c):
+    # Running totals of how name ties were settled (rule/cache/llm/deferred/fallback), shown by `stats`
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS name_decision_counts (
+            method TEXT PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        )
+    ''')
+
+def _migrate_12_email_group_key(c):
+    # The concentrator's group (other party address) of an email, set on its first concentration.
+    # Ordered by date within (is_concentrated, year, group), so a year's groups are read one at a time.
+    _add_column(c, 'emails', 'group_key', 'TEXT')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_concentrate_group ON emails(is_concentrated, year, group_key, date_epoch)")
+
+MIGRATIONS = [
+    (1, _migrate_1_base),
+    (2, _migrate_2_sync_state),
+    (3, _migrate_3_transfer_ledger),
+    (4, _migrate_4_sha256),
+    (5, _migrate_5_typed_columns),
+    (6, _migrate_6_fts),
+    (7, _migrate_7_concentrated_items),
+    (8, _migrate_8_mime_columns),
+    (9, _migrate_9_archive_groups),
+    (10, _migrate_10_name_decisions),
+    (11, _migrate_11_name_decision_counts),
+    (12, _migrate_12_email_group_key),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn=None):
+    conn = conn or get_db_connection()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    """Apply pending migrations. On an up-to-date database this is one PRAGMA read."""
+    conn = get_db_connection()
+    version = get_schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        return
+
+    conn.commit()
+    c = conn.cursor()
+    for target, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        print(f"Migrating database to version {target} ({migrate.__name__[len('_migrate_'):]})...")
+        # One transaction per step (SQLite DDL is transactional), so a crash never leaves half a step
+        c.execute("BEGIN")
+        try:
+            migrate(c)
+            c.execute(f"PRAGMA user_version = {target}")
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+
+    pending = pending_backfills()
+    if pending:
+        print(f"Pending data backfills: {', '.join(pending)}. Run 'python main.py backfill' (resumable).")
+    print(f"Database initialized at {DB_FILE} (schema version {SCHEMA_VERSION})")
+
+# --- Resumable Backfills ---
+
+def pending_backfills():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT name FROM migration_backfills WHERE done = 0 ORDER BY rowid")
+    return [r[0] for r in c.fetchall()]
+
+def backfill_pending(name):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM migration_backfills WHERE name = ? AND done = 0", (name,))
+    return c.fetchone() is not None
+
+def run_backfill(name, select_sql, process_rows, chunk_size=1000):
+    """
+    Run a registered backfill in chunks of rows ordered by id.
+    select_sql must take (last_id, limit) parameters, e.g.
+        "SELECT id, ... FROM emails WHERE id > ? AND x IS NULL ORDER BY id LIMIT ?".
+    process_rows(rows) writes through get_db_connection(). Each chunk and its progress
+    (last id) are one transaction, so an interrupted backfill resumes after the last chunk.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("INSERT OR IGNORE INTO migration_backfills (name) VALUES (?)", (name,))
+    c.execute("SELECT last_id, done FROM migration_backfills WHERE name = ?", (name,))
+    last_id, done = c.fetchone()
+    conn.commit()
+    if done:
+        return 0
+    if last_id:
+        print(f"Resuming backfill '{name}' after id {last_id}...")
+
+    processed = 0
+    while True:
+        c.execute(select_sql, (last_id, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        with batch():
+            process_rows(rows)
+            last_id = rows[-1]['id']
+            c.execute("UPDATE migration_backfills SET last_id = ?, updated_at = CURRENT_TIMESTAMP WHERE name = ?", (last_id, name))
+        processed += len(rows)
+        print(f"  {name}: {processed} rows (up to id {last_id})...")
+
+    c.execute("UPDATE migration_backfills SET done = 1, updated_at = CURRENT_TIMESTAMP WHERE name = ?", (name,))
+    conn.commit()
+    return processed
+
+def _message_id_key(message_id):
+    return hashlib.blake2b(str(message_id).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def load_message_id_index(force=False):
+    """Load every known Message-ID into memory (once per process unless force=True)."""
+    global _MESSAGE_ID_INDEX
     
-    # 2. Migrations (For existing databases with old schemas)
-    try:
-        c.execute("SELECT concentrated_id FROM emails LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Migrating: Adding concentrated_id column to emails table...")
-        c.execute("ALTER TABLE emails ADD COLUMN concentrated_id INTEGER")
+    if _MESSAGE_ID_INDEX is not None and not force:
+        return _MESSAGE_ID_INDEX
         
+    index = set()
+    conn = get_db_connection()
     try:
-        c.execute("SELECT seen_names FROM email_identities LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Migrating: Adding seen_names column to email_identities table...")
-        c.execute("ALTER TABLE email_identities ADD COLUMN seen_names TEXT")
+        c = conn.cursor()
+        c.execute("SELECT message_id FROM emails WHERE message_id IS NOT NULL")
+        while True:
+            rows = c.fetchmany(10000)
+            if not rows:
+                break
+            index.update(_message_id_key(r[0]) for r in rows)
+    finally:
+        conn.close()
         
-    try:
-        c.execute("SELECT name_source FROM email_identities LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Migrating: Adding name_source column to email_identities table...")
-        c.execute("ALTER TABLE email_identities ADD COLUMN name_source INTEGER DEFAULT 0")
-
-    try:
-        c.execute("SELECT uploaded FROM concentrated_emails LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Migrating: Adding uploaded column to concentrated_emails table...")
-        c.execute("ALTER TABLE concentrated_emails ADD COLUMN uploaded BOOLEAN DEFAULT 0")
-    
-    conn.commit()
-    conn.close()
-    print(f"Database initialized at {DB_FILE}")
+    _MESSAGE_ID_INDEX = index
+    return index
 
 def email_exists(message_id):
+    """Check the in-memory index. No DB connection after the first call."""
+    return _message_id_key(message_id) in load_message_id_index()
+
+def save_email_metadata(message_id, subject, sender, date_str, local_path, sha256=None, columns=None):
+    """columns: optional dict of TYPED_COLUMNS values. Returns the new email id."""
+    values = {
+        'message_id': message_id,
+        'sender': sender,
+        'subject': subject,
+        'date': date_str,
+        'local_path': local_path,
+        'sha256': sha256,
+    }
+    for col, _ in TYPED_COLUMNS:
+        values[col] = (columns or {}).get(col)
+        
     conn = get_db_connection()
     try:
         c = conn.cursor()
-        c.execute("SELECT id FROM emails WHERE message_id = ?", (message_id,))
-        exists = c.fetchone() is not None
-        return exists
+        c.execute(f"INSERT INTO emails ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})", list(values.values()))
+        email_id = c.lastrowid
+        conn.commit()
     finally:
         conn.close()
+        
+    if _MESSAGE_ID_INDEX is not None:
+        _MESSAGE_ID_INDEX.add(_message_id_key(message_id))
+    return email_id
 
-def save_email_metadata(message_id, subject, sender, date_str, local_path):
+def update_email_columns(rows):
+    """rows: list of (email_id, columns dict). One transaction."""
     conn = get_db_connection()
     try:
         c = conn.cursor()
-        c.execute('''
-            INSERT INTO emails (message_id, sender, subject, date, local_path)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (message_id, sender, subject, date_str, local_path))
+        cols = [col for col, _ in TYPED_COLUMNS]
+        sql = f"UPDATE emails SET {', '.join(f'{col} = ?' for col in cols)} WHERE id = ?"
+        c.executemany(sql, [[columns.get(col) for col in cols] + [email_id] for email_id, columns in rows])
         conn.commit()
     finally:
         conn.close()
 
+def save_mime_summaries(rows):
+    """rows: list of (email_id, summary) with summary = {to, cc, bcc, attachments}."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.executemany("UPDATE emails SET to_addrs = ?, cc_addrs = ?, bcc_addrs = ?, attachments = ? WHERE id = ?",
+                  [(m['to'], m['cc'], m['bcc'], json.dumps(m['attachments'], ensure_ascii=False), email_id) for email_id, m in rows])
+    conn.commit()
+
+def load_mime_summary(row):
+    """Cached summary of an emails row (None if it was never scanned)."""
+    if row['attachments'] is None:
+        return None
+    return {'to': row['to_addrs'] or '', 'cc': row['cc_addrs'] or '', 'bcc': row['bcc_addrs'] or '',
+            'attachments': json.loads(row['attachments'])}
+
 def get_latest_email_date():
     """Get the date of the most recent email in the DB."""
     conn = get_db_connection()
@@ -130,5 +533,128 @@ def get_latest_email_date():
     finally:
         conn.close()
 
+def get_sync_state(folder):
+    """Return (uidvalidity, last_uid) for a folder, or (None, 0) if it was never synced."""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT uidvalidity, last_uid FROM sync_state WHERE folder = ?", (folder,))
+        row = c.fetchone()
+        if row:
+            return row['uidvalidity'], row['last_uid'] or 0
+        return None, 0
+    finally:
+        conn.close()
+
+def reset_sync_state(folder, uidvalidity):
+    """Drop all checkpoints of a folder (UIDVALIDITY changed, so old UIDs mean nothing)."""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM synced_months WHERE folder = ?", (folder,))
+        c.execute('''
+            INSERT INTO sync_state (folder, uidvalidity, last_uid) VALUES (?, ?, 0)
+            ON CONFLICT(folder) DO UPDATE SET
+                uidvalidity=excluded.uidvalidity,
+                last_uid=0,
+                updated_at=CURRENT_TIMESTAMP
+        ''', (folder, uidvalidity))
+        conn.commit()
+    finally:
+        conn.close()
+
+def update_sync_state(folder, uidvalidity, last_uid):
+    """Advance the highest fully handled UID of a folder (never moves backwards)."""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO sync_state (folder, uidvalidity, last_uid) VALUES (?, ?, ?)
+            ON CONFLICT(folder) DO UPDATE SET
+                last_uid=MAX(last_uid, excluded.last_uid),
+                updated_at=CURRENT_TIMESTAMP
+            WHERE uidvalidity = excluded.uidvalidity
+        ''', (folder, uidvalidity, last_uid))
+        conn.commit()
+    finally:
+        conn.close()
+
+def mark_month_synced(folder, uidvalidity, month):
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR REPLACE INTO synced_months (folder, uidvalidity, month)
+            VALUES (?, ?, ?)
+        ''', (folder, uidvalidity, month))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_fully_synced_months():
+    """Months ('YYYY-MM') that are synced in every folder we have a checkpoint for."""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT m.month
+            FROM synced_months m
+            JOIN sync_state s ON s.folder = m.folder AND s.uidvalidity = m.uidvalidity
+            GROUP BY m.month
+            HAVING COUNT(*) = (SELECT COUNT(*) FROM sync_state)
+        ''')
+        return set(r[0] for r in c.fetchall())
+    finally:
+        conn.close()
+
+# --- Concentrated Archive Contents ---
+
+def save_concentrated_items(concentrated_id, items):
+    """
+    items: dicts with email_id, part_index (0 = whole email, 1..n = split part), total_parts,
+    filename, byte_offset, size and attachments (list of {name, size}).
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.executemany('''
+        INSERT INTO concentrated_items (concentrated_id, email_id, part_index, total_parts, filename, byte_offset, size, attachments)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(concentrated_id, i['email_id'], i.get('part_index', 0), i.get('total_parts', 1), i.get('filename'),
+           i.get('byte_offset'), i.get('size'), json.dumps(i.get('attachments') or [], ensure_ascii=False)) for i in items])
+    conn.commit()
+
+def get_archive_group_counts(year):
+    """Archives already made for a year, per group key."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT group_key, COUNT(*) FROM concentrated_emails WHERE year = ? GROUP BY group_key", (year,))
+    return {r[0]: r[1] for r in c.fetchall()}
+
+def get_archive_items(concentrated_id):
+    """What's inside an archive, in archive order (joined with the emails they came from)."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT i.*, e.subject, e.date, e.message_id
+        FROM concentrated_items i
+        LEFT JOIN emails e ON e.id = i.email_id
+        WHERE i.concentrated_id = ?
+        ORDER BY i.id
+    ''', (concentrated_id,))
+    return c.fetchall()
+
+def find_email_archives(email_id):
+    """Which archive(s) hold an email: one row per stored part (split emails can span archives)."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT i.*, ce.file_path, ce.uploaded
+        FROM concentrated_items i
+        JOIN concentrated_emails ce ON ce.id = i.concentrated_id
+        WHERE i.email_id = ?
+        ORDER BY i.part_index
+    ''', (email_id,))
+    return c.fetchall()
+
 if __name__ == "__main__":
     init_db()
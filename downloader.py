@@ -6,10 +6,21 @@ import datetime
 import calendar
 import re
 import time # Added for time.time()
+import hashlib
+import queue
+import threading
 from config import load_config
 from config import load_config
-from db import save_email_metadata, email_exists, get_db_connection, get_latest_email_date
-from identity import process_identity, get_email_address_and_name, decode_mime_words
+from db import save_email_metadata, email_exists, get_db_connection, get_latest_email_date, load_message_id_index
+from db import get_sync_state, reset_sync_state, update_sync_state, mark_month_synced, update_email_columns, save_mime_summaries
+from db import batch as db_batch, run_backfill, pending_backfills
+from identity import process_identity, get_email_address_and_name, decode_mime_words, decision_report
+from quota import TransferBudget, QuotaExceeded, is_quota_error
+from storage import new_temp_path, write_temp, discard_temp, clean_incoming, commit_temp, read_headers
+from storage import unique_path, hash_file, commit_temp_cas, compression_method, compress_temp, RAW_SUFFIXES
+from storage import open_raw, raw_size, read_header_block, count_attachments, scan_attachments, scan_email, read_body_text
+from fts import index_email
+from email.parser import BytesHeaderParser
 
 def clean_filename(s):
     """Sanitize string."""
@@ -158,259 +169,1001 @@ def extract_date_from_received(msg):
              continue
     return None
 
-def download_emails(limit=None, month=None, since=None, before=None, remove_on_exist=False):
+def parse_email_date(date_str):
+    """emails.date value (RFC 2822, or str(datetime) from the fallbacks) -> aware datetime, None if unparseable."""
+    if not date_str:
+        return None
+    try:
+        dt = email.utils.parsedate_to_datetime(date_str)
+    except:
+        try:
+            dt = datetime.datetime.fromisoformat(str(date_str).strip())
+        except:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+def email_columns(date_obj, other_email, is_from_me, size_bytes=None, attachment_count=None):
+    """Typed emails columns (db.TYPED_COLUMNS) of one message."""
+    columns = {
+        'other_party': other_email,
+        'direction': 'sent' if is_from_me else 'received',
+        'size_bytes': size_bytes,
+        'attachment_count': attachment_count,
+    }
+    if date_obj is not None:
+        if date_obj.tzinfo is None:
+            date_obj = date_obj.replace(tzinfo=datetime.timezone.utc)
+        columns['date_epoch'] = int(date_obj.timestamp())
+        columns['year'] = date_obj.year
+        columns['month'] = date_obj.month
+    return columns
+
+FETCH_BATCH_SIZE = 50 # Bodies per UID FETCH command
+FETCH_BATCH_MB = 16 # ...and at most this many MB per command
+STREAM_THRESHOLD_MB = 8 # Bigger messages are streamed to disk in chunks
+STREAM_CHUNK_SIZE = 1024 * 1024 # Bytes per partial FETCH when streaming
+HEADER_BATCH_SIZE = 500 # UIDs per Message-ID FETCH command
+MAX_UID_SET_LEN = 4000 # Characters of sequence set per UID STORE (keeps command lines short)
+CONFIRM_RANGE_SIZE = 5000 # Messages per FETCH in confirm mode (a sequence range, so the command stays tiny)
+
+UID_RE = re.compile(rb'UID (\d+)')
+SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_ITEM_RE = re.compile(rb'\d+ \(') # Start of an untagged FETCH item (not the rest of one)
+
+def chunked(items, size):
+    """Yield successive slices of `items` with at most `size` elements."""
+    size = max(1, int(size))
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def parse_fetch_response(data):
+    """
+    Pair every literal in a UID FETCH response with its UID.
+    imaplib returns tuples like (b'12 (UID 345 BODY[...] {56}', b'<literal>') followed by b')'.
+    Some servers send the UID after the literal, so we also look at the trailing bytes.
+    Returns {uid(bytes): literal(bytes)}.
+    """
+    results = {}
+    pending = None
+    for part in data or []:
+        if isinstance(part, tuple):
+            m = UID_RE.search(part[0])
+            if m:
+                results[m.group(1)] = part[1]
+                pending = None
+            else:
+                pending = part[1]
+        elif pending is not None and part:
+            m = UID_RE.search(part)
+            if m:
+                results[m.group(1)] = pending
+            pending = None
+    return results
+
+def _scan_uid_size(text, uid=None, size=None):
+    m = UID_RE.search(text)
+    if m: uid = m.group(1)
+    m = SIZE_RE.search(text)
+    if m: size = int(m.group(1))
+    return uid, size
+
+def parse_fetch_sizes(data):
+    """
+    Return {uid: RFC822.SIZE} from a UID FETCH response. UID and size are taken from the same
+    FETCH item: an item with a literal continues in the bytes after it (some servers send the
+    UID or the size there, see parse_fetch_response). Sizes without a UID are dropped.
+    """
+    sizes = {}
+    
+    def record(uid, size):
+        if uid is not None and size is not None:
+            sizes[uid] = size
+            
+    pending = None # (uid, size) so far of the item whose literal came last
+    for part in data or []:
+        if isinstance(part, tuple):
+            if pending is not None:
+                record(*pending)
+            pending = _scan_uid_size(part[0])
+        elif isinstance(part, bytes):
+            if pending is not None and not FETCH_ITEM_RE.match(part):
+                # Rest of the pending item, e.g. b' UID 345 RFC822.SIZE 100)'
+                record(*_scan_uid_size(part, *pending))
+            else:
+                if pending is not None:
+                    record(*pending)
+                # A whole item without a literal, e.g. b'12 (UID 345 RFC822.SIZE 100)'
+                record(*_scan_uid_size(part))
+            pending = None
+    if pending is not None:
+        record(*pending)
+    return sizes
+
+def parse_message_ids(data):
+    """Return {uid: Message-ID} from a HEADER.FIELDS (MESSAGE-ID) FETCH response ('' when the header is missing)."""
+    message_ids = {}
+    for uid, header_content in parse_fetch_response(data).items():
+        message_id = ''
+        try:
+            msg_header = email.message_from_bytes(header_content)
+            message_id = str(msg_header.get('Message-ID', '')).strip()
+        except:
+            pass
+        message_ids[uid] = message_id
+    return message_ids
+
+def fetch_response_size(data):
+    """Bytes in a FETCH response (lines and literals), for charging header passes to the budget."""
+    total = 0
+    for part in data or []:
+        for piece in (part if isinstance(part, tuple) else (part,)):
+            if isinstance(piece, bytes):
+                total += len(piece)
+    return total
+
+def fetch_message_ids(mail, uids, folder, budget=None):
+    """
+    Fetch the Message-ID header and RFC822.SIZE of many messages with one UID FETCH per HEADER_BATCH_SIZE uids.
+    Returns ({uid: message_id}, {uid: size}). Messages without a Message-ID get a synthetic one (same as before).
+    budget: optional TransferBudget the response bytes are recorded to.
+    """
+    message_ids = {}
+    sizes = {}
+    for batch in chunked(uids, HEADER_BATCH_SIZE):
+        uid_set = b','.join(batch).decode()
+        typ, data = mail.uid('FETCH', uid_set, '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+        if typ != 'OK':
+            raise Exception(f"Error fetching headers for {len(batch)} messages")
+        if budget:
+            budget.commit(fetch_response_size(data), 'download', reserved=0)
+            
+        sizes.update(parse_fetch_sizes(data))
+        for uid, message_id in parse_message_ids(data).items():
+            if message_id:
+                message_ids[uid] = message_id
+                
+    for uid in uids:
+        if uid not in message_ids:
+            message_ids[uid] = f"{uid.decode()}_{folder}_{int(time.time())}"
+    return message_ids, sizes
+
+def fetch_all_message_ids(mail, exists, range_size=CONFIRM_RANGE_SIZE, budget=None):
+    """
+    Read the UID, Message-ID and size of every message in the selected folder.
+    Walks sequence ranges 1:n, n+1:2n... up to EXISTS, so there is no SEARCH and no
+    UID list to send, and each range comes back as one streamed response.
+    Returns ({uid: message_id}, {uid: size}); message_id is '' when the header is missing.
+    budget: optional TransferBudget the response bytes are recorded to.
+    """
+    message_ids = {}
+    sizes = {}
+    for start in range(1, exists + 1, range_size):
+        end = min(start + range_size - 1, exists)
+        typ, data = mail.fetch(f'{start}:{end}', '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+        if typ != 'OK':
+            raise Exception(f"Error fetching headers for messages {start}:{end}")
+        if budget:
+            budget.commit(fetch_response_size(data), 'download', reserved=0)
+        message_ids.update(parse_message_ids(data))
+        sizes.update(parse_fetch_sizes(data))
+        print(f"  Read {min(end, exists)}/{exists} headers...")
+    return message_ids, sizes
+
+def compress_uid_set(uids):
+    """
+    Turn UIDs into compact IMAP sequence sets, e.g. [1,2,3,7,9,10] -> ['1:3,7,9:10'].
+    Returns a list of sets, each at most MAX_UID_SET_LEN characters.
+    """
+    numbers = sorted(set(int(u) for u in uids))
+    ranges = []
+    for n in numbers:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+            
+    sets = []
+    current = []
+    current_len = 0
+    for start, end in ranges:
+        token = str(start) if start == end else f"{start}:{end}"
+        if current and current_len + len(token) + 1 > MAX_UID_SET_LEN:
+            sets.append(",".join(current))
+            current, current_len = [], 0
+        current.append(token)
+        current_len += len(token) + 1
+    if current:
+        sets.append(",".join(current))
+    return sets
+
+def delete_uids(mail, uids):
+    """Flag UIDs \\Deleted with as few UID STORE commands as possible, then expunge once."""
+    if not uids:
+        return 0
+    for uid_set in compress_uid_set(uids):
+        typ, data = mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if typ != 'OK':
+            raise Exception(f"UID STORE failed: {data}")
+    mail.expunge()
+    return len(uids)
+
+def get_uidvalidity(mail):
+    """UIDVALIDITY of the currently selected folder (from the SELECT response)."""
+    try:
+        typ, data = mail.response('UIDVALIDITY')
+        if data and data[0]:
+            return int(data[0])
+    except:
+        pass
+    return None
+
+def load_checkpoint(mail, folder):
+    """
+    Return (uidvalidity, last_uid) for the selected folder.
+    If the server's UIDVALIDITY changed, the folder's checkpoints are dropped and last_uid is 0.
+    """
+    uidvalidity = get_uidvalidity(mail)
+    saved_validity, last_uid = get_sync_state(folder)
+    if uidvalidity is not None and saved_validity is not None and saved_validity != uidvalidity:
+        print(f"  UIDVALIDITY changed ({saved_validity} -> {uidvalidity}). Discarding checkpoints for {folder}.")
+        reset_sync_state(folder, uidvalidity)
+        last_uid = 0
+    return uidvalidity, last_uid
+
+def month_is_over(month_str):
+    """True if 'YYYY-MM' lies entirely in the past, so a complete pass over it stays complete."""
+    try:
+        year, mon = map(int, month_str.split('-'))
+    except:
+        return False
+    first_of_next = datetime.date(year + 1, 1, 1) if mon == 12 else datetime.date(year, mon + 1, 1)
+    return first_of_next <= datetime.date.today()
+
+def save_downloaded_email(temp_path, message_id, config):
+    """
+    Parse the headers of a downloaded message (temp file), update identities,
+    move it into data/raw and record it in the DB. The body is never loaded.
+    raw_storage (config.ini): 'tree' (default) stores data/raw/YYYY/MM/<party>/<subject>_<time>.eml,
+    'cas' stores data/raw/objects/ab/cd/<sha256>.eml and writes identical bytes only once.
+    """
+    # Same message in INBOX and Sent, fetched in the same run
+    if email_exists(message_id):
+        discard_temp(temp_path)
+        print(f"Skipping {message_id} (Already saved in this run)")
+        return None, None
+        
+    msg = read_headers(temp_path)
+    
+    # Parse Basic Info
+    # Ensure all are strings for SQLite
+    subject = str(decode_mime_words(msg.get('Subject', 'No Subject')))
+    date_str = str(msg.get('Date') or '')
+    from_str = str(msg.get('From') or '')
+    to_str = str(msg.get('To', ''))
+    
+    # Message ID cleanup
+    message_id = str(message_id).strip()
+
+    # --- Identity Processing (Downloader Phase) ---
+    # Check Sender (Received Email -> Source 0)
+    from_name, from_email = get_email_address_and_name(from_str)
+    process_identity(from_email, from_name, source_type=0)
+    
+    # Check Recipient (Sent Email -> Source 1)
+    # Use my username to check if I am sender
+    me_address = config.get('username', '').lower()
+    is_from_me = (me_address in from_email.lower()) if me_address else False
+    
+    if is_from_me:
+        to_name, to_email = get_email_address_and_name(to_str)
+        # Use Source 1 (High Priority) for people I send TO
+        process_identity(to_email, to_name, source_type=1)
+    # ----------------------------------------------
+
+    if not date_str:
+        date_str = str(datetime.datetime.now())
+        
+    # Folder/File Logic
+    # Local Path: data/raw/YYYY/MM/OtherParty/filename
+    
+    # Determine Other Party (for folder organization)
+    if is_from_me:
+        # I sent it, so folder is the Recipient
+        # Simpler parsing for folder key
+        _, other_email = get_email_address_and_name(to_str)
+    else:
+        # I received it, so folder is Sender
+        other_email = from_email
+        
+    if not other_email: other_email = "unknown"
+
+    # Date Parsing with Fallback regarding "Received" header
+    final_date_obj = None
+    
+    # 1. Try Standard Date Header
+    try:
+        if date_str:
+            final_date_obj = email.utils.parsedate_to_datetime(date_str)
+            # Sanity Check: If year is way off (e.g. < 1990) or future?
+            # For now, just trust it if it parses.
+    except:
+        pass
+        
+    # 2. Fallback to Received Header if 1 failed
+    if not final_date_obj:
+        print(f"  Date header '{date_str}' invalid/missing. Trying 'Received' header...")
+        final_date_obj = extract_date_from_received(msg)
+        if final_date_obj:
+             # Update date_str for DB consistency
+             date_str = str(final_date_obj)
+             print(f"  Extracted date from Received: {date_str}")
+             
+    # 3. Fallback to Now
+    if not final_date_obj:
+        print("  Could not extract any date. using NOW.")
+        final_date_obj = datetime.datetime.now()
+        
+    sha256 = hash_file(temp_path)
+    size_bytes = os.path.getsize(temp_path)
+    with open(temp_path, 'rb') as f:
+        attachments = scan_attachments(f)
+    columns = email_columns(final_date_obj, other_email, is_from_me, size_bytes, len(attachments))
+    # Body text for the search index (fts_body in config.ini), read before compression
+    body = read_body_text(temp_path) if config.get('fts_body', 'false').lower() == 'true' else ''
+    
+    # raw_compression: hash the original bytes, store them compressed
+    method = compression_method(config)
+    suffix = RAW_SUFFIXES[method]
+    temp_path = compress_temp(temp_path, method)
+    
+    if config.get('raw_storage', 'tree') == 'cas':
+        # Content-addressed: the name is the hash, so identical bytes are stored once
+        filepath, written = commit_temp_cas(temp_path, sha256, suffix)
+        if not written:
+            print(f"  Identical content already stored: {filepath}")
+    else:
+        year = str(final_date_obj.year)
+        month = f"{final_date_obj.month:02d}"
+            
+        save_dir = os.path.join("data", "raw", year, month, clean_filename(other_email))
+        os.makedirs(save_dir, exist_ok=True)
+        
+        filename = f"{clean_filename(subject[:50])}_{int(time.time())}.eml{suffix}"
+        filepath = unique_path(os.path.join(save_dir, filename))
+        
+        commit_temp(temp_path, filepath)
+        
+    email_id = save_email_metadata(message_id, subject, from_str, date_str, filepath, sha256, columns)
+    # Cached for the concentrator, so it never has to parse the file
+    save_mime_summaries([(email_id, mime_summary(msg, attachments))])
+    index_email(email_id, subject, decode_mime_words(from_str), email_recipients(msg), [a['name'] for a in attachments], body)
+    return subject, date_str
+
+def mime_summary(headers, attachments):
+    """Decoded recipients and the attachment list of a message (cached in the emails table)."""
+    return {
+        'to': decode_mime_words(headers.get('To', '')),
+        'cc': decode_mime_words(headers.get('Cc', '')),
+        'bcc': decode_mime_words(headers.get('Bcc', '')),
+        'attachments': attachments,
+    }
+
+def email_recipients(headers):
+    """To and Cc of a message, decoded, as one string."""
+    values = (headers.get_all('To') or []) + (headers.get_all('Cc') or [])
+    return ', '.join(str(decode_mime_words(str(v))) for v in values)
+
+def stored_email_columns(row, me_address):
+    """Typed columns for an already stored email (row: id, sender, date, local_path)."""
+    _, from_email = get_email_address_and_name(row['sender'] or '')
+    is_from_me = (me_address in from_email) if me_address else False
+    other_email = from_email
+    size_bytes = raw_size(row['local_path']) if row['local_path'] else None
+    attachment_count = None
+    
+    if size_bytes is not None:
+        with open_raw(row) as f:
+            headers = BytesHeaderParser().parsebytes(read_header_block(f))
+            if is_from_me:
+                _, other_email = get_email_address_and_name(str(headers.get('To', '')))
+            attachment_count = count_attachments(f, headers)
+            
+    if not other_email: other_email = "unknown"
+    # Missing files get size 0, so they are not picked up again
+    return email_columns(parse_email_date(row['date']), other_email, is_from_me, size_bytes or 0, attachment_count)
+
+def backfill_email_columns(chunk_size=1000):
+    """Backfill 'email_columns': typed columns of emails saved before they existed."""
+    config = load_config()
+    me_address = config.get('username', '').lower()
+    
+    def process(rows):
+        updates = []
+        for row in rows:
+            try:
+                updates.append((row['id'], stored_email_columns(row, me_address)))
+            except Exception as e:
+                print(f"  Error reading email {row['id']} ({row['local_path']}): {e}")
+        update_email_columns(updates)
+        
+    return run_backfill('email_columns',
+                        "SELECT id, sender, date, local_path FROM emails WHERE id > ? AND size_bytes IS NULL ORDER BY id LIMIT ?",
+                        process, chunk_size)
+
+def backfill_sha256(chunk_size=1000):
+    """Backfill 'sha256': content hashes of emails saved before they were recorded."""
+    def process(rows):
+        conn = get_db_connection()
+        for row in rows:
+            if not row['local_path'] or not os.path.exists(row['local_path']):
+                continue
+            try:
+                with open_raw(row) as f:
+                    h = hashlib.sha256()
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        h.update(chunk)
+                conn.execute("UPDATE emails SET sha256 = ? WHERE id = ?", (h.hexdigest(), row['id']))
+            except Exception as e:
+                print(f"  Error hashing email {row['id']} ({row['local_path']}): {e}")
+                
+    return run_backfill('sha256',
+                        "SELECT id, local_path FROM emails WHERE id > ? AND sha256 IS NULL ORDER BY id LIMIT ?",
+                        process, chunk_size)
+
+def backfill_emails_fts(chunk_size=1000):
+    """Backfill 'emails_fts': search index entries of emails saved before it existed."""
     config = load_config()
+    index_body = config.get('fts_body', 'false').lower() == 'true'
+    
+    def process(rows):
+        summaries = []
+        for row in rows:
+            recipients, names, body = '', [], ''
+            try:
+                if raw_size(row) is not None:
+                    headers, attachments = scan_email(row)
+                    recipients = email_recipients(headers)
+                    names = [a['name'] for a in attachments]
+                    # Same pass fills the concentrator's cache
+                    summaries.append((row['id'], mime_summary(headers, attachments)))
+                    if index_body:
+                        body = read_body_text(row)
+            except Exception as e:
+                print(f"  Error reading email {row['id']} ({row['local_path']}): {e}")
+            # Subject and sender are indexed even if the file is unreadable
+            index_email(row['id'], row['subject'], decode_mime_words(row['sender'] or ''), recipients, names, body)
+        save_mime_summaries(summaries)
+                
+    return run_backfill('emails_fts',
+                        "SELECT id, subject, sender, local_path FROM emails WHERE id > ? ORDER BY id LIMIT ?",
+                        process, chunk_size)
+
+def backfill_concentrated_items(chunk_size=1000):
+    """Backfill 'concentrated_items' (archive contents, see concentrator.py)."""
+    from concentrator import backfill_concentrated_items as backfill
+    # Archives hold many emails each
+    return backfill(max(1, chunk_size // 10))
+
+# Data migrations registered by db.MIGRATIONS, by name
+BACKFILLS = {
+    'sha256': backfill_sha256,
+    'email_columns': backfill_email_columns,
+    'emails_fts': backfill_emails_fts,
+    'concentrated_items': backfill_concentrated_items,
+}
+
+def run_pending_backfills(chunk_size=1000, only=None):
+    """Run every pending backfill (or just `only`). Interrupted ones resume where they stopped."""
+    pending = pending_backfills()
+    if only:
+        pending = [name for name in pending if name in only]
+    if not pending:
+        print("No pending backfills.")
+        return
+    for name in pending:
+        if name not in BACKFILLS:
+            print(f"Unknown backfill '{name}', skipping.")
+            continue
+        print(f"Running backfill '{name}'...")
+        count = BACKFILLS[name](chunk_size)
+        print(f"Backfill '{name}' complete ({count} rows).")
+
+def connect_imap(config=None):
+    """Open an authenticated IMAP connection (and send the ID command 163.com wants)."""
+    if config is None:
+        config = load_config()
     imap_server = config['imap_server']
     imap_port = int(config.get('imap_tls_port', 993))
-    username = config['username']
-    password = config['password']
+    
+    mail = imaplib.IMAP4_SSL(imap_server, imap_port)
+    mail.login(config['username'], config['password'])
+    
+    # ID Command
+    name_val = '("name" "python-client" "version" "1.0")'
+    try:
+         mail.xatom('ID', name_val)
+    except:
+         pass
+    return mail
+
+def detect_target_folders(mail):
+    """INBOX plus the Sent folder (163 uses &XfJT0ZAB- for Sent Items usually)."""
+    target_folders = ["INBOX"]
+    # Try to find Sent folder
+    typ, mailboxes = mail.list()
+    sent_folder = None
+    for m in mailboxes:
+        name = m.decode('utf-8')
+        # 163 uses &XfJT0ZAB- for Sent Items usually, or "Sent Items"
+        if "&XfJT0ZAB-" in name or "Sent" in name:
+            # Extract name from string like: (\HasNoChildren) "/" "&XfJT0ZAB-"
+            # Simple extraction
+            if '"/"' in name:
+                folder_name = name.split('"/"')[-1].strip().replace('"', '')
+            else:
+                folder_name = name.split()[-1].replace('"', '')
+            
+            # Check if it looks like Sent
+            if "&XfJT0ZAB-" in folder_name or "Sent" in folder_name:
+                sent_folder = folder_name
+                break
+    
+    if sent_folder:
+        print(f"Detected Sent folder: {sent_folder}")
+        target_folders.append(sent_folder)
+    else:
+        print("Could not specific Sent folder automatically, checking standard 'Sent Items'...")
+        target_folders.append("Sent Items") # Try standard
+    return target_folders
+
+def plan_fetch_batches(uids, sizes, batch_size, batch_bytes, stream_threshold):
+    """
+    Split uids into fetch batches of at most batch_size messages and batch_bytes bytes.
+    Messages above stream_threshold get a batch of their own (they are streamed).
+    """
+    batches = []
+    batch = []
+    batch_total = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if size > stream_threshold:
+            if batch:
+                batches.append(batch)
+                batch, batch_total = [], 0
+            batches.append([uid])
+            continue
+        if batch and (len(batch) >= batch_size or batch_total + size > batch_bytes):
+            batches.append(batch)
+            batch, batch_total = [], 0
+        batch.append(uid)
+        batch_total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def stream_body_to_file(mail, uid, chunk_size=STREAM_CHUNK_SIZE, budget=None):
+    """
+    Download one message with partial fetches (BODY.PEEK[]<offset.chunk_size>) straight
+    into a temp file, so at most one chunk is held in memory. Returns the temp path.
+    """
+    temp_path = new_temp_path()
+    try:
+        with open(temp_path, 'wb') as f:
+            offset = 0
+            while True:
+                if budget:
+                    budget.throttle(chunk_size)
+                typ, data = mail.uid('FETCH', uid.decode(), f'(BODY.PEEK[]<{offset}.{chunk_size}>)')
+                if typ != 'OK':
+                    raise Exception("Error fetching body chunk")
+                chunk = parse_fetch_response(data).get(uid)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                if len(chunk) < chunk_size:
+                    break
+        if offset == 0:
+            discard_temp(temp_path)
+            return None
+        return temp_path
+    except:
+        discard_temp(temp_path)
+        raise
+
+def fetch_bodies(mail, uids, sizes=None, stream_threshold=None, budget=None):
+    """
+    Fetch a batch of messages. Returns {uid: raw_bytes or temp_path}.
+    A single message above stream_threshold is streamed to a temp file instead.
+    budget: optional TransferBudget whose rate limit is applied before the transfer.
+    """
+    if len(uids) == 1 and sizes and stream_threshold and sizes.get(uids[0], 0) > stream_threshold:
+        return {uids[0]: stream_body_to_file(mail, uids[0], budget=budget)}
+        
+    if budget and sizes:
+        budget.throttle(sum(sizes.get(u, 0) for u in uids))
+
+    typ, msg_data = mail.uid('FETCH', b','.join(uids).decode(), '(RFC822)')
+    if typ != 'OK':
+        raise Exception("Error fetching body")
+    return parse_fetch_response(msg_data)
+
+def _body_worker(config, tasks, results, stop_event, stream_threshold, budget):
+    """
+    Fetch thread: owns one IMAP connection, takes (plan, uids) tasks and puts
+    (plan, uids, bodies, error) on the results queue. Never touches the DB; bodies
+    above stream_threshold are streamed to .incoming temp files (their paths are put
+    on the queue instead of bytes). Always ends with a None sentinel.
+    """
+    mail = None
+    selected = None
+    try:
+        mail = connect_imap(config)
+        while not stop_event.is_set():
+            try:
+                plan, uids = tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if selected != plan['folder']:
+                    typ, _ = mail.select(plan['folder'])
+                    if typ != 'OK':
+                        raise Exception(f"Select {plan['folder']} failed")
+                    selected = plan['folder']
+                results.put((plan, uids, fetch_bodies(mail, uids, plan['sizes'], stream_threshold, budget), None))
+            except Exception as e:
+                results.put((plan, uids, None, e))
+    except Exception as e:
+        print(f"  Worker connection failed: {e}")
+    finally:
+        if mail:
+            try: mail.logout()
+            except: pass
+        results.put(None)
+
+def iter_fetched_batches(mail, config, tasks, workers=1, stream_threshold=None, budget=None):
+    """
+    Yield (plan, uids, bodies, error) for every (plan, uids) task.
+    workers <= 1: fetched in order on the given connection.
+    workers > 1: fetched by a pool of threads with their own connections; results
+    come back in completion order and are consumed by the caller (the single writer).
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        selected = None
+        for plan, uids in tasks:
+            try:
+                if selected != plan['folder']:
+                    typ, _ = mail.select(plan['folder'])
+                    if typ != 'OK':
+                        raise Exception(f"Select {plan['folder']} failed")
+                    selected = plan['folder']
+                yield plan, uids, fetch_bodies(mail, uids, plan['sizes'], stream_threshold, budget), None
+            except Exception as e:
+                yield plan, uids, None, e
+        return
+        
+    workers = min(workers, len(tasks))
+    task_queue = queue.Queue()
+    for t in tasks:
+        task_queue.put(t)
+    # Bounded, so fetchers wait for the writer instead of piling bodies up in memory
+    results = queue.Queue(maxsize=workers * 2)
+    stop_event = threading.Event()
+    
+    print(f"  Starting {workers} download workers...")
+    threads = [threading.Thread(target=_body_worker, args=(config, task_queue, results, stop_event, stream_threshold, budget), daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+        
+    try:
+        finished = 0
+        while finished < len(threads):
+            item = results.get()
+            if item is None:
+                finished += 1
+                continue
+            yield item
+            
+        # Tasks left behind by workers that could not connect
+        while True:
+            try:
+                plan, uids = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            yield plan, uids, None, Exception("No worker connection available")
+    finally:
+        stop_event.set()
+        while any(t.is_alive() for t in threads):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for t in threads:
+            t.join()
+
+def store_missing_bodies(mail, config, plans, budget, batch_size=None, workers=None, log_ctx=None):
+    """
+    Fetch the bodies of every plan's missing_uids (batch_size messages per command,
+    spread over `workers` connections) and save them. This thread is the only writer.
+    Daily quota: whole messages are reserved by RFC822.SIZE in order, the rest is deferred.
+    Returns (processed, quota_stopped). Raises RuntimeError after 10 consecutive errors.
+    """
+    if not batch_size:
+        batch_size = int(config.get('fetch_batch_size', FETCH_BATCH_SIZE))
+    if not workers:
+        workers = int(config.get('download_workers', 1))
+    batch_bytes = int(float(config.get('fetch_batch_mb', FETCH_BATCH_MB)) * 1024 * 1024)
+    stream_threshold = int(float(config.get('stream_threshold_mb', STREAM_THRESHOLD_MB)) * 1024 * 1024)
+    log_ctx = log_ctx or {}
+    
+    total_processed = 0
+    quota_stopped = False
+    
+    # Daily quota: reserve whole messages (by RFC822.SIZE) in order, defer the rest.
+    tasks = []
+    for plan in plans:
+        for batch in plan_fetch_batches(plan['missing_uids'], plan['sizes'], batch_size, batch_bytes, stream_threshold):
+            if quota_stopped or not budget.try_reserve(sum(plan['sizes'].get(u, 0) for u in batch)):
+                quota_stopped = True
+                continue
+            tasks.append((plan, batch))
+    total_missing = sum(len(batch) for _, batch in tasks)
+    if quota_stopped:
+        deferred = sum(len(plan['missing_uids']) for plan in plans) - total_missing
+        print(f"Daily transfer budget allows {total_missing} of the missing emails; {deferred} deferred. ({budget.describe()})")
+
+    consecutive_errors = 0
+    done = 0
+    batches = iter_fetched_batches(mail, config, tasks, workers, stream_threshold, budget)
+    try:
+        for plan, batch, bodies, fetch_err in batches:
+            folder = plan['folder']
+            print(f"[{done+1}-{done+len(batch)}/{total_missing}] Fetched {folder} UIDs {batch[0].decode()}..{batch[-1].decode()}")
+
+            if fetch_err is not None:
+                budget.release(sum(plan['sizes'].get(u, 0) for u in batch))
+                if is_quota_error(fetch_err):
+                    print(f"Server reports transfer quota exceeded: {fetch_err}")
+                    budget.mark_exhausted('download')
+                    quota_stopped = True
+                    break
+
+                print(f"Error fetching batch: {fetch_err}")
+                log_download_error(fetch_err, {
+                    **log_ctx,
+                    "Current Folder": folder,
+                    "UIDs": b','.join(batch).decode(),
+                })
+                done += len(batch)
+                consecutive_errors += 1
+                if consecutive_errors >= 10:
+                    print("TOO MANY CONSECUTIVE ERRORS (10). Stopping download safely.")
+                    raise RuntimeError("Too many consecutive errors")
+                continue
+
+            # One transaction for the whole batch (rows, identities, quota ledger)
+            with db_batch():
+                for uid in batch:
+                    done += 1
+                    reserved = plan['sizes'].get(uid, 0)
+                    msg_id_str = uid.decode()
+                    subject = None
+                    date_str = None
+                    temp_path = None
+                    try:
+                        body = bodies.pop(uid, None)
+                        if not body:
+                            raise Exception(f"Invalid message body data received for UID {msg_id_str}")
+                        # Small bodies arrive as bytes, streamed ones as a temp file
+                        temp_path = body if isinstance(body, str) else write_temp(body)
+                        body = None
+                        nbytes = os.path.getsize(temp_path)
+
+                        subject, date_str = save_downloaded_email(temp_path, plan['message_ids'][uid], config)
+                        temp_path = None
+                        budget.commit(nbytes, 'download', reserved=reserved)
+                        plan['done_uids'].add(uid)
+
+                        total_processed += 1
+                        consecutive_errors = 0 # Reset on success
+
+                    except Exception as e:
+                        discard_temp(temp_path)
+                        budget.release(reserved)
+                        print(f"Error processing email UID {msg_id_str}: {e}")
+
+                        # Gather context for logging
+                        err_ctx = {
+                            **log_ctx,
+                            "Current Folder": folder,
+                            "Msg UID": msg_id_str,
+                            "Last DB Date": get_latest_email_date(), # Re-query for specific error context
+                        }
+                        if date_str: err_ctx["Email Date"] = date_str
+                        if subject: err_ctx["Subject"] = subject
+
+                        log_download_error(e, err_ctx)
+
+                        # If it's just a missing body (ghost email), don't count it as a connection/critical failure
+                        if "Invalid message body data" in str(e):
+                            print(f"  Warning: Skipping invalid email {msg_id_str} and continuing...")
+                            plan['done_uids'].add(uid)
+                        else:
+                            consecutive_errors += 1
+
+                        if consecutive_errors >= 10:
+                            print("TOO MANY CONSECUTIVE ERRORS (10). Stopping download safely.")
+                            raise RuntimeError("Too many consecutive errors")
+                        continue
+    finally:
+        batches.close()
+            
+    return total_processed, quota_stopped
+
+def checkpoint_plans(plans, month=None):
+    """
+    Advance each folder's UID checkpoint to the highest UID below its first unhandled
+    one (failed, deferred by the quota or never reached), and mark `month` as synced
+    for folders that were handled completely.
+    Only plans that covered every UID below them (checkpoint passes 'last_uid+1:*' and
+    full-folder passes, plan['covers_lower_uids']) move the checkpoint: a date window
+    says nothing about the UIDs of other months.
+    """
+    for plan in plans:
+        uidvalidity = plan['uidvalidity']
+        if uidvalidity is None:
+            continue
+        unhandled = set(plan['missing_uids']) - plan['done_uids']
+        handled = [int(u) for u in plan['email_uids'] if u not in unhandled]
+        if unhandled:
+            first_unhandled = min(int(u) for u in unhandled)
+            handled = [u for u in handled if u < first_unhandled]
+        if handled and plan['covers_lower_uids']:
+            update_sync_state(plan['folder'], uidvalidity, max(handled))
+        if month and not unhandled and not plan['truncated'] and month_is_over(month):
+            mark_month_synced(plan['folder'], uidvalidity, month)
+
+def download_emails(limit=None, month=None, since=None, before=None, remove_on_exist=False, batch_size=None, checkpoint_only=False, workers=None):
+    """
+    Download emails from INBOX and the Sent folder.
+    With month/since: search that date window.
+    Otherwise: resume each folder from its UID checkpoint (UID SEARCH UID <last+1>:*),
+    falling back to the date-based smart resume for folders without one.
+    Only checkpoint passes move the checkpoint; `confirm` sets the first one.
+    checkpoint_only: only run the UID checkpoint pass (skip folders without a checkpoint).
+    workers: number of IMAP connections fetching bodies in parallel. Saving (files, DB,
+    identities) always happens in this thread.
+    """
+    config = load_config()
+    imap_server = config['imap_server']
     
     total_processed = 0
     total_deleted = 0
+    quota_stopped = False
+    
+    budget = TransferBudget(config)
+    if budget.daily_bytes and budget.remaining() <= 0:
+        raise QuotaExceeded(f"Daily transfer budget used up ({budget.describe()}). Run again tomorrow.")
 
     print(f"Connecting to {imap_server}...")
-    mail = imaplib.IMAP4_SSL(imap_server, imap_port)
+    mail = None
     
     try:
-        mail.login(username, password)
+        mail = connect_imap(config)
         print("Logged in.")
+        clean_incoming()
         
-        # ID Command
-        name_val = '("name" "python-client" "version" "1.0")'
-        try:
-             mail.xatom('ID', name_val)
-        except:
-             pass
-
         # Identify folders
-        target_folders = ["INBOX"]
-        # Try to find Sent folder
-        typ, mailboxes = mail.list()
-        sent_folder = None
-        for m in mailboxes:
-            name = m.decode('utf-8')
-            # 163 uses &XfJT0ZAB- for Sent Items usually, or "Sent Items"
-            if "&XfJT0ZAB-" in name or "Sent" in name:
-                # Extract name from string like: (\HasNoChildren) "/" "&XfJT0ZAB-"
-                # Simple extraction
-                if '"/"' in name:
-                    folder_name = name.split('"/"')[-1].strip().replace('"', '')
-                else:
-                    folder_name = name.split()[-1].replace('"', '')
-                
-                # Check if it looks like Sent
-                if "&XfJT0ZAB-" in folder_name or "Sent" in folder_name:
-                    sent_folder = folder_name
-                    break
-        
-        if sent_folder:
-            print(f"Detected Sent folder: {sent_folder}")
-            target_folders.append(sent_folder)
-        else:
-            print("Could not specific Sent folder automatically, checking standard 'Sent Items'...")
-            target_folders.append("Sent Items") # Try standard
+        target_folders = detect_target_folders(mail)
+
+        # Known Message-IDs, loaded once for the whole run
+        known_count = len(load_message_id_index())
+        print(f"Loaded {known_count} known Message-IDs.")
 
         # Date Criteria
-        since_crit, before_crit = get_date_search_criteria(month, since, before)
-        print(f"Date Range: SINCE {since_crit} BEFORE {before_crit}")
+        date_window = bool(month or since)
+        since_crit, before_crit = None, None
+        if not checkpoint_only:
+            since_crit, before_crit = get_date_search_criteria(month, since, before)
+            print(f"Date Range: SINCE {since_crit} BEFORE {before_crit}")
         
-        # conn = get_db_connection() # No longer needed here, db functions handle their own connections
-        # cursor = conn.cursor() # No longer needed here
-
+        # Phase 1: search + Message-ID diff per folder (main connection)
+        plans = []
         for folder in target_folders:
             print(f"Scanning folder: {folder}")
             typ, data = mail.select(folder)
             if typ != 'OK':
                 print(f"  Skipping {folder} (Selected failed)")
                 continue
+                
+            # Checkpoint: only valid while UIDVALIDITY is unchanged
+            uidvalidity, last_uid = load_checkpoint(mail, folder)
+                
+            use_checkpoint = (not date_window) and uidvalidity is not None and last_uid > 0
+            if checkpoint_only and not use_checkpoint:
+                print(f"  No UID checkpoint for {folder} yet.")
+                continue
 
-            # Search with Date Range
-            # SEARCH SINCE d-M-Y BEFORE d-M-Y
-            search_crit = f'(SINCE "{since_crit}" BEFORE "{before_crit}")'
-            typ, messages = mail.search(None, search_crit)
+            if use_checkpoint:
+                # Only what arrived since the last run
+                print(f"  Resuming from UID checkpoint {last_uid}.")
+                typ, messages = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+            else:
+                # Search with Date Range
+                # UID SEARCH SINCE d-M-Y BEFORE d-M-Y
+                search_crit = f'(SINCE "{since_crit}" BEFORE "{before_crit}")'
+                typ, messages = mail.uid('SEARCH', None, search_crit)
             
             if typ != 'OK':
                 print("  Search failed.")
                 continue
                 
-            email_ids = messages[0].split()
-            print(f"  Found {len(email_ids)} emails in {folder}.")
+            email_uids = sorted(messages[0].split(), key=int)
+            if use_checkpoint:
+                # 'n:*' always matches the highest UID, even if it is below n
+                email_uids = [u for u in email_uids if int(u) > last_uid]
+            print(f"  Found {len(email_uids)} emails in {folder}.")
             
             # Apply limit if strictly requested (though date range usually overrides)
-            if limit and len(email_ids) > limit:
-                print(f"  Limiting to last {limit}...")
-                email_ids = email_ids[-limit:]
-
-            consecutive_errors = 0
-            for i, e_id in enumerate(email_ids):
-                msg_id_str = e_id.decode() if isinstance(e_id, bytes) else str(e_id)
-                print(f"[{i+1}/{len(email_ids)}] Fetching ID {msg_id_str}...")
+            truncated = False
+            if limit and len(email_uids) > limit:
+                truncated = True
+                if use_checkpoint:
+                    # Oldest first, so the checkpoint can advance over them
+                    print(f"  Limiting to first {limit}...")
+                    email_uids = email_uids[:limit]
+                else:
+                    print(f"  Limiting to last {limit}...")
+                    email_uids = email_uids[-limit:]
                 
-                try:
-                    # 1. Fetch Header for ID check (Optimization)
-                    typ, header_data = mail.fetch(msg_id_str, '(RFC822.HEADER)')
-                    if typ != 'OK': 
-                        raise Exception("Error fetching header")
-                        
-                    header_content = None
-                    if header_data and isinstance(header_data[0], tuple):
-                        header_content = header_data[0][1]
-                    
-                    if header_content:
-                        try:
-                            msg_header = email.message_from_bytes(header_content)
-                            message_id = msg_header.get('Message-ID', '').strip()
-                            if not message_id:
-                                 message_id = f"{msg_id_str}_{folder}_{int(time.time())}"
-                        except:
-                            message_id = f"{msg_id_str}_{folder}_{int(time.time())}"
-                    else:
-                        message_id = f"{msg_id_str}_{folder}_{int(time.time())}"
-                    
-                    # Resume/Duplicate Check
-                    if email_exists(message_id):
-                        print(f"Skipping {message_id} (Already exists)")
-                        
-                        if remove_on_exist:
-                            try:
-                                mail.store(msg_id_str, '+FLAGS', '\\Deleted')
-                                print(f"  Marked {msg_id_str} for deletion.")
-                                total_deleted += 1
-                            except Exception as del_err:
-                                print(f"  Deletion failed: {del_err}")
-                                
-                        consecutive_errors = 0 # Successful skip resets errors
-                        continue
-
-                    # 2. Fetch Full Content
-                    typ, msg_data = mail.fetch(msg_id_str, '(RFC822)')
-                    if typ != 'OK':
-                        raise Exception("Error fetching body")
-                        
-                    if not msg_data or not isinstance(msg_data[0], tuple):
-                         raise Exception(f"Invalid message body data received for ID {msg_id_str}")
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    # Parse Basic Info
-                    # Ensure all are strings for SQLite
-                    subject = str(decode_mime_words(msg.get('Subject', 'No Subject')))
-                    date_str = str(msg.get('Date') or '')
-                    from_str = str(msg.get('From') or '')
-                    to_str = str(msg.get('To', ''))
-                    
-                    # Message ID cleanup
-                    message_id = str(message_id).strip()
+            if not email_uids:
+                if month and uidvalidity is not None and month_is_over(month):
+                    mark_month_synced(folder, uidvalidity, month)
+                continue
 
-                    # --- Identity Processing (Downloader Phase) ---
-                    # Check Sender (Received Email -> Source 0)
-                    from_name, from_email = get_email_address_and_name(from_str)
-                    process_identity(from_email, from_name, source_type=0)
-                    
-                    # Check Recipient (Sent Email -> Source 1)
-                    # Use my username to check if I am sender
-                    me_address = config.get('username', '').lower()
-                    is_from_me = (me_address in from_email.lower()) if me_address else False
-                    
-                    if is_from_me:
-                        to_name, to_email = get_email_address_and_name(to_str)
-                        # Use Source 1 (High Priority) for people I send TO
-                        process_identity(to_email, to_name, source_type=1)
-                    # ----------------------------------------------
-
-                    if not date_str:
-                        date_str = str(datetime.datetime.now())
-                        
-                    # Folder/File Logic
-                    # Local Path: data/raw/YYYY/MM/OtherParty/filename
-                    
-                    # Determine Other Party (for folder organization)
-                    if is_from_me:
-                        # I sent it, so folder is the Recipient
-                        # Simpler parsing for folder key
-                        _, other_email = get_email_address_and_name(to_str)
-                    else:
-                        # I received it, so folder is Sender
-                        other_email = from_email
-                        
-                    if not other_email: other_email = "unknown"
-    
-                    # Date Parsing with Fallback regarding "Received" header
-                    final_date_obj = None
-                    
-                    # 1. Try Standard Date Header
-                    try:
-                        if date_str:
-                            final_date_obj = email.utils.parsedate_to_datetime(date_str)
-                            # Sanity Check: If year is way off (e.g. < 1990) or future?
-                            # For now, just trust it if it parses.
-                    except:
-                        pass
-                        
-                    # 2. Fallback to Received Header if 1 failed
-                    if not final_date_obj:
-                        print(f"  Date header '{date_str}' invalid/missing. Trying 'Received' header...")
-                        final_date_obj = extract_date_from_received(msg)
-                        if final_date_obj:
-                             # Update date_str for DB consistency
-                             date_str = str(final_date_obj)
-                             print(f"  Extracted date from Received: {date_str}")
-                             
-                    # 3. Fallback to Now
-                    if not final_date_obj:
-                        print("  Could not extract any date. using NOW.")
-                        final_date_obj = datetime.datetime.now()
-                        
-                    year = str(final_date_obj.year)
-                    month = f"{final_date_obj.month:02d}"
-                        
-                    save_dir = os.path.join("data", "raw", year, month, clean_filename(other_email))
-                    os.makedirs(save_dir, exist_ok=True)
+            # 1. One round-trip per HEADER_BATCH_SIZE messages for the Message-IDs
+            message_ids, sizes = fetch_message_ids(mail, email_uids, folder, budget)
+            
+            # 2. Diff against the local DB
+            missing_uids = []
+            existing_uids = []
+            for uid in email_uids:
+                message_id = message_ids[uid]
+                if email_exists(message_id):
+                    print(f"Skipping {message_id} (Already exists)")
+                    existing_uids.append(uid)
+                else:
+                    missing_uids.append(uid)
                     
-                    filename = f"{clean_filename(subject[:50])}_{int(time.time())}.eml"
-                    filepath = os.path.join(save_dir, filename)
+            # Delete everything already stored locally: compressed UID sets, one expunge per folder
+            if remove_on_exist and existing_uids:
+                try:
+                    total_deleted += delete_uids(mail, existing_uids)
+                    print(f"  Deleted {len(existing_uids)} already stored emails from {folder}.")
+                except Exception as del_err:
+                    print(f"  Deletion failed: {del_err}")
                     
-                    with open(filepath, 'wb') as f:
-                        f.write(raw_email)
-                        
-                    save_email_metadata(message_id, subject, from_str, date_str, filepath)
+            print(f"  {len(missing_uids)} new emails to fetch.")
+            plans.append({
+                'folder': folder,
+                'uidvalidity': uidvalidity,
+                'email_uids': email_uids,
+                'message_ids': message_ids,
+                'sizes': sizes,
+                'missing_uids': missing_uids,
+                'truncated': truncated,
+                'covers_lower_uids': use_checkpoint,
+                'done_uids': set(),
+            })
 
-                    total_processed += 1
-                    consecutive_errors = 0 # Reset on success
-                    
-                except Exception as e:
-                    print(f"Error processing email {i}: {e}")
-                    
-                    # Gather context for logging
-                    err_ctx = {
-                        "Query Since": since_crit,
-                        "Query Before": before_crit,
-                        "Current Folder": folder,
-                        "Message Sequence": i,
-                        "Last DB Date": get_latest_email_date(), # Re-query for specific error context
-                    }
-                    
-                    # Try to add current email details if available
-                    try:
-                        if 'msg_id_str' in locals(): err_ctx["Msg ID"] = msg_id_str
-                        if 'date_str' in locals() and date_str: err_ctx["Email Date"] = date_str
-                        if 'subject' in locals() and subject: err_ctx["Subject"] = subject
-                    except:
-                        pass
+        # Phase 2: fetch only the missing bodies, spread over `workers` connections
+        log_ctx = {"Query Since": since_crit, "Query Before": before_crit}
+        total_processed, quota_stopped = store_missing_bodies(mail, config, plans, budget, batch_size, workers, log_ctx)
                         
-                    log_download_error(e, err_ctx)
-                    
-                    # If it's just a missing body (ghost email), don't count it as a connection/critical failure
-                    if "Invalid message body data" in str(e):
-                        print(f"  Warning: Skipping invalid email {msg_id_str} and continuing...")
-                        #consecutive_errors = 0 # Reset or just don't increment? Resetting is safer to avoid accumulating mixed errors.
-                    else:
-                        consecutive_errors += 1
-                        
-                    if consecutive_errors >= 10:
-                        print("TOO MANY CONSECUTIVE ERRORS (10). Stopping download safely.")
-                        raise RuntimeError("Too many consecutive errors")
-                    continue
+        # Phase 3: Checkpoints
+        checkpoint_plans(plans, month)
         
     except Exception as e:
         print(f"IMAP Error: {e}")
@@ -418,16 +1171,130 @@ def download_emails(limit=None, month=None, since=None, before=None, remove_on_e
         if "Too many consecutive errors" in str(e):
             raise e
     finally:
-        if remove_on_exist:
-            try:
-                print("Expunging deleted messages...")
-                mail.expunge()
-            except Exception as e:
-                print(f"Expunge Error: {e}")
-        mail.logout()
+        if mail:
+            mail.logout()
         
     print(f"Download complete. Processed {total_processed} emails. Deleted {total_deleted} emails.")
+    report = decision_report()
+    if report: print(report)
+    if quota_stopped:
+        raise QuotaExceeded(f"Daily transfer budget reached ({budget.describe()}). Run again tomorrow to continue.")
     return total_processed, total_deleted
 
+def confirm_folders(remove=False, download_missing=False, list_missing=False, batch_size=None, workers=None):
+    """
+    Compare every message on the server with the local index, without any date windows.
+    Per folder: one SELECT, then one FETCH per CONFIRM_RANGE_SIZE messages for the Message-IDs.
+    remove: delete the messages that are stored locally (like download --remove).
+    download_missing: fetch the missing ones through the normal download pipeline.
+    list_missing: print UID, Message-ID and size of every missing message.
+    The folder checkpoints advance as far as everything is stored.
+    Returns (stored, missing, deleted, downloaded).
+    """
+    config = load_config()
+    imap_server = config['imap_server']
+    
+    total_stored = 0
+    total_missing = 0
+    total_deleted = 0
+    total_processed = 0
+    quota_stopped = False
+    
+    # Also charged with the header pass when nothing is downloaded
+    budget = TransferBudget(config)
+    if download_missing:
+        if budget.daily_bytes and budget.remaining() <= 0:
+            raise QuotaExceeded(f"Daily transfer budget used up ({budget.describe()}). Run again tomorrow.")
+    
+    print(f"Connecting to {imap_server}...")
+    mail = None
+    
+    try:
+        mail = connect_imap(config)
+        print("Logged in.")
+        if download_missing:
+            clean_incoming()
+            
+        target_folders = detect_target_folders(mail)
+        
+        known_count = len(load_message_id_index())
+        print(f"Loaded {known_count} known Message-IDs.")
+        
+        plans = []
+        for folder in target_folders:
+            print(f"Confirming folder: {folder}")
+            # Read-only unless we are going to delete
+            typ, data = mail.select(folder, readonly=not remove)
+            if typ != 'OK':
+                print(f"  Skipping {folder} (Selected failed)")
+                continue
+            exists = int(data[0]) if data and data[0] else 0
+            
+            uidvalidity, _ = load_checkpoint(mail, folder)
+            message_ids, sizes = fetch_all_message_ids(mail, exists, budget=budget)
+            email_uids = sorted(message_ids, key=int)
+            
+            stored_uids = []
+            missing_uids = []
+            no_id = 0
+            for uid in email_uids:
+                if not message_ids[uid]:
+                    # Same synthetic ID the download pass uses
+                    message_ids[uid] = f"{uid.decode()}_{folder}_{int(time.time())}"
+                    no_id += 1
+                    missing_uids.append(uid)
+                elif email_exists(message_ids[uid]):
+                    stored_uids.append(uid)
+                else:
+                    missing_uids.append(uid)
+                    
+            print(f"  {len(email_uids)} on server: {len(stored_uids)} stored locally, {len(missing_uids)} missing ({no_id} without Message-ID).")
+            if list_missing:
+                for uid in missing_uids:
+                    print(f"    UID {uid.decode()}  {message_ids[uid]}  ({sizes.get(uid, 0)} bytes)")
+            total_stored += len(stored_uids)
+            total_missing += len(missing_uids)
+                    
+            if remove and stored_uids:
+                try:
+                    total_deleted += delete_uids(mail, stored_uids)
+                    print(f"  Deleted {len(stored_uids)} already stored emails from {folder}.")
+                except Exception as del_err:
+                    print(f"  Deletion failed: {del_err}")
+                    
+            plans.append({
+                'folder': folder,
+                'uidvalidity': uidvalidity,
+                'email_uids': email_uids,
+                'message_ids': message_ids,
+                'sizes': sizes,
+                'missing_uids': missing_uids,
+                'truncated': False,
+                'covers_lower_uids': True, # Every message of the folder
+                'done_uids': set(),
+            })
+            
+        if download_missing:
+            log_ctx = {"Mode": "confirm"}
+            total_processed, quota_stopped = store_missing_bodies(mail, config, plans, budget, batch_size, workers, log_ctx)
+            
+        # Checkpoints stop below the first UID that is still missing
+        checkpoint_plans(plans)
+        
+    except Exception as e:
+        print(f"IMAP Error: {e}")
+        if "Too many consecutive errors" in str(e):
+            raise e
+    finally:
+        if mail:
+            mail.logout()
+            
+    print(f"Confirm complete. Stored: {total_stored}, Missing: {total_missing}, Deleted: {total_deleted}, Downloaded: {total_processed}.")
+    report = decision_report()
+    if report: print(report)
+    if quota_stopped:
+        raise QuotaExceeded(f"Daily transfer budget reached ({budget.describe()}). Run again tomorrow to continue.")
+    return total_stored, total_missing, total_deleted, total_processed
+
 if __name__ == "__main__":
     download_emails(limit=5)
@@ -0,0 +1,61 @@
+import re
+import html
+from db import get_db_connection
+
+# Full-text index over emails (SQLite FTS5, table emails_fts, rowid = emails.id).
+# Body text is only indexed with fts_body: true in config.ini.
+FTS_COLUMNS = ('subject', 'sender', 'recipients', 'attachments', 'body')
+RANK_SQL = "bm25(emails_fts, 10.0, 5.0, 3.0, 3.0, 1.0)" # Subject hits count most
+SNIPPET_SQL = "snippet(emails_fts, -1, char(2), char(3), '...', 12)"
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+# unicode61 keeps a run of Chinese/Japanese/Korean characters as one token, so
+# '发票' would never match '发票已开'. Index (and query) every such character on its own.
+CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+CJK_RE = re.compile(f'([{CJK}])')
+MARK = SNIPPET_START + SNIPPET_END
+# Spaces fts_text put between two CJK characters (possibly around a highlight marker)
+CJK_GAP_RE = re.compile(f'(?<=[{CJK}]) +(?=[{MARK}]?[{CJK}])|(?<=[{CJK}][{MARK}]) +(?=[{MARK}]?[{CJK}])')
+
+def fts_text(text):
+    return CJK_RE.sub(r' \1 ', str(text or ''))
+
+def index_email(email_id, subject, sender, recipients='', attachments=(), body=None):
+    """Add or replace the search entry of one email. body=None keeps the body text already indexed."""
+    conn = get_db_connection()
+    if body is None:
+        existing = conn.execute("SELECT body FROM emails_fts WHERE rowid = ?", (email_id,)).fetchone()
+        body = existing[0] if existing else ''
+    else:
+        body = fts_text(body)
+    conn.execute("DELETE FROM emails_fts WHERE rowid = ?", (email_id,))
+    conn.execute(
+        "INSERT INTO emails_fts (rowid, subject, sender, recipients, attachments, body) VALUES (?, ?, ?, ?, ?, ?)",
+        (email_id, fts_text(subject), fts_text(sender), fts_text(recipients), fts_text(' '.join(attachments)), body))
+    conn.commit()
+
+def build_match_query(query):
+    """
+    Search box text -> FTS5 MATCH expression ('' if there is nothing to search).
+    Every word must match, each as a prefix ('inv' finds 'invoice'); Chinese words
+    match as a phrase of characters.
+    """
+    terms = []
+    for word in query.split():
+        tokens = fts_text(word.replace('"', ' ')).split()
+        if tokens:
+            terms.append('"' + ' '.join(tokens) + '"*')
+    return ' AND '.join(terms)
+
+def _clean_snippet(snippet):
+    return re.sub(' {2,}', ' ', CJK_GAP_RE.sub('', snippet or '')).strip()
+
+def snippet_html(snippet):
+    """Snippet with the matches in <mark>, everything else escaped."""
+    text = html.escape(_clean_snippet(snippet))
+    return text.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+def snippet_text(snippet):
+    """Snippet for the terminal, matches in [brackets]."""
+    return _clean_snippet(snippet).replace(SNIPPET_START, '[').replace(SNIPPET_END, ']')
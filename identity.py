@@ -1,15 +1,43 @@
 import json
 import sqlite3
 import re
+import atexit
+import threading
+import concurrent.futures
+import collections
 import email.utils
 from email.header import decode_header
 import ollama
 from db import get_db_connection
 from config import load_config
 
-# In-Memory Cache
-# Key: email_address, Value: (name, seen_names_list, source)
+# In-Memory Cache: the whole email_identities table, loaded once (load_identities)
+# Key: email_address, Value: (name, seen_names, source). seen_names stays the stored JSON
+# text until the address is looked up (then a list), which keeps a big table small in memory.
 _IDENTITY_CACHE = {}
+_IDENTITY_LOADED = False
+# Addresses changed since the last flush_identities() (write-behind)
+_IDENTITY_DIRTY = set()
+_IDENTITY_LOCK = threading.Lock()
+IDENTITY_FLUSH_EVERY = 500 # Changed identities written per batched upsert
+
+# LLM name tie-breaks: normalized sorted name pair -> normalized winner (table name_decisions,
+# loaded with the identities). New decisions and deferred ties are written by flush_identities().
+_DECISIONS = {}
+_DECISIONS_DIRTY = set()
+_TIES_DIRTY = {} # (email, candidate_name) -> current_name, for `main.py resolve-identities`
+_OLLAMA = {} # Settings and client, made once per process (llm_settings)
+
+# How name ties were settled: rule (name_rule_decision), cache, llm, deferred, fallback (longer name).
+# DECISION_COUNTS is this run (decision_report); the totals are kept in name_decision_counts for `stats`.
+DECISION_METHODS = ('rule', 'cache', 'llm', 'deferred', 'fallback')
+DECISION_COUNTS = collections.Counter()
+_COUNTS_DIRTY = collections.Counter()
+
+# Sender names that describe a role, not a person or company
+GENERIC_NAMES = {'admin', 'administrator', 'info', 'noreply', 'no-reply', 'no_reply', 'donotreply', 'do-not-reply',
+                 'support', 'service', 'services', 'customer service', 'notification', 'notifications', 'notice',
+                 'mailer-daemon', 'postmaster', 'webmaster', 'system', 'team', 'news', 'newsletter', 'hello', 'contact'}
 
 def decode_mime_words(s):
     """Decode MIME encoded words."""
@@ -64,22 +92,135 @@ def contains_chinese(text):
             return True
     return False
 
-def call_ollama_decision(name1, name2):
+def llm_settings():
     """
-    Ask Ollama (qwen3) which name is more descriptive.
-    Returns: The selected name (name1 or name2).
+    Ollama settings from config.ini, read once. identity_llm decides what a name tie that
+    needs the LLM does: 'defer' (default) keeps the current name and records the tie for
+    `main.py resolve-identities`, 'inline' asks right away (waiting at most ollama_timeout
+    seconds), 'off' takes the longer name.
     """
-    if not name1: return name2
-    if not name2: return name1
+    if not _OLLAMA:
+        config = load_config()
+        _OLLAMA['host'] = config.get('ollama_url', 'http://localhost:11434')
+        _OLLAMA['model'] = config.get('ollama_model', 'qwen3')
+        _OLLAMA['timeout'] = float(config.get('ollama_timeout', 30))
+        _OLLAMA['workers'] = int(config.get('ollama_workers', 2))
+        _OLLAMA['mode'] = config.get('identity_llm', 'defer').strip().lower()
+        _OLLAMA['rule_confidence'] = float(config.get('name_rule_confidence', 0.8))
+        _OLLAMA['in_flight'] = 0
+    return _OLLAMA
+
+def ollama_client():
+    settings = llm_settings()
+    if 'client' not in settings:
+        settings['client'] = ollama.Client(host=settings['host'], timeout=settings['timeout'])
+    return settings['client']
+
+def llm_pool():
+    # Inline decisions run here, so a call that times out never blocks the caller
+    settings = llm_settings()
+    if 'pool' not in settings:
+        settings['pool'] = concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers'])
+    return settings['pool']
+
+def normalize_name(name):
+    return ' '.join(str(name or '').split()).casefold()
+
+def decision_key(name1, name2):
+    return tuple(sorted((normalize_name(name1), normalize_name(name2))))
+
+def longer_name(name1, name2):
+    return name1 if len(name1) >= len(name2) else name2
+
+def count_decision(method):
+    DECISION_COUNTS[method] += 1
+    _COUNTS_DIRTY[method] += 1
+
+def decision_report():
+    """One line on how this run's name ties were settled ('' if there were none)."""
+    total = sum(DECISION_COUNTS.values())
+    if not total:
+        return ''
+    parts = [f"{m} {DECISION_COUNTS[m]}" for m in DECISION_METHODS if DECISION_COUNTS[m]]
+    return f"Name decisions: {total} ({', '.join(parts)}; LLM calls {DECISION_COUNTS['llm'] / total:.0%})"
+
+def _bare_name(name):
+    # Without surrounding quotes/space, whitespace collapsed, case folded
+    return normalize_name(str(name or '').strip().strip('"\'').strip())
+
+def _name_form(name):
+    # How tidy a spelling is: not quoted or padded, single spaces, not all lower/upper case
+    score = 0
+    if name != name.strip().strip('"\'').strip():
+        score -= 1
+    if '  ' in name:
+        score -= 1
+    cased = [ch for ch in name if ch.lower() != ch.upper()]
+    if len(cased) > 1 and (all(ch.islower() for ch in cased) or all(ch.isupper() for ch in cased)):
+        score -= 1
+    return score
+
+def _is_junk_name(name):
+    return '@' in name or '=?' in name or not any(ch.isalpha() for ch in name)
+
+def name_rule_decision(current_name, candidate_name):
+    """
+    Deterministic tie-break for the obvious cases, before the cache/LLM.
+    Returns (winner or None, confidence 0..1, rule).
+    """
+    bare_cur, bare_cand = _bare_name(current_name), _bare_name(candidate_name)
     
+    # Same name up to case, quotes and spacing: the tidier spelling (the current one if equal)
+    if bare_cur == bare_cand:
+        winner = candidate_name if _name_form(candidate_name) > _name_form(current_name) else current_name
+        return winner, 1.0, 'same name'
+        
+    # Leftover address / encoded word / no letters at all
+    cur_junk, cand_junk = _is_junk_name(current_name), _is_junk_name(candidate_name)
+    if cur_junk != cand_junk:
+        return (current_name if cand_junk else candidate_name), 0.95, 'junk'
+        
+    # Role names ("Support", "noreply") lose against a real one
+    cur_generic, cand_generic = bare_cur in GENERIC_NAMES, bare_cand in GENERIC_NAMES
+    if cur_generic != cand_generic:
+        return (current_name if cand_generic else candidate_name), 0.9, 'generic'
+        
+    # One name extends the other ("John" / "John Smith", "Acme" / "Acme Ltd."): the longer one
+    shorter, longer = sorted((bare_cur, bare_cand), key=len)
+    if len(shorter) >= 2 and shorter in longer:
+        if not re.search(r'(?<!\w)' + re.escape(shorter) + r'(?!\w)', longer):
+            # Only part of a word: "Ann" in "Anna" or "Joanna Smith" is not the same name
+            return longer_name(current_name, candidate_name), 0.4, 'substring'
+        return (current_name if _bare_name(current_name) == longer else candidate_name), 0.85, 'extends'
+        
+    # Nothing obvious: a weak guess, left to the LLM below the confidence threshold
+    return longer_name(current_name, candidate_name), 0.3, 'longer'
+
+def cached_decision(name1, name2):
+    """name1 or name2 if this pair was decided before (in any run), else None."""
+    if not _IDENTITY_LOADED:
+        load_identities()
+    winner = _DECISIONS.get(decision_key(name1, name2))
+    if winner is None:
+        return None
+    return name1 if normalize_name(name1) == winner else name2
+
+def remember_decision(name1, name2, winner):
+    key = decision_key(name1, name2)
+    with _IDENTITY_LOCK:
+        _DECISIONS[key] = normalize_name(winner)
+        _DECISIONS_DIRTY.add(key)
+
+def ask_ollama(name1, name2):
+    """
+    Ask Ollama (qwen3) which name is more descriptive.
+    Returns: The selected name (name1 or name2), or None if the call failed.
+    """
     prompt = f"Which name is more descriptive for a person or entity? Option A: '{name1}', Option B: '{name2}'. Answer with only 'A' or 'B'."
     
     try:
-        # Use ollama python library with specific host
-        config = load_config()
-        ollama_host = config.get('ollama_url', 'http://localhost:11434')
-        client = ollama.Client(host=ollama_host)
-        response = client.generate(model='qwen3', prompt=prompt)
+        settings = llm_settings()
+        response = ollama_client().generate(model=settings['model'], prompt=prompt)
         answer = response['response'].strip().upper()
             
         # Simple parsing of the answer
@@ -89,11 +230,56 @@ def call_ollama_decision(name1, name2):
             return name2
         else:
             # Fallback: prefer longer name if ambiguous
-            return name1 if len(name1) >= len(name2) else name2
+            return longer_name(name1, name2)
     except Exception as e:
         print(f"Ollama call failed: {e}")
-        # Fallback
-        return name1 if len(name1) >= len(name2) else name2
+        return None
+
+def call_ollama_decision(name1, name2):
+    """
+    Which of two names is more descriptive: cached answer, or ask Ollama (identity_llm: inline).
+    Waits at most ollama_timeout seconds; a late answer is still cached for next time.
+    Falls back to the longer name.
+    """
+    if not name1: return name2
+    if not name2: return name1
+    
+    cached = cached_decision(name1, name2)
+    if cached is not None:
+        count_decision('cache')
+        return cached
+        
+    settings = llm_settings()
+    if settings['in_flight'] >= settings['workers']:
+        # Every slot is busy with calls that timed out: don't queue more behind them
+        count_decision('fallback')
+        return longer_name(name1, name2)
+        
+    def ask():
+        try:
+            winner = ask_ollama(name1, name2)
+            if winner is not None:
+                remember_decision(name1, name2, winner)
+            return winner
+        finally:
+            with _IDENTITY_LOCK:
+                settings['in_flight'] -= 1
+            
+    with _IDENTITY_LOCK:
+        settings['in_flight'] += 1
+    future = llm_pool().submit(ask)
+    try:
+        winner = future.result(timeout=settings['timeout'])
+    except concurrent.futures.TimeoutError:
+        print(f"Ollama did not answer within {settings['timeout']:g}s, using the longer name")
+        winner = None
+    count_decision('llm' if winner is not None else 'fallback')
+    return winner if winner is not None else longer_name(name1, name2)
+
+def defer_decision(email_addr, current_name, candidate_name):
+    """Record a tie for `main.py resolve-identities` (identity_llm: defer)."""
+    with _IDENTITY_LOCK:
+        _TIES_DIRTY[(email_addr, candidate_name)] = current_name
 
 def is_valid_name(name, email_addr):
     """
@@ -122,6 +308,7 @@ def get_better_name(current_name, candidate_name, email_addr, current_source=0,
     If sources equal:
       - Valid > Invalid
       - Chinese > Non-Chinese
+      - Obvious cases by rule (name_rule_decision)
       - LLM > Length
     """
     # 0. Source Check (Strict Priority for Sent Names)
@@ -155,66 +342,120 @@ def get_better_name(current_name, candidate_name, email_addr, current_source=0,
     if curr_cn and not cand_cn:
         return current_name
         
-    # 3. LLM Decision (if both are non-chinese or both are chinese)
-    # Only call LLM if they are sufficiently different
+    # 3. Rules for the obvious cases (case-only changes, quotes, "John" vs "John Smith", ...)
+    winner, confidence, rule = name_rule_decision(current_name, candidate_name)
+    if confidence >= llm_settings()['rule_confidence']:
+        count_decision('rule')
+        return winner
+        
+    # 4. LLM Decision (if both are non-chinese or both are chinese)
+    # Asked once per name pair, ever (name_decisions)
+    decided = cached_decision(current_name, candidate_name)
+    if decided is not None:
+        count_decision('cache')
+        return decided
+        
+    mode = llm_settings()['mode']
+    if mode == 'off':
+        count_decision('fallback')
+        return longer_name(current_name, candidate_name)
+    if mode != 'inline':
+        # Never wait for the model here: keep the current name until resolve-identities
+        count_decision('deferred')
+        defer_decision(email_addr, current_name, candidate_name)
+        return current_name
+        
     print(f"Asking LLM: '{current_name}' vs '{candidate_name}'")
     return call_ollama_decision(current_name, candidate_name)
 
+def load_identities():
+    """Read the whole email_identities table into the memory cache (once per process)."""
+    global _IDENTITY_LOADED
+    with _IDENTITY_LOCK:
+        if _IDENTITY_LOADED:
+            return
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT email, name, seen_names, name_source FROM email_identities")
+        for addr, name, seen_json, source in c.fetchall():
+            # Changes not flushed yet are newer than the table
+            if addr not in _IDENTITY_CACHE:
+                _IDENTITY_CACHE[addr] = (name, seen_json, source if source is not None else 0)
+        c.execute("SELECT name_a, name_b, winner FROM name_decisions")
+        for name_a, name_b, winner in c.fetchall():
+            _DECISIONS.setdefault((name_a, name_b), winner)
+        conn.close()
+        _IDENTITY_LOADED = True
+
 def get_cached_identity_full(email):
-    """Get name, seen_names, and name_source from DB or Memory Cache."""
-    global _IDENTITY_CACHE
-    
-    if email in _IDENTITY_CACHE:
-        return _IDENTITY_CACHE[email]
+    """Get name, seen_names, and name_source from the Memory Cache (None, [], 0 if never seen)."""
+    if not _IDENTITY_LOADED:
+        load_identities()
         
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT name, seen_names, name_source FROM email_identities WHERE email = ?", (email,))
-    row = c.fetchone()
-    conn.close()
-    
-    if row:
-        name = row[0]
+    entry = _IDENTITY_CACHE.get(email)
+    if entry is None:
+        return None, [], 0
+        
+    name, seen, source = entry
+    if not isinstance(seen, list):
         try:
-            seen = json.loads(row[1]) if row[1] else []
+            seen = json.loads(seen) if seen else []
         except:
             seen = []
-        source = row[2] if row[2] is not None else 0
-        
-        # Populate Cache
         _IDENTITY_CACHE[email] = (name, seen, source)
-        return name, seen, source
-        
-    return None, [], 0
+    return name, seen, source
 
 def update_cached_identity(email, name, seen_names=None, name_source=0):
-    """Update DB and Memory Cache."""
-    global _IDENTITY_CACHE
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    
+    """Update the Memory Cache; the DB is written in batches by flush_identities()."""
     # Ensure current seen_names/source are preserved or updated if passed as None (though caller usually passes full)
     # But since we use cache, we assume caller has latest.
     if seen_names is None:
         seen_names = []
-            
-    seen_json = json.dumps(seen_names)
-    
-    c.execute('''
-        INSERT INTO email_identities (email, name, seen_names, name_source) 
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(email) DO UPDATE SET 
-            name=excluded.name, 
-            seen_names=excluded.seen_names, 
-            name_source=excluded.name_source,
-            updated_at=CURRENT_TIMESTAMP
-    ''', (email, name, seen_json, name_source))
-    conn.commit()
-    conn.close()
-    
-    # Update Cache
+        
     _IDENTITY_CACHE[email] = (name, seen_names, name_source)
+    _IDENTITY_DIRTY.add(email)
+    if len(_IDENTITY_DIRTY) >= IDENTITY_FLUSH_EVERY:
+        flush_identities()
+
+def flush_identities():
+    """Write all changed identities (and name decisions, deferred ties) in one batched upsert (also run at exit)."""
+    with _IDENTITY_LOCK:
+        if not (_IDENTITY_DIRTY or _DECISIONS_DIRTY or _TIES_DIRTY or _COUNTS_DIRTY):
+            return
+        rows = []
+        for addr in _IDENTITY_DIRTY:
+            name, seen, source = _IDENTITY_CACHE[addr]
+            rows.append((addr, name, seen if isinstance(seen, str) else json.dumps(seen), source))
+        _IDENTITY_DIRTY.clear()
+        decisions = [key + (_DECISIONS[key],) for key in _DECISIONS_DIRTY]
+        _DECISIONS_DIRTY.clear()
+        ties = [key + (current,) for key, current in _TIES_DIRTY.items()]
+        _TIES_DIRTY.clear()
+        counts = list(_COUNTS_DIRTY.items())
+        _COUNTS_DIRTY.clear()
+        
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.executemany('''
+            INSERT INTO email_identities (email, name, seen_names, name_source) 
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET 
+                name=excluded.name, 
+                seen_names=excluded.seen_names, 
+                name_source=excluded.name_source,
+                updated_at=CURRENT_TIMESTAMP
+        ''', rows)
+        c.executemany("INSERT OR REPLACE INTO name_decisions (name_a, name_b, winner) VALUES (?, ?, ?)", decisions)
+        c.executemany("INSERT OR REPLACE INTO identity_ties (email, candidate_name, current_name) VALUES (?, ?, ?)", ties)
+        c.executemany('''
+            INSERT INTO name_decision_counts (method, count) VALUES (?, ?)
+            ON CONFLICT(method) DO UPDATE SET count = count + excluded.count
+        ''', counts)
+        conn.commit()
+        conn.close()
+
+# Registered after db's own atexit hook, so this runs first, while the connection is open
+atexit.register(flush_identities)
 
 def process_identity(email_addr, raw_name, source_type=0):
     """
@@ -268,3 +509,71 @@ def process_identity(email_addr, raw_name, source_type=0):
         
         # Save update (name + seen list + source)
         update_cached_identity(email_addr, cached_name, seen_names, cached_source)
+
+def resolve_identities(workers=None):
+    """
+    `main.py resolve-identities`: ask the LLM about every tie deferred by downloads and
+    concentration (identity_llm: defer), ollama_workers calls at a time, cache the answers
+    and apply them to the identities whose name has not changed since.
+    """
+    flush_identities()
+    settings = llm_settings()
+    workers = workers or settings['workers']
+    
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT email, current_name, candidate_name FROM identity_ties ORDER BY created_at")
+    ties = c.fetchall()
+    if not ties:
+        print("No deferred name decisions.")
+        return
+        
+    def settled(tie):
+        # Rules first (ties recorded before a rule existed), then earlier LLM answers
+        winner, confidence, rule = name_rule_decision(tie['current_name'], tie['candidate_name'])
+        if confidence >= settings['rule_confidence']:
+            return winner, 'rule'
+        return cached_decision(tie['current_name'], tie['candidate_name']), 'cache'
+        
+    pairs = {}
+    for tie in ties:
+        if settled(tie)[0] is None:
+            pairs.setdefault(decision_key(tie['current_name'], tie['candidate_name']), (tie['current_name'], tie['candidate_name']))
+    print(f"{len(ties)} deferred name decisions, {len(pairs)} name pairs to ask ({workers} at a time)...")
+    
+    asked = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Every call is limited by ollama_timeout (client side)
+        futures = {pool.submit(ask_ollama, *pair): pair for pair in pairs.values()}
+        for future in concurrent.futures.as_completed(futures):
+            pair = futures[future]
+            winner = future.result()
+            if winner is not None:
+                remember_decision(pair[0], pair[1], winner)
+                count_decision('llm')
+            asked += 1
+            if asked % 50 == 0:
+                print(f"  {asked}/{len(pairs)} asked...")
+                flush_identities()
+    
+    resolved = 0
+    changed = 0
+    asked_keys = set(pairs)
+    for tie in ties:
+        winner, method = settled(tie)
+        if winner is None:
+            continue # Failed, stays for the next run
+        if decision_key(tie['current_name'], tie['candidate_name']) not in asked_keys:
+            count_decision(method)
+        resolved += 1
+        name, seen_names, source = get_cached_identity_full(tie['email'])
+        if name == tie['current_name'] and winner == tie['candidate_name']:
+            print(f"Updating identity for {tie['email']}: {name} -> {winner}")
+            update_cached_identity(tie['email'], winner, seen_names, source)
+            changed += 1
+        c.execute("DELETE FROM identity_ties WHERE email = ? AND candidate_name = ?", (tie['email'], tie['candidate_name']))
+    conn.commit()
+    flush_identities()
+    print(f"Resolved {resolved}/{len(ties)} deferred name decisions, {changed} names changed.")
+    report = decision_report()
+    if report: print(report)
@@ -2,7 +2,8 @@ import argparse
 import sys
 from db import init_db
 
-from downloader import download_emails
+from downloader import download_emails, confirm_folders, BACKFILLS
+from quota import QuotaExceeded
 import datetime
 import email.utils
 
@@ -36,6 +37,7 @@ def handle_clean(args):
             c = conn.cursor()
             # Clear concentrated_emails table
             c.execute("DELETE FROM concentrated_emails")
+            c.execute("DELETE FROM concentrated_items")
             # Reset emails status
             c.execute("UPDATE emails SET is_concentrated = 0, concentrated_id = NULL")
             conn.commit()
@@ -46,6 +48,9 @@ def handle_clean(args):
              
     else:
         print("Cleaning ALL local data...")
+        # The shared DB connection holds the file open (Windows can't delete it otherwise)
+        from db import close_db_connection
+        close_db_connection()
         if os.path.exists("data"):
             try:
                 shutil.rmtree("data")
@@ -100,8 +105,32 @@ def handle_download(args):
         # `if 2011-08 > 2011-08`: False. No jump.
         # So it works naturally.
         
-        from db import get_latest_email_date
-        latest_str = get_latest_email_date()
+        total_downloaded = 0
+        total_deleted = 0
+        global_limit = args.limit
+        
+        # UID Checkpoints: pick up everything that arrived since the last run with
+        # one UID SEARCH per folder, then skip months that are already fully synced.
+        # With --remove every month must be visited, so nothing is skipped.
+        from db import get_latest_email_date, get_fully_synced_months
+        synced_months = set()
+        if not args.remove:
+            print("Checking UID checkpoints for new mail...")
+            try:
+                count, _ = download_emails(limit=global_limit, remove_on_exist=False, batch_size=args.fetch_batch_size, workers=args.workers, checkpoint_only=True)
+                total_downloaded += count
+            except QuotaExceeded as e:
+                print(f"Batch stopping: {e}")
+                return
+            except RuntimeError as e:
+                print(f"Batch stopping due to error: {e}")
+                return
+            synced_months = get_fully_synced_months()
+            if synced_months:
+                print(f"{len(synced_months)} months already fully synced. They will be skipped.")
+        
+        # Legacy date-based jump, only for databases without sync checkpoints
+        latest_str = get_latest_email_date() if not synced_months else None
         if latest_str and not args.start_from:
             try:
                 lat_date = email.utils.parsedate_to_datetime(latest_str).date()
@@ -128,19 +157,23 @@ def handle_download(args):
 
         print(f"Starting Batch Download from {current_iter.strftime('%Y-%m')} to {end_date_str}...")
         
-        total_downloaded = 0
-        total_deleted = 0
-        global_limit = args.limit
-        
         # loop condition now unified: run while month-start is <= end_date
         while current_iter <= end_date:
+            month_str = current_iter.strftime("%Y-%m")
+            if current_iter.month == 12:
+                next_iter = datetime.date(current_iter.year + 1, 1, 1)
+            else:
+                next_iter = datetime.date(current_iter.year, current_iter.month + 1, 1)
+                
+            if month_str in synced_months:
+                current_iter = next_iter
+                continue
 
             # Check Global Limit
             if global_limit and total_downloaded >= global_limit:
                 print(f"Global limit of {global_limit} reached. Stopping batch.")
                 break
                 
-            month_str = current_iter.strftime("%Y-%m")
             print(f"\n=== Processing Month: {month_str} | Downloaded: {total_downloaded}/{global_limit if global_limit else 'Inf'} | Deleted: {total_deleted} ===")
             
             # Calculate remaining limit for this batch
@@ -150,31 +183,54 @@ def handle_download(args):
             
             # Increment Month
             try:
-                 count, del_count = download_emails(limit=current_batch_limit, month=month_str, remove_on_exist=args.remove)
+                 count, del_count = download_emails(limit=current_batch_limit, month=month_str, remove_on_exist=args.remove, batch_size=args.fetch_batch_size, workers=args.workers)
                  total_downloaded += count
                  total_deleted += del_count
+            except QuotaExceeded as e:
+                 print(f"Batch stopping: {e}")
+                 break
             except RuntimeError as e:
                  print(f"Batch stopping due to error: {e}")
                  break
             except Exception as e:
                  print(f"Batch interrupt: {e}")
                  break
-            
-            if current_iter.month == 12:
-                current_iter = datetime.date(current_iter.year + 1, 1, 1)
-            else:
-                current_iter = datetime.date(current_iter.year, current_iter.month + 1, 1)
+
+            current_iter = next_iter
                 
     else:
         # Standard Single Mode
-        download_emails(limit=args.limit, month=args.month, since=args.since, before=args.before, remove_on_exist=args.remove)
+        try:
+            download_emails(limit=args.limit, month=args.month, since=args.since, before=args.before, remove_on_exist=args.remove, batch_size=args.fetch_batch_size, workers=args.workers)
+        except QuotaExceeded as e:
+            print(f"Stopping: {e}")
+
+def handle_confirm(args):
+    # Second pass over the whole mailbox: headers only, no date windows
+    try:
+        confirm_folders(remove=args.remove, download_missing=args.download_missing, list_missing=args.list, batch_size=args.fetch_batch_size, workers=args.workers)
+    except QuotaExceeded as e:
+        print(f"Stopping: {e}")
+
+def handle_compress_raw(args):
+    from storage import compress_raw_store
+    compress_raw_store(method=args.method, jobs=args.jobs)
+
+def handle_backfill(args):
+    from downloader import run_pending_backfills
+    run_pending_backfills(chunk_size=args.chunk_size, only=args.name)
 
 def handle_concentrate(args):
     print("Starting concentration...")
-    concentrate_emails(start_year_arg=args.start_year, end_year_arg=args.end_year)
+    concentrate_emails(start_year_arg=args.start_year, end_year_arg=args.end_year, jobs=args.jobs, pack=args.pack,
+                       incremental=args.incremental, merge_deltas=args.merge_deltas)
+
+def handle_resolve_identities(args):
+    from identity import resolve_identities
+    resolve_identities(workers=args.workers)
 
 def handle_search(args):
-    search_emails(args.query)
+    search_emails(args.query, args.limit)
 
 def handle_stats(args):
     generate_statistics()
@@ -194,13 +250,28 @@ def main():
     parser_download.add_argument('--start-from', type=str, help='Start month for batch mode (YYYY-MM). Overrides start-year.')
     parser_download.add_argument('--batch-mode', action='store_true', help='Iterate month-by-month from Start Year to Now')
     parser_download.add_argument('--remove', action='store_true', help='Remove email from server if it already exists locally')
+    parser_download.add_argument('--workers', type=int, help='Parallel IMAP connections for fetching bodies (Default: download_workers in config.ini or 1)')
+    parser_download.add_argument('--fetch-batch-size', type=int, help='Messages per UID FETCH command (Default: fetch_batch_size in config.ini or 50)')
+    
+    # Confirm command
+    parser_confirm = subparsers.add_parser('confirm', help='Compare all server emails with local storage (headers only)')
+    parser_confirm.add_argument('--remove', action='store_true', help='Remove emails from server that already exist locally')
+    parser_confirm.add_argument('--download-missing', action='store_true', help='Download the emails that are not stored locally yet')
+    parser_confirm.add_argument('--list', action='store_true', help='Print every missing email (UID, Message-ID, size)')
+    parser_confirm.add_argument('--workers', type=int, help='Parallel IMAP connections for --download-missing')
+    parser_confirm.add_argument('--fetch-batch-size', type=int, help='Messages per UID FETCH command for --download-missing')
     
     parser_concentrate = subparsers.add_parser('concentrate', help='Concentrate emails')
     parser_concentrate.add_argument('--start-year', type=int, help='Start year (inclusive)')
     parser_concentrate.add_argument('--end-year', type=int, help='End year (inclusive)')
+    parser_concentrate.add_argument('--jobs', type=int, help='Archives built in parallel processes (Default: concentrate_jobs in config.ini, or 1)')
+    parser_concentrate.add_argument('--pack', choices=['exact', 'tight'], help="Archive packing: 'exact' sizes (default) or 'tight' (real titles, scans unknown emails first)")
+    parser_concentrate.add_argument('--incremental', action='store_true', help='Add new mail as new archives of its group (the last one a delta) instead of a fresh series')
+    parser_concentrate.add_argument('--merge-deltas', action='store_true', help='Incremental, and first repack the delta archives not uploaded yet into full-size ones')
     
-    parser_search = subparsers.add_parser('search', help='Search concentrated emails')
-    parser_search.add_argument('--query', type=str, required=True, help='Search query')
+    parser_search = subparsers.add_parser('search', help='Full-text search of downloaded emails')
+    parser_search.add_argument('--query', type=str, required=True, help='Search query (every word must match, as a prefix)')
+    parser_search.add_argument('--limit', type=int, default=50, help='Max results (default: 50)')
     
     parser_clean = subparsers.add_parser('clean', help='Clean local data')
     parser_clean.add_argument('--concentration', action='store_true', help='Clean only concentration data (keep raw emails)')
@@ -212,10 +283,23 @@ def main():
 
     parser_stats = subparsers.add_parser('stats', help='Show email statistics')
     
+    parser_backfill = subparsers.add_parser('backfill', help='Run pending data migrations (resumable)')
+    parser_backfill.add_argument('--chunk-size', type=int, default=1000, help='Rows per transaction (Default: 1000)')
+    parser_backfill.add_argument('--name', action='append', choices=list(BACKFILLS), help=f"Only run this backfill ({', '.join(BACKFILLS)}). Repeatable.")
+    
+    parser_resolve = subparsers.add_parser('resolve-identities', help='Ask the LLM about the name decisions deferred by download/concentrate')
+    parser_resolve.add_argument('--workers', type=int, help='Parallel LLM calls (Default: ollama_workers in config.ini, or 2)')
+    
+    parser_compress = subparsers.add_parser('compress-raw', help='Compress existing raw emails (data/raw)')
+    parser_compress.add_argument('--method', choices=['gzip', 'zstd'], help='Compression (Default: raw_compression in config.ini)')
+    parser_compress.add_argument('--jobs', type=int, help='Parallel processes (Default: CPU count)')
+    
     args = parser.parse_args()
 
     if args.command == 'download':
         handle_download(args)
+    elif args.command == 'confirm':
+        handle_confirm(args)
     elif args.command == 'concentrate':
         handle_concentrate(args)
     elif args.command == 'upload':
@@ -231,6 +315,12 @@ def main():
         handle_flush(args)
     elif args.command == 'stats':
         handle_stats(args)
+    elif args.command == 'backfill':
+        handle_backfill(args)
+    elif args.command == 'compress-raw':
+        handle_compress_raw(args)
+    elif args.command == 'resolve-identities':
+        handle_resolve_identities(args)
     else:
         parser.print_help()
 
@@ -0,0 +1,145 @@
+import datetime
+import threading
+import time
+from config import load_config
+from db import get_db_connection
+
+# 163.com's IMAP quota is ~10GB/day and resets at 12:00 AM CST (UTC+8).
+# Downloads and uploads count against the same budget.
+CST = datetime.timezone(datetime.timedelta(hours=8))
+DAILY_QUOTA_MB = 9500 # Stop a little before the real limit
+RATE_BURST_SECONDS = 2 # Token bucket holds this many seconds worth of bytes
+
+class QuotaExceeded(Exception):
+    """Raised when today's transfer budget is used up (or the server said so)."""
+    pass
+
+def cst_day(now=None):
+    """The quota day ('YYYY-MM-DD') in China Standard Time."""
+    now = now or datetime.datetime.now(CST)
+    return now.astimezone(CST).strftime('%Y-%m-%d')
+
+def get_bytes_used(day=None):
+    """Total bytes recorded for a CST day (download + upload)."""
+    day = day or cst_day()
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT COALESCE(SUM(bytes), 0) FROM transfer_ledger WHERE day = ?", (day,))
+        return c.fetchone()[0]
+    finally:
+        conn.close()
+
+def record_transfer(nbytes, direction, day=None):
+    """Add bytes to the persistent ledger. direction: 'download' or 'upload'."""
+    day = day or cst_day()
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO transfer_ledger (day, direction, bytes) VALUES (?, ?, ?)
+            ON CONFLICT(day, direction) DO UPDATE SET
+                bytes=bytes + excluded.bytes,
+                updated_at=CURRENT_TIMESTAMP
+        ''', (day, direction, int(nbytes)))
+        conn.commit()
+    finally:
+        conn.close()
+
+class TransferBudget:
+    """
+    Daily byte budget plus a token-bucket rate limiter.
+
+    try_reserve() is called with a message's RFC822.SIZE (or a file size) before the
+    transfer, so the day's budget is spent on whole messages only. commit() writes the
+    bytes to the ledger once the transfer succeeded, release() gives them back.
+    throttle() may be called from several fetch threads; they share one bucket.
+    """
+
+    def __init__(self, config=None):
+        if config is None:
+            config = load_config()
+        daily_mb = float(config.get('daily_quota_mb', DAILY_QUOTA_MB))
+        rate_kbps = float(config.get('rate_limit_kbps', 0))
+
+        self.daily_bytes = int(daily_mb * 1024 * 1024) # 0 = unlimited
+        self.rate = rate_kbps * 1024 # Bytes per second, 0 = unlimited
+        self.capacity = max(self.rate * RATE_BURST_SECONDS, 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.day = cst_day()
+        self.used = get_bytes_used(self.day)
+        self.reserved = 0
+
+    def _roll_day(self):
+        today = cst_day()
+        if today != self.day:
+            print(f"Transfer quota day rolled over to {today} (CST).")
+            self.day = today
+            self.used = get_bytes_used(today)
+            self.reserved = 0
+
+    def remaining(self):
+        if not self.daily_bytes:
+            return None
+        with self.lock:
+            self._roll_day()
+            return max(0, self.daily_bytes - self.used - self.reserved)
+
+    def try_reserve(self, nbytes):
+        """Reserve bytes for one whole transfer. False if it does not fit in today's budget."""
+        with self.lock:
+            self._roll_day()
+            if self.daily_bytes and self.used + self.reserved + nbytes > self.daily_bytes:
+                return False
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.lock:
+            self.reserved = max(0, self.reserved - nbytes)
+
+    def commit(self, nbytes, direction, reserved=None):
+        """Record a finished transfer. `reserved` is what try_reserve() got (defaults to nbytes)."""
+        if reserved is None:
+            reserved = nbytes
+        with self.lock:
+            self.reserved = max(0, self.reserved - reserved)
+            self.used += nbytes
+            day = self.day
+        record_transfer(nbytes, direction, day)
+
+    def mark_exhausted(self, direction):
+        """The server refused with a quota error: book the rest of today's budget so later runs stop early."""
+        with self.lock:
+            self._roll_day()
+            left = self.daily_bytes - self.used if self.daily_bytes else 0
+            self.used += max(0, left)
+            day = self.day
+        if left > 0:
+            record_transfer(left, direction, day)
+
+    def throttle(self, nbytes):
+        """Block until the rate limit allows nbytes more."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def describe(self):
+        if not self.daily_bytes:
+            return "unlimited"
+        left = self.remaining()
+        return f"{left / (1024*1024):.0f}MB of {self.daily_bytes / (1024*1024):.0f}MB left today (CST {self.day})"
+
+def is_quota_error(e):
+    text = str(e).lower()
+    return "limit exceed" in text or "quota" in text
@@ -15,6 +15,9 @@ def reset_all():
         
         print("Truncating concentrated_emails...")
         c.execute("DELETE FROM concentrated_emails")
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'concentrated_items'")
+        if c.fetchone():
+            c.execute("DELETE FROM concentrated_items")
         
         print("Resetting emails status...")
         c.execute("UPDATE emails SET is_concentrated = 0, concentrated_id = NULL")
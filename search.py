@@ -1,52 +1,48 @@
 import argparse
 import sqlite3
-import json
-from db import get_db_connection
+from db import get_db_connection, find_email_archives
+from fts import build_match_query, snippet_text, RANK_SQL, SNIPPET_SQL
 
-def search_emails(query):
+def search_emails(query, limit=50):
     print(f"Searching for '{query}'...")
+    match = build_match_query(query)
+    if not match:
+        print("No matches found.")
+        return
+        
     conn = get_db_connection()
     c = conn.cursor()
     
-    # We'll just fetch all and filter in python for simplicity given it's a JSON field
-    # For large datasets, SQLite's json_extract or a proper FTS would be better,
-    # but for this "test run" simplicity is key.
-    c.execute("SELECT * FROM concentrated_emails")
+    # Full-text index (subject, sender, recipients, attachment names, body), best match first.
+    c.execute(f"""
+        SELECT e.id, e.date, e.subject, e.sender, {SNIPPET_SQL} AS snippet
+        FROM emails_fts
+        JOIN emails e ON e.id = emails_fts.rowid
+        WHERE emails_fts MATCH ?
+        ORDER BY {RANK_SQL}
+        LIMIT ?
+    """, (match, limit))
     rows = c.fetchall()
     
-    found_count = 0
-    query = query.lower()
-    
     for row in rows:
-        metadata_json = row['content_metadata']
-        try:
-            metadata = json.loads(metadata_json)
-        except:
-            continue
-            
-        matches_in_file = []
-        for item in metadata:
-            subject = item.get('subject', '').lower()
-            date = item.get('date', '')
-            
-            if query in subject or query in date.lower():
-                matches_in_file.append(item)
-        
-        if matches_in_file:
-            print(f"Found {len(matches_in_file)} matches in '{row['file_path']}':")
-            for m in matches_in_file:
-                print(f"  - [{m['date']}] {m['subject']}")
-            print("-" * 40)
-            found_count += 1
+        print(f"  - [{row['date']}] {row['subject']}  ({row['sender']})")
+        print(f"      {snippet_text(row['snippet'])}")
+        # Concentrated emails also show the archive(s) they were bundled into
+        for item in find_email_archives(row['id']):
+            part = f" (part {item['part_index']}/{item['total_parts']})" if item['part_index'] else ""
+            print(f"      in '{item['file_path']}'{part}")
             
-    if found_count == 0:
+    if not rows:
         print("No matches found.")
+    elif len(rows) == limit:
+        print(f"(showing the best {limit} matches, use --limit for more)")
         
     conn.close()
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Search Concentrated Emails")
-    parser.add_argument('--query', required=True, help='Keyword to search in metadata')
+    parser = argparse.ArgumentParser(description="Search Emails")
+    parser.add_argument('--query', required=True, help='Words to search (prefix match)')
+    parser.add_argument('--limit', type=int, default=50, help='Max results')
     args = parser.parse_args()
     
-    search_emails(args.query)
+    search_emails(args.query, args.limit)
@@ -1,8 +1,8 @@
 import os
 import sqlite3
 import datetime
-import email.utils
-from db import get_db_connection
+from db import get_db_connection, backfill_pending
+from storage import RAW_DIR
 
 def format_size(size_bytes):
     """Format bytes into human readable string."""
@@ -14,71 +14,43 @@ def format_size(size_bytes):
 
 def generate_statistics():
     """
-    Connect to DB, fetch all emails, calculate stats by year.
-    Priority for Year:
-    1. Parse from 'date' column.
-    2. Parse from 'local_path' (data/raw/YYYY/...).
+    Connect to DB and calculate stats by year with one indexed GROUP BY
+    (year and size_bytes are parsed at download time).
     """
+    if backfill_pending('email_columns'):
+        from downloader import backfill_email_columns
+        backfill_email_columns()
+        
     conn = get_db_connection()
     try:
         c = conn.cursor()
         print("Fetching email metadata...")
-        c.execute("SELECT id, date, local_path FROM emails")
+        c.execute("""
+            SELECT year, COUNT(*) AS cnt, COALESCE(SUM(size_bytes), 0) AS size
+            FROM emails
+            GROUP BY year
+        """)
         rows = c.fetchall()
         
         stats = {} # { year: {'count': 0, 'size': 0} }
         total_count = 0
         total_size = 0
         
-        print(f"Analyzing {len(rows)} emails...")
-        
         for row in rows:
-            uid, date_str, local_path = row
+            year = str(row['year']) if row['year'] is not None else "Unknown"
+            stats[year] = {'count': row['cnt'], 'size': row['size']}
+            total_count += row['cnt']
+            total_size += row['size']
             
-            # Determine Year
-            year = "Unknown"
-            
-            # Method 1: Path (Most reliable since downloader structures it)
-            # data/raw/2013/05/...
-            if local_path and "data" in local_path:
-                parts = local_path.replace("\\", "/").split("/")
-                # Find 'raw' index and next is year
+        # On disk: smaller than total_size with raw_compression
+        disk_size = 0
+        for root, _, files in os.walk(RAW_DIR):
+            for name in files:
                 try:
-                    if "raw" in parts:
-                        idx = parts.index("raw")
-                        if idx + 1 < len(parts):
-                            year_candidate = parts[idx+1]
-                            if year_candidate.isdigit() and len(year_candidate) == 4:
-                                year = year_candidate
-                except:
+                    disk_size += os.path.getsize(os.path.join(root, name))
+                except OSError:
                     pass
             
-            # Method 2: Date String Fallback
-            if year == "Unknown" and date_str:
-                try:
-                    dt = email.utils.parsedate_to_datetime(date_str)
-                    year = str(dt.year)
-                except:
-                    pass
-            
-            # Calculate Size
-            size = 0
-            if local_path and os.path.exists(local_path):
-                try:
-                    size = os.path.getsize(local_path)
-                except:
-                    pass
-            
-            # Update Stats
-            if year not in stats:
-                stats[year] = {'count': 0, 'size': 0}
-            
-            stats[year]['count'] += 1
-            stats[year]['size'] += size
-            
-            total_count += 1
-            total_size += size
-            
         # Display Results
         print("\n=== Email Statistics by Year ===\n")
         print(f"{'Year':<10} | {'Count':<10} | {'Size':<15}")
@@ -92,6 +64,16 @@ def generate_statistics():
             
         print("-" * 40)
         print(f"{'TOTAL':<10} | {total_count:<10} | {format_size(total_size):<15}")
+        if disk_size and disk_size != total_size:
+            print(f"On disk: {format_size(disk_size)} (compression / deduplication)")
+            
+        # How sender name ties were settled, all runs (LLM share = Ollama calls)
+        c.execute("SELECT method, count FROM name_decision_counts WHERE count > 0")
+        decisions = {r['method']: r['count'] for r in c.fetchall()}
+        total_decisions = sum(decisions.values())
+        if total_decisions:
+            parts = ", ".join(f"{m} {n}" for m, n in sorted(decisions.items(), key=lambda kv: -kv[1]))
+            print(f"Name decisions: {total_decisions} ({parts}; LLM calls {decisions.get('llm', 0) / total_decisions:.0%})")
         print("\n")
         
     finally:
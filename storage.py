@@ -0,0 +1,585 @@
+import os
+import io
+import glob
+import gzip
+import shutil
+import struct
+import hashlib
+import tempfile
+import base64
+import copy
+import binascii
+import random
+import concurrent.futures
+import re
+import html
+import email.policy
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser, BytesParser
+from email.mime.application import MIMEApplication
+
+try:
+    import zstandard # Optional: pip install zstandard
+except ImportError:
+    zstandard = None
+
+RAW_DIR = os.path.join("data", "raw")
+INCOMING_DIR = os.path.join(RAW_DIR, ".incoming") # Partial downloads, renamed into place when complete
+OBJECTS_DIR = os.path.join(RAW_DIR, "objects") # Content-addressed store (raw_storage: cas)
+
+MAX_HEADER_BYTES = 1024 * 1024 # Stop reading a header block after 1MB (broken/binary files)
+HASH_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+BASE64_BLOCK = 57 * 16384 # Whole base64 lines (57 bytes -> 76 chars), ~1MB per write
+
+# raw_compression (config.ini) -> file suffix appended to .eml
+RAW_SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+FTS_BODY_MAX_MESSAGE = 16 * 1024 * 1024 # Bigger emails are indexed without their body text
+FTS_BODY_MAX_CHARS = 64 * 1024
+ZSTD_LEVEL = 10
+
+def new_temp_path():
+    """Create an empty temp file under data/raw/.incoming and return its path."""
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=INCOMING_DIR, suffix=".eml.part")
+    os.close(fd)
+    return path
+
+def write_temp(data):
+    """Write bytes to a new temp file and return its path."""
+    path = new_temp_path()
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def discard_temp(path):
+    try:
+        if path and os.path.exists(path):
+            os.remove(path)
+    except OSError:
+        pass
+
+def clean_incoming():
+    """Remove partial downloads left behind by an interrupted run."""
+    for path in glob.glob(os.path.join(INCOMING_DIR, "*.part")):
+        discard_temp(path)
+
+def commit_temp(temp_path, final_path):
+    """Move a finished temp file to its final location under data/raw."""
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(temp_path, final_path)
+    return final_path
+
+def split_raw_ext(path):
+    """('dir/name', '.eml.gz') for raw email paths, so the compression suffix stays at the end."""
+    for ext in ('.eml.gz', '.eml.zst', '.eml'):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+def unique_path(path):
+    """Append _1, _2... to the file name until it does not exist (never overwrite another email)."""
+    if not os.path.exists(path):
+        return path
+    base, ext = split_raw_ext(path)
+    n = 1
+    while os.path.exists(f"{base}_{n}{ext}"):
+        n += 1
+    return f"{base}_{n}{ext}"
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cas_path(digest, suffix=''):
+    """data/raw/objects/ab/cd/<digest>.eml: two levels of 256 shards keep every directory small."""
+    return os.path.join(OBJECTS_DIR, digest[:2], digest[2:4], f"{digest}.eml{suffix}")
+
+def commit_temp_cas(temp_path, digest, suffix=''):
+    """
+    Move a temp file into the content-addressed store (digest = SHA-256 of the uncompressed bytes).
+    If the same bytes are already stored, in any compression, the temp file is dropped instead.
+    Returns (final_path, written).
+    """
+    for existing_suffix in RAW_SUFFIXES.values():
+        existing = cas_path(digest, existing_suffix)
+        if os.path.exists(existing):
+            discard_temp(temp_path)
+            return existing, False
+    return commit_temp(temp_path, cas_path(digest, suffix)), True
+
+# --- Compression ---
+
+def compression_method(config):
+    """raw_compression from config.ini: 'none' (default), 'gzip' or 'zstd' (falls back to gzip without the zstandard package)."""
+    method = str(config.get('raw_compression', 'none')).strip().lower() or 'none'
+    if method not in RAW_SUFFIXES:
+        _warn_once(f"Unknown raw_compression '{method}', storing uncompressed.")
+        return 'none'
+    if method == 'zstd' and zstandard is None:
+        _warn_once("raw_compression: zstd needs 'pip install zstandard'. Using gzip instead.")
+        return 'gzip'
+    return method
+
+_WARNED = set()
+
+def _warn_once(text):
+    if text not in _WARNED:
+        _WARNED.add(text)
+        print(text)
+
+def raw_format(path):
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return 'none'
+
+def compress_file(src_path, dest_path, method):
+    """Compress src_path into dest_path in chunks. The source is left alone."""
+    with open(src_path, 'rb') as src:
+        if method == 'gzip':
+            with gzip.open(dest_path, 'wb', compresslevel=GZIP_LEVEL) as dest:
+                shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+        elif method == 'zstd':
+            cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            with open(dest_path, 'wb') as dest:
+                # Passing the size records it in the frame header (raw_size() reads it back)
+                cctx.copy_stream(src, dest, size=os.path.getsize(src_path), write_size=COPY_CHUNK_SIZE)
+        else:
+            shutil.copyfile(src_path, dest_path)
+
+def compress_temp(temp_path, method):
+    """Compress a finished download (temp file) and return the new temp path. 'none' returns it unchanged."""
+    if method == 'none':
+        return temp_path
+    out_path = new_temp_path()
+    try:
+        compress_file(temp_path, out_path, method)
+    except:
+        discard_temp(out_path)
+        raise
+    discard_temp(temp_path)
+    return out_path
+
+def open_raw(row):
+    """
+    Open a stored raw email for reading, whatever its format.
+    `row` is an emails row (anything with ['local_path']) or a path.
+    Returns a binary file object that decompresses as it is read; use it in a with-block.
+    """
+    path = row if isinstance(row, str) else row['local_path']
+    fmt = raw_format(path)
+    if fmt == 'gzip':
+        return gzip.open(path, 'rb')
+    if fmt == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd compressed. Install the zstandard package to read it.")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.BufferedReader(reader, COPY_CHUNK_SIZE)
+    return open(path, 'rb')
+
+def read_raw(row):
+    """Whole message as bytes (for callers that need it all anyway)."""
+    with open_raw(row) as f:
+        return f.read()
+
+def raw_size(row):
+    """Uncompressed size of a stored email (None if the file is missing)."""
+    path = row if isinstance(row, str) else row['local_path']
+    if not path or not os.path.exists(path):
+        return None
+    fmt = raw_format(path)
+    if fmt == 'gzip':
+        # ISIZE trailer: size mod 2^32, fine for emails
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+    if fmt == 'zstd' and zstandard is not None:
+        with open(path, 'rb') as f:
+            size = zstandard.frame_content_size(f.read(18))
+        if size >= 0:
+            return size
+    if fmt != 'none':
+        # Unknown content size: count it
+        total = 0
+        with open_raw(path) as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                total += len(chunk)
+        return total
+    return os.path.getsize(path)
+
+def raw_name(path):
+    """File name without the compression suffix (what the email was called originally)."""
+    name = os.path.basename(path)
+    for suffix in RAW_SUFFIXES.values():
+        if suffix and name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def extract_raw(path, dest_dir):
+    """Write the uncompressed email into dest_dir (for tools like 7-Zip that need a plain file)."""
+    if raw_format(path) == 'none':
+        return path
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, raw_name(path))
+    with open_raw(path) as src, open(dest, 'wb') as out:
+        shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+    return dest
+
+def _compress_in_place(path, method):
+    """Worker for compress_raw_store: path -> (path, new_path or None, error)."""
+    try:
+        new_path = path + RAW_SUFFIXES[method]
+        if not os.path.exists(path):
+            # Compressed by an interrupted run before the DB was updated
+            if os.path.exists(new_path):
+                return path, new_path, None
+            return path, None, "missing"
+        part = new_path + ".part"
+        compress_file(path, part, method)
+        os.replace(part, new_path)
+        os.remove(path)
+        return path, new_path, None
+    except Exception as e:
+        discard_temp(path + RAW_SUFFIXES[method] + ".part")
+        return path, None, str(e)
+
+def compress_raw_store(method=None, jobs=None, commit_every=500):
+    """
+    Compress every uncompressed raw email in parallel (one process per job) and
+    update emails.local_path. Safe to interrupt and run again.
+    """
+    from config import load_config
+    from db import get_db_connection
+    
+    method = method or compression_method(load_config())
+    if method == 'none':
+        print("raw_compression is 'none'. Pass --method gzip or zstd (or set raw_compression in config.ini).")
+        return 0
+    if method == 'zstd' and zstandard is None:
+        print("zstd needs 'pip install zstandard'.")
+        return 0
+    jobs = jobs or os.cpu_count() or 1
+    
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT local_path FROM emails WHERE local_path LIKE '%.eml'")
+        paths = [r[0] for r in c.fetchall()]
+        print(f"Compressing {len(paths)} raw emails with {method} ({jobs} jobs)...")
+        
+        done = 0
+        failed = 0
+        before_bytes = 0
+        after_bytes = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            for path, new_path, err in pool.map(_compress_in_place, paths, [method] * len(paths), chunksize=64):
+                if err:
+                    failed += 1
+                    if err != "missing":
+                        print(f"  Failed {path}: {err}")
+                    continue
+                before_bytes += raw_size(new_path) or 0
+                after_bytes += os.path.getsize(new_path)
+                # Several rows can share a file (raw_storage: cas)
+                c.execute("UPDATE emails SET local_path = ? WHERE local_path = ?", (new_path, path))
+                done += 1
+                if done % commit_every == 0:
+                    conn.commit()
+                    print(f"  {done}/{len(paths)} compressed...")
+        conn.commit()
+    finally:
+        conn.close()
+        
+    ratio = (before_bytes / after_bytes) if after_bytes else 0
+    print(f"Compressed {done} emails ({failed} skipped/failed): {before_bytes / (1024*1024):.1f}MB -> {after_bytes / (1024*1024):.1f}MB ({ratio:.1f}x).")
+    return done
+
+def read_header_block(fp):
+    """Read the header block (up to and including the blank line) from a binary file object."""
+    lines = []
+    total = 0
+    while total < MAX_HEADER_BYTES:
+        line = fp.readline(65536)
+        if not line:
+            break
+        lines.append(line)
+        total += len(line)
+        if line in (b'\r\n', b'\n'):
+            break
+    return b''.join(lines)
+
+def read_headers(path):
+    """Parse only the headers of a raw email file (compressed or not). The body is never loaded."""
+    with open_raw(path) as f:
+        header_bytes = read_header_block(f)
+    return BytesHeaderParser().parsebytes(header_bytes)
+
+def _decode_filename(name):
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+def _visit_part(headers, boundaries):
+    """Register a multipart boundary. Returns (attachment file name or None, is_embedded_message)."""
+    if headers.get_content_maintype() == 'multipart':
+        boundary = headers.get_boundary()
+        if boundary:
+            boundaries.add(boundary.encode('utf-8', 'surrogateescape'))
+        return None, False
+    if headers.get_content_type() == 'message/rfc822':
+        # Not counted itself (no decodable payload), but its own attachments are
+        return None, True
+    # Attachment = a part with a Content-Disposition and a file name
+    filename = headers.get_filename()
+    if headers.get('Content-Disposition') is not None and filename:
+        return _decode_filename(filename), False
+    return None, False
+
+class _AttachmentSize:
+    """Decoded size of one attachment body, fed line by line."""
+    def __init__(self, name, headers):
+        self.name = name
+        self.encoding = str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+        self.size = 0
+        self.b64_chars = 0
+        self.pending_eol = 0 # The line break before a boundary is not part of the body
+
+    def add(self, line):
+        content = line.rstrip(b'\r\n')
+        if self.encoding == 'base64':
+            content = content.strip()
+            self.b64_chars += len(content) - content.count(b'=')
+            return
+        eol = len(line) - len(content)
+        if self.encoding == 'quoted-printable':
+            if content.endswith(b'='):
+                content, eol = content[:-1], 0 # Soft line break
+            content = binascii.a2b_qp(content)
+        self.size += self.pending_eol + len(content)
+        self.pending_eol = eol
+
+    def result(self):
+        size = self.b64_chars * 3 // 4 if self.encoding == 'base64' else self.size
+        return {'name': self.name, 'size': size}
+
+def scan_attachments(fp, headers=None):
+    """
+    Attachments of a raw email as [{'name', 'size'}] (size decoded), in one line-by-line pass
+    over a binary file object. Only the header blocks of the MIME parts are parsed.
+    headers: the top-level headers if the caller already read them from fp.
+    Attachments with an empty body are left out.
+    """
+    parser = BytesHeaderParser()
+    boundaries = set()
+    found = []
+    
+    if headers is None:
+        headers = parser.parsebytes(read_header_block(fp))
+    name, _ = _visit_part(headers, boundaries)
+    current = _AttachmentSize(name, headers) if name else None
+    
+    if boundaries or current:
+        for line in iter(lambda: fp.readline(65536), b''):
+            marker = line.rstrip()[2:] if line.startswith(b'--') else None
+            if marker and (marker in boundaries or (marker.endswith(b'--') and marker[:-2] in boundaries)):
+                if current: found.append(current.result())
+                current = None
+                if marker in boundaries:
+                    # Part headers follow the boundary line (and an embedded message's headers follow those)
+                    embedded = True
+                    while embedded:
+                        part_headers = parser.parsebytes(read_header_block(fp))
+                        name, embedded = _visit_part(part_headers, boundaries)
+                        if name: current = _AttachmentSize(name, part_headers)
+                continue
+            if current:
+                current.add(line)
+        if current: found.append(current.result())
+                
+    return [a for a in found if a['size']]
+
+def count_attachments(fp, headers=None, names=None):
+    """
+    Count the attachments of a raw email from a binary file object (see scan_attachments).
+    names: optional list that receives the attachment file names.
+    """
+    found = scan_attachments(fp, headers)
+    if names is not None:
+        names.extend(a['name'] for a in found)
+    return len(found)
+
+def scan_email(row):
+    """
+    One pass over a stored email: (top-level headers, attachments as in scan_attachments).
+    The body is streamed, never loaded whole.
+    """
+    with open_raw(row) as f:
+        headers = BytesHeaderParser().parsebytes(read_header_block(f))
+        return headers, scan_attachments(f, headers)
+
+def mime_part_offsets(fp):
+    """
+    (offset, size) of every top-level part of a multipart message, from a binary file object.
+    A part is its headers and encoded body, without the boundary lines around it, so
+    read_archive_part can pull one email out of a concentrated archive without parsing the rest.
+    """
+    headers = BytesHeaderParser().parsebytes(read_header_block(fp))
+    boundary = headers.get_boundary()
+    if not boundary:
+        return []
+    delimiter = b'--' + boundary.encode()
+
+    offsets = []
+    start = None
+    pos = fp.tell()
+    prev_eol = 0
+    at_line_start = True
+    for line in iter(lambda: fp.readline(65536), b''):
+        if at_line_start and line.startswith(delimiter):
+            rest = line[len(delimiter):].rstrip(b'\r\n \t')
+            if rest in (b'', b'--'):
+                # The line break before a boundary belongs to the boundary
+                if start is not None:
+                    offsets.append((start, pos - prev_eol - start))
+                start = pos + len(line) if rest == b'' else None
+                if rest == b'--':
+                    break
+        prev_eol = len(line) - len(line.rstrip(b'\r\n'))
+        at_line_start = line.endswith(b'\n')
+        pos += len(line)
+    return offsets
+
+def _header_block(msg):
+    data = msg.as_bytes()
+    return data[:data.find(b'\n\n') + 2]
+
+def _read_full(fp, size):
+    # Decompressing readers may return short reads; base64 lines need whole blocks
+    chunks = []
+    while size > 0:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+BOUNDARY_LEN = 36
+
+def new_boundary():
+    # Same shape as the email package's boundaries; base64 bodies can never contain it
+    return '=' * 15 + f'{random.randrange(10 ** 19):019d}' + '=='
+
+def base64_size(n):
+    """Length of base64.encodebytes() output for n bytes (76-char lines, each with a newline)."""
+    return 4 * ((n + 2) // 3) + (n + 56) // 57
+
+def _attachment_part(filename, subtype):
+    part = MIMEApplication(b'', _subtype=subtype)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+def attachment_part_size(filename, subtype, size):
+    """Bytes write_multipart writes for one member of `size` bytes (part headers and base64 body)."""
+    return len(_header_block(_attachment_part(filename, subtype))) + base64_size(size)
+
+def multipart_size(outer, parts_size, part_count):
+    """
+    Exact size of the write_multipart output for `outer`: its headers, the boundary lines,
+    and part_count parts of parts_size bytes in total (see attachment_part_size).
+    `outer` itself is left alone (the placeholder boundary is set on a copy).
+    """
+    outer = copy.deepcopy(outer)
+    outer.set_boundary('=' * BOUNDARY_LEN)
+    delimiter = BOUNDARY_LEN + 3 # --boundary\n
+    return (len(_header_block(outer)) + parts_size + part_count * delimiter + (part_count - 1)
+            + BOUNDARY_LEN + 6) # \n--boundary--\n
+
+def split_ranges(size, part_size):
+    """(offset, length) of the pieces a file of `size` bytes is split into."""
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+def _member_blocks(source):
+    # Whole raw email (path, decompressed), or an (path, offset, length) range of a file's stored bytes
+    if isinstance(source, str):
+        with open_raw(source) as src:
+            yield from iter(lambda: _read_full(src, BASE64_BLOCK), b'')
+        return
+    path, offset, length = source
+    with open(path, 'rb') as src:
+        src.seek(offset)
+        while length > 0:
+            block = _read_full(src, min(BASE64_BLOCK, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+def write_multipart(file_path, outer, members, extra_parts=()):
+    """
+    Stream a multipart message to file_path without holding it in memory: the headers of
+    `outer`, then every member (filename, subtype, source) as a base64 attachment encoded
+    block by block straight from its source, then the (small) extra_parts as they are.
+    A source is a raw email path (open_raw, so compressed raw emails work) or a
+    (path, offset, length) range of a file (split emails). The parts are written exactly as
+    given, with no newline added after a part that lacks one, so this is a valid MIME
+    message but not always byte for byte what outer.as_bytes() would produce.
+    Returns the (offset, size) of every part, like mime_part_offsets.
+    """
+    boundary = new_boundary()
+    outer.set_boundary(boundary)
+    delimiter = b'--' + boundary.encode()
+
+    offsets = []
+    with open(file_path, 'wb') as out:
+        out.write(_header_block(outer))
+        for n, (filename, subtype, source) in enumerate(members):
+            out.write((b'\n' if n else b'') + delimiter + b'\n')
+            start = out.tell()
+            out.write(_header_block(_attachment_part(filename, subtype)))
+            for block in _member_blocks(source):
+                out.write(base64.encodebytes(block))
+            offsets.append((start, out.tell() - start))
+        for n, part in enumerate(extra_parts, len(members)):
+            out.write((b'\n' if n else b'') + delimiter + b'\n')
+            start = out.tell()
+            out.write(part.as_bytes())
+            offsets.append((start, out.tell() - start))
+        out.write(b'\n' + delimiter + b'--\n')
+    return offsets
+
+def read_archive_part(path, offset, size):
+    """Decoded content of one part of a concentrated archive (e.g. the original email bytes)."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        part = BytesParser().parsebytes(f.read(size))
+    return part.get_payload(decode=True)
+
+def read_body_text(row, max_message_bytes=FTS_BODY_MAX_MESSAGE, max_chars=FTS_BODY_MAX_CHARS):
+    """
+    Plain text of an email's body for the search index ('' if it has none or is too big to parse).
+    HTML-only bodies are stripped of tags.
+    """
+    size = raw_size(row)
+    if not size or size > max_message_bytes:
+        return ''
+    try:
+        with open_raw(row) as f:
+            msg = BytesParser(policy=email.policy.default).parse(f)
+        part = msg.get_body(preferencelist=('plain', 'html'))
+        if part is None:
+            return ''
+        text = part.get_content()
+        if part.get_content_subtype() == 'html':
+            text = html.unescape(re.sub(r'(?is)<(script|style).*?</\1>|<[^>]+>', ' ', text))
+        return re.sub(r'\s+', ' ', text)[:max_chars]
+    except Exception:
+        return ''
@@ -4,6 +4,7 @@ import imaplib
 import sqlite3
 from config import load_config
 from db import get_db_connection
+from quota import TransferBudget, is_quota_error
 
 TARGET_FOLDER = "Concentrated_Emails"
 
@@ -46,7 +47,7 @@ def ensure_remote_folder(mail, folder=TARGET_FOLDER):
         print(f"Folder Ensure Error: {e}")
         return False
 
-def upload_to_imap(file_path, retry_interactive=True, mail_conn=None, check_folder=True):
+def upload_to_imap(file_path, retry_interactive=True, mail_conn=None, check_folder=True, budget=None):
     should_close = False
     
     while True:
@@ -65,6 +66,9 @@ def upload_to_imap(file_path, retry_interactive=True, mail_conn=None, check_fold
             with open(file_path, 'rb') as f:
                 msg_data = f.read()
                 
+            if budget:
+                budget.throttle(len(msg_data))
+                
             # print(f"Uploading {os.path.basename(file_path)}...")
             typ, data = mail.append(TARGET_FOLDER, None, imaplib.Time2Internaldate(time.time()), msg_data)
             
@@ -81,8 +85,11 @@ def upload_to_imap(file_path, retry_interactive=True, mail_conn=None, check_fold
                 try: mail.logout() 
                 except: pass
 
-            if "limit exceed" in str(e).lower() or "quota" in str(e).lower():
+            if is_quota_error(e):
                 print("CRITICAL: Upload limit exceeded. Aborting.")
+                if budget:
+                    # Remember it, so runs later today stop before connecting
+                    budget.mark_exhausted('upload')
                 # Close connection if possible
                 try: mail.logout()
                 except: pass
@@ -113,6 +120,12 @@ def upload_pending_concentrated_emails():
 
     print(f"Found {len(rows)} pending files.")
     
+    budget = TransferBudget()
+    if budget.daily_bytes and budget.remaining() <= 0:
+        print(f"Daily transfer budget used up ({budget.describe()}). Run again tomorrow.")
+        return
+    print(f"Transfer budget: {budget.describe()}")
+    
     mail = None
     try:
         print("Connecting to IMAP for batch upload...")
@@ -138,11 +151,18 @@ def upload_pending_concentrated_emails():
             print(f"File missing: {file_path}. Skipping.")
             continue
             
+        # Only start uploads that fit entirely in today's budget
+        file_size = os.path.getsize(file_path)
+        if not budget.try_reserve(file_size):
+            print(f"Daily transfer budget reached ({budget.describe()}). Stopping before {os.path.basename(file_path)}; run again tomorrow.")
+            break
+            
         print(f"Uploading ID {record_id}: {os.path.basename(file_path)}...")
         
         # Pass usage of shared connection, skip folder check since we did it once
-        success = upload_to_imap(file_path, retry_interactive=False, mail_conn=mail, check_folder=False)
+        success = upload_to_imap(file_path, retry_interactive=False, mail_conn=mail, check_folder=False, budget=budget)
         if success:
+            budget.commit(file_size, 'upload')
             conn = get_db_connection()
             c = conn.cursor()
             c.execute("UPDATE concentrated_emails SET uploaded = 1 WHERE id = ?", (record_id,))
@@ -150,6 +170,7 @@ def upload_pending_concentrated_emails():
             conn.close()
             success_count += 1
         else:
+            budget.release(file_size)
             fail_count += 1
             # Reconnection logic is handled in upload_to_imap somewhat, but here we loop
             # If aborted due to limit, we exited already.